@@ -4,6 +4,26 @@ echo status: $2
 echo save dir: $3
 
 cd tools/culane_evaluation
+if ! ./evaluate -h > /dev/null 2>&1; then
+    # No usable official C++ evaluator (e.g. OpenCV libraries not found), use the python one with the same results
+    if [ -f "../../output/$1.lanes.npz" ]; then
+        detect_dir=../../output/$1.lanes.npz/
+    else
+        detect_dir=../../output/
+    fi
+    if [ "$2" = "test" ]; then
+        python ../culane_evaluation_py/evaluate.py --exp-name=$1 --mode=test --detect-dir=${detect_dir} ${3:+--save-dir=$3}
+        python cal_total.py --exp-name=$1 --save-dir=$3
+    else
+        python ../culane_evaluation_py/evaluate.py --exp-name=$1 --mode=val --detect-dir=${detect_dir} ${3:+--save-dir=$3}
+    fi
+    cd ../../
+    exit
+fi
+if [ -f "../../output/$1.lanes.npz" ]; then
+    # Export packed predictions (test.output_format='packed') for the official scripts
+    python ../culane_evaluation_py/lane_store.py --packed-file=../../output/$1.lanes.npz
+fi
 if [ "$2" = "test" ]; then
     # Perform test with official scripts
     ./eval.sh $1 $3
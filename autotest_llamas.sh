@@ -4,10 +4,15 @@ echo status: $2
 echo save dir: $3
 data_dir=../../../../dataset/llamas/labels/valid
 cd tools/llamas_evaluation/
+pred_dir=../../output/valid
+if [ -f "../../output/$1.lanes.npz" ]; then
+    # Read packed predictions (test.output_format='packed') directly
+    pred_dir=../../output/$1.lanes.npz/valid
+fi
 
 if [ "$2" = "val" ]; then
     # we can provide the valid set to evaluate models
-    python evaluate.py --pred_dir=../../output/valid --anno_dir=${data_dir} --exp_name=$1 --save-dir=$3
+    python evaluate.py --pred_dir=${pred_dir} --anno_dir=${data_dir} --exp_name=$1 --save-dir=$3
 else
     echo "The test set of llamas is not public available."
 fi
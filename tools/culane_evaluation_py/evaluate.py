@@ -0,0 +1,298 @@
+# A python CULane evaluator that reproduces the official C++ one (tools/culane_evaluation/evaluate),
+# same spline interpolation, rasterization (cvRound points, 1 thick polyline per lane), KM matching and output files,
+# but each lane is rasterized only once (cropped & bit-packed) with IoUs of all pairs in 1 vectorized pass,
+# and images are processed by a process pool
+import os
+import argparse
+import numpy as np
+import cv2
+from concurrent.futures import ProcessPoolExecutor
+from tqdm import tqdm
+from lane_store import split_packed_path, open_packed_lanes
+
+TEST_SPLITS = ['test0_normal', 'test1_crowd', 'test2_hlight', 'test3_shadow', 'test4_noline',
+               'test5_arrow', 'test6_curve', 'test7_cross', 'test8_night']
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.int64)
+
+
+def read_lane_file(filename):
+    # Same as the official read_lane_file(): every line is a lane (could be empty), points are stored as float32,
+    # non-exist file means no lanes
+    packed = split_packed_path(filename)
+    if packed is not None:
+        store = open_packed_lanes(packed[0])
+        return [np.array(lane, dtype=np.float32) for lane in store[packed[1]]] if packed[1] in store else []
+    if not os.path.exists(filename):
+        return []
+    lanes = []
+    with open(filename, 'r') as f:
+        for line in f.readlines():
+            values = []
+            for v in line.split():  # Stream extraction stops at the first non-number
+                try:
+                    values.append(float(v))
+                except ValueError:
+                    break
+            values = values[:len(values) // 2 * 2]
+            lanes.append(np.array(values, dtype=np.float32).reshape(-1, 2))
+
+    return lanes
+
+
+def spline_interp_times(points, times=50):
+    # Port of the official Spline::splineInterpTimes() for > 2 points (natural cubic spline by TDMA),
+    # points: N x 2 float32, same float32/float64 arithmetic as the C++ code
+    n = points.shape[0]
+    diffs = (points[1:] - points[:-1]).astype(np.float64)  # float - float in C++ is float
+    h = np.sqrt(np.power(diffs[:, 0], 2) + np.power(diffs[:, 1], 2))
+    slopes = diffs / h[:, None]
+    d = (6 * (slopes[1:] - slopes[:-1])).tolist()
+    a = h[:-1].tolist()
+    b = (2 * (h[:-1] + h[1:])).tolist()
+    c = h[1:].tolist()
+
+    # TDMA
+    c[0] = c[0] / b[0]
+    d[0] = [d[0][0] / b[0], d[0][1] / b[0]]
+    for i in range(1, n - 2):
+        tmp = b[i] - a[i] * c[i - 1]
+        c[i] = c[i] / tmp
+        d[i] = [(d[i][0] - a[i] * d[i - 1][0]) / tmp, (d[i][1] - a[i] * d[i - 1][1]) / tmp]
+    m = [[0., 0.] for _ in range(n)]
+    m[n - 2] = list(d[n - 3])
+    for i in range(n - 4, -1, -1):
+        m[i + 1] = [d[i][0] - c[i] * m[i + 2][0], d[i][1] - c[i] * m[i + 2][1]]
+    m[0] = [0., 0.]
+    m[n - 1] = [0., 0.]
+    m = np.array(m)
+
+    # Coefficients of each segment (n - 1 x 2)
+    h2 = h[:, None]
+    coef_a = points[:-1].astype(np.float64)
+    coef_b = slopes - (2 * h2 * m[:-1] + h2 * m[1:]) / 6
+    coef_c = m[:-1] / 2
+    coef_d = (m[1:] - m[:-1]) / (6 * h2)
+
+    # Sample times points per segment
+    t = (h / times)[:, None] * np.arange(times, dtype=np.float64)[None, :]  # n - 1 x times
+    t = t[..., None]
+    res = coef_a[:, None] + coef_b[:, None] * t + coef_c[:, None] * np.power(t, 2) + coef_d[:, None] * np.power(t, 3)
+    res = np.concatenate([res.reshape(-1, 2).astype(np.float32), points[-1:]])
+
+    return res
+
+
+def interp_lane(lane, times=50):
+    # As in LaneCompare::get_lane_similarity()
+    if lane.shape[0] < 2:
+        return None
+    elif lane.shape[0] == 2:
+        return lane
+    else:
+        return spline_interp_times(lane, times)
+
+
+def rasterize_lanes(lanes, width, im_width, im_height, times=50):
+    # Draw each lane once on a canvas cropped to the union bounding box of all lanes (of 1 image pair),
+    # Return: L x h x ceil(w / 8) bit-packed masks, L pixel areas
+    # Points are rounded like Point2f -> Point (cvRound) in cv::line()
+    lanes = [interp_lane(lane, times) for lane in lanes]
+    lanes = [None if lane is None else np.rint(lane).astype(np.int64) for lane in lanes]
+    valid = [lane for lane in lanes if lane is not None]
+    if len(valid) == 0:
+        return np.zeros((len(lanes), 1, 1), dtype=np.uint8), np.zeros(len(lanes), dtype=np.int64)
+    all_points = np.concatenate(valid)
+    r = width // 2 + 2
+    x0 = int(min(max(all_points[:, 0].min() - r, 0), im_width - 1))
+    x1 = int(max(min(all_points[:, 0].max() + r, im_width - 1), 0))
+    y0 = int(min(max(all_points[:, 1].min() - r, 0), im_height - 1))
+    y1 = int(max(min(all_points[:, 1].max() + r, im_height - 1), 0))
+    offset = np.array([x0, y0])
+    masks = []
+    for lane in lanes:
+        canvas = np.zeros((y1 - y0 + 1, x1 - x0 + 1), dtype=np.uint8)
+        if lane is not None:
+            # Same pixels as drawing each segment by cv::line() on the full image
+            # (shared end caps are the same circles, clipping is translation invariant)
+            cv2.polylines(canvas, [(lane - offset).astype(np.int32)], isClosed=False, color=(1,), thickness=width)
+        masks.append(canvas)
+    masks = np.packbits(np.stack(masks), axis=-1)
+
+    return masks, POPCOUNT[masks].reshape(masks.shape[0], -1).sum(axis=-1)
+
+
+def cross_iou(anno_lanes, detect_lanes, width=30, im_width=1640, im_height=590):
+    # IoU of all pairs, in 1 vectorized pass over bit-packed masks
+    masks, areas = rasterize_lanes(anno_lanes + detect_lanes, width, im_width, im_height)
+    num_anno = len(anno_lanes)
+    inter = POPCOUNT[np.bitwise_and(masks[:num_anno, None], masks[None, num_anno:])]
+    inter = inter.reshape(num_anno, len(detect_lanes), -1).sum(axis=-1)
+    union = areas[:num_anno, None] + areas[None, num_anno:] - inter
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ious = np.where(union > 0, inter / np.maximum(union, 1), 0.)  # Official returns 0 for < 2 points
+
+    return ious
+
+
+def km_match(similarity):
+    # Port of the official pipartiteGraph (hungarianGraph.hpp), Kuhn-Munkres with a 1e-2 tolerance,
+    # results could differ to an exact maximum weight matching, so we keep it for the same F1
+    similarity = similarity.tolist()
+    m, n = len(similarity), len(similarity[0])
+    exchange = m > n
+    if exchange:
+        m, n = n, m
+        mat = [[similarity[j][i] for j in range(n)] for i in range(m)]
+    else:
+        mat = similarity
+    left_match = [-1] * m
+    right_match = [-1] * n
+    right_weight = [0.] * n
+    left_weight = [max([-1e5] + row) for row in mat]
+    left_used = [False] * m
+    right_used = [False] * n
+
+    def match_dfs(u):
+        left_used[u] = True
+        for v in range(n):
+            if not right_used[v] and abs(left_weight[u] + right_weight[v] - mat[u][v]) < 1e-2:
+                right_used[v] = True
+                if right_match[v] == -1 or match_dfs(right_match[v]):
+                    right_match[v] = u
+                    left_match[u] = v
+                    return True
+        return False
+
+    for u in range(m):
+        while True:
+            for i in range(m):
+                left_used[i] = False
+            for i in range(n):
+                right_used[i] = False
+            if match_dfs(u):
+                break
+            d = 1e10
+            for i in range(m):
+                if left_used[i]:
+                    for j in range(n):
+                        if not right_used[j]:
+                            d = min(d, left_weight[i] + right_weight[j] - mat[i][j])
+            if d == 1e10:
+                return (right_match, left_match) if exchange else (left_match, right_match)
+            for i in range(m):
+                if left_used[i]:
+                    left_weight[i] -= d
+            for i in range(n):
+                if right_used[i]:
+                    right_weight[i] += d
+
+    return (right_match, left_match) if exchange else (left_match, right_match)
+
+
+def count_im_pair(anno_lanes, detect_lanes, iou_threshold=0.5, width=30, im_width=1640, im_height=590):
+    # Same as the official Counter::count_im_pair(), Return: tp, fp, fn
+    if len(anno_lanes) == 0:
+        return 0, len(detect_lanes), 0
+    if len(detect_lanes) == 0:
+        return 0, 0, len(anno_lanes)
+    similarity = cross_iou(anno_lanes, detect_lanes, width, im_width, im_height)
+    anno_match, _ = km_match(similarity)
+    tp = sum([1 for i in range(len(anno_lanes)) if anno_match[i] >= 0 and similarity[i][anno_match[i]] > iou_threshold])
+
+    return tp, len(detect_lanes) - tp, len(anno_lanes) - tp
+
+
+def _count_file_pair(args):
+    anno_file, detect_file, iou_threshold, width, im_width, im_height = args
+
+    return count_im_pair(read_lane_file(anno_file), read_lane_file(detect_file),
+                         iou_threshold, width, im_width, im_height)
+
+
+def evaluate_list(list_file, anno_dir, detect_dir, iou_threshold=0.5, width=30, im_width=1640, im_height=590,
+                  workers=None, executor=None):
+    # Return: tp, fp, fn of images in list_file (paths are concatenated as strings, like the official code)
+    with open(list_file, 'r') as f:
+        names = [x.strip() for x in f.readlines() if x.strip()]
+    names = [x[:x.rfind('.')] + '.lines.txt' for x in names]
+    jobs = [(anno_dir + x, detect_dir + x, iou_threshold, width, im_width, im_height) for x in names]
+    if executor is None:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(tqdm(executor.map(_count_file_pair, jobs, chunksize=64), total=len(jobs)))
+    else:
+        results = list(tqdm(executor.map(_count_file_pair, jobs, chunksize=64), total=len(jobs)))
+    tp = sum([x[0] for x in results])
+    fp = sum([x[1] for x in results])
+    fn = sum([x[2] for x in results])
+
+    return tp, fp, fn
+
+
+def format_result(output_file, tp, fp, fn):
+    # Same content as the official output file
+    precision = tp / (tp + fp) if tp + fp != 0 else -1.
+    recall = tp / (tp + fn) if tp + fn != 0 else -1.
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall != 0 else float('nan')
+
+    return 'file: {}\ntp: {} fp: {} fn: {}\nprecision: {:g}\nrecall: {:g}\nFmeasure: {:g}\n\n'.format(
+        output_file, tp, fp, fn, precision, recall, f1)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Python CULane evaluation, same results as the official C++ one')
+    parser.add_argument('--exp-name', type=str, help='Name of experiment', required=True)
+    parser.add_argument('--save-dir', type=str, help='Path prefix to save full res.')
+    parser.add_argument('--anno-dir', type=str, default='../../../../dataset/culane/',
+                        help='Directory for annotation files (default: ../../../../dataset/culane/)')
+    parser.add_argument('--detect-dir', type=str, default='../../output/',
+                        help='Directory for detection files, could be inside a packed store, '
+                             'e.g. ../../output/<exp_name>.lanes.npz/ (default: ../../output/)')
+    parser.add_argument('--mode', type=str, default='test',
+                        help='Evaluate on test splits (test) or validation set (val)')
+    parser.add_argument('--width', type=int, default=30, help='Width of the lanes (default: 30)')
+    parser.add_argument('--iou', type=float, default=0.5, help='Threshold of iou (default: 0.5)')
+    parser.add_argument('--im-width', type=int, default=1640, help='Image width (default: 1640)')
+    parser.add_argument('--im-height', type=int, default=590, help='Image height (default: 590)')
+    parser.add_argument('--workers', type=int, default=None, help='Number of processes (default: number of CPUs)')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    # Run in tools/culane_evaluation, writes the same files as eval.sh & eval_validation.sh
+    args = parse_args()
+    if args.mode == 'test':
+        lists = [os.path.join(args.anno_dir, 'list', 'test_split', x + '.txt') for x in TEST_SPLITS]
+        outputs = ['./output/out{}.txt'.format(x[4:]) for x in TEST_SPLITS]
+        final_output = './output/{}_iou{}_split.txt'.format(args.exp_name, args.iou)
+        save_name = 'test_result.txt'
+    elif args.mode == 'val':
+        lists = [os.path.join(args.anno_dir, 'list', 'val.txt')]
+        outputs = ['./output/{}_iou{}_validation.txt'.format(args.exp_name, args.iou)]
+        final_output = None
+        save_name = 'val_result.txt'
+    else:
+        raise ValueError
+    os.makedirs('./output', exist_ok=True)
+    contents = []
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        for list_file, output_file in zip(lists, outputs):
+            tp, fp, fn = evaluate_list(list_file, args.anno_dir, args.detect_dir, args.iou, args.width,
+                                       args.im_width, args.im_height, executor=executor)
+            contents.append(format_result(output_file, tp, fp, fn))
+            print(contents[-1])
+            with open(output_file, 'w') as f:
+                f.write(contents[-1])
+    if final_output is not None:
+        with open(final_output, 'w') as f:
+            f.write(''.join(contents))
+    else:
+        final_output = outputs[0]
+
+    if args.save_dir is not None:
+        save_dir = os.path.join('../../', args.save_dir, args.exp_name)
+        os.makedirs(save_dir, exist_ok=True)
+        with open(final_output, 'r') as f:
+            res = f.read()
+        with open(os.path.join(save_dir, save_name), 'w') as f:
+            f.write(res)
@@ -0,0 +1,148 @@
+# A packed store for lane predictions (CULane format), instead of 1 .lines.txt file per image
+# Single uncompressed .npz file (also readable by np.load), arrays are memory-mapped when reading:
+#   key_bytes: uint8, utf-8 encoded keys (.lines.txt paths relative to the store's directory) concatenated
+#   key_offsets: int64, (num_images + 1)
+#   lane_offsets: int64, (num_images + 1), index into point_offsets
+#   point_offsets: int64, (num_lanes + 1), index into points
+#   points: float32, (num_points x 2), [x, y]
+#   (other arrays could be stored along, e.g. by the LLAMAS GT cache)
+# A path inside the store is treated like a path inside a directory,
+# e.g. ./output/exp.lanes.npz/driver_37_30frame/05181432_0203.MP4/00000.lines.txt
+import os
+import argparse
+import numpy as np
+from importmagician import import_from
+# Import packed.py as a standalone module, importing the utils package would load all models (torch, mmcv, etc.)
+with import_from(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../utils/datasets')):
+    from packed import load_npz_arrays
+
+PACKED_SUFFIX = '.lanes.npz'
+PACKED_VERSION = 1
+_opened_stores = {}
+
+
+def save_packed_lanes(filename, keys, predictions, dtype=np.float32, **extra_arrays):
+    # keys: list of str
+    # predictions: list (per image) of lists of lanes, each lane is a list/array of [x, y]
+    # dtype: dtype of points, extra_arrays: other arrays to save in the same file
+    key_bytes = [os.path.normpath(k).encode('utf-8') for k in keys]
+    key_offsets = np.cumsum([0] + [len(k) for k in key_bytes], dtype=np.int64)
+    lanes = [np.asarray(lane, dtype=dtype).reshape(-1, 2) for lanes in predictions for lane in lanes]
+    lane_offsets = np.cumsum([0] + [len(lanes) for lanes in predictions], dtype=np.int64)
+    point_offsets = np.cumsum([0] + [len(lane) for lane in lanes], dtype=np.int64)
+    points = np.concatenate(lanes) if len(lanes) > 0 else np.zeros((0, 2), dtype=dtype)
+
+    # Write to a temp file then rename, so a half-written store is never read
+    temp = filename + '.tmp.npz'
+    np.savez(temp, version=np.array(PACKED_VERSION),
+             key_bytes=np.frombuffer(b''.join(key_bytes), dtype=np.uint8),
+             key_offsets=key_offsets, lane_offsets=lane_offsets, point_offsets=point_offsets, points=points,
+             **extra_arrays)
+    os.replace(temp, filename)
+    # Drop the store opened by this process before, it maps the replaced file
+    _opened_stores.pop(os.path.abspath(filename), None)
+
+
+class PackedLanes(object):
+    # Read-only, dict-like access: store[key] -> list of N x 2 float32 arrays
+    def __init__(self, filename, mmap=True):
+        self.filename = filename
+        arrays = load_npz_arrays(filename, mmap=mmap)
+        self.arrays = arrays
+        if int(arrays['version']) != PACKED_VERSION:
+            raise ValueError('Unsupported packed lane store version {} in {}'.format(int(arrays['version']), filename))
+        self.lane_offsets = arrays['lane_offsets']
+        self.point_offsets = arrays['point_offsets']
+        self.points = arrays['points']
+        key_bytes = bytes(arrays['key_bytes'])
+        key_offsets = arrays['key_offsets'].tolist()
+        self.index = {key_bytes[key_offsets[i]:key_offsets[i + 1]].decode('utf-8'): i
+                      for i in range(len(key_offsets) - 1)}
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return os.path.normpath(key) in self.index
+
+    def keys(self):
+        return self.index.keys()
+
+    def __getitem__(self, key):
+        i = self.index[os.path.normpath(key)]
+        starts = self.point_offsets[self.lane_offsets[i]:self.lane_offsets[i + 1] + 1].tolist()
+
+        return [self.points[starts[j]:starts[j + 1]] for j in range(len(starts) - 1)]
+
+    def lane_range(self, key):
+        # Global indices of lanes for key
+        i = self.index[os.path.normpath(key)]
+
+        return int(self.lane_offsets[i]), int(self.lane_offsets[i + 1])
+
+    def items(self):
+        for key in self.index.keys():
+            yield key, self[key]
+
+
+def open_packed_lanes(filename):
+    # Cached per process, memory-mapped pages are shared across processes
+    filename = os.path.abspath(filename)
+    if filename not in _opened_stores:
+        _opened_stores[filename] = PackedLanes(filename)
+
+    return _opened_stores[filename]
+
+
+def split_packed_path(path):
+    # ./output/exp.lanes.npz/a/b.lines.txt -> (./output/exp.lanes.npz, a/b.lines.txt), None if not in a store
+    path = os.path.normpath(path)
+    parts = path.split(os.sep)
+    for i in range(len(parts) - 1, 0, -1):
+        if parts[i - 1].endswith(PACKED_SUFFIX):
+            filename = os.sep.join(parts[:i])
+            if os.path.isfile(filename):
+                return filename, os.sep.join(parts[i:])
+    return None
+
+
+def load_lines(path):
+    # Read a CULane format prediction from a .lines.txt file or a packed store
+    # Return: a list of N x 2 arrays
+    packed = split_packed_path(path)
+    if packed is None:
+        with open(path, 'r') as f:
+            lines = f.readlines()
+        return [np.array([float(x) for x in line.split()]).reshape(-1, 2) for line in lines if line.strip()]
+    else:
+        filename, key = packed
+        return open_packed_lanes(filename)[key]
+
+
+def export_to_lines(filename, output_root=None):
+    # Write a packed store back to .lines.txt files (e.g. for the official C++ CULane evaluator)
+    if output_root is None:
+        output_root = os.path.dirname(filename)
+    store = PackedLanes(filename)
+    created_dirs = set()
+    for key, lanes in store.items():
+        path = os.path.join(output_root, key)
+        dir_name = os.path.dirname(path)
+        if dir_name not in created_dirs:
+            os.makedirs(dir_name, exist_ok=True)
+            created_dirs.add(dir_name)
+        with open(path, 'w') as f:
+            # str() of float32 scalars is the shortest repr that round-trips
+            f.write(''.join([''.join(['{} {} '.format(str(x), str(y)) for (x, y) in lane]) + '\n'
+                             for lane in lanes if len(lane) > 0]))
+
+    return len(store)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export a packed lane store to .lines.txt files')
+    parser.add_argument('--packed-file', type=str, help='Path to the .lanes.npz file', required=True)
+    parser.add_argument('--output-root', type=str, default=None,
+                        help='Root directory to write to (default: the directory of the packed file)')
+    args = parser.parse_args()
+    print('Exported {} files.'.format(export_to_lines(args.packed_file, args.output_root)))
@@ -1,12 +1,31 @@
 import argparse
 import json
 import os
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
 from loader import SimpleKPLoader
 from _utils import root_map, size_map
 from importmagician import import_from
 with import_from('./'):
-    from utils.curve_utils import BezierCurve as Bezier
+    from utils.curve_utils import fit_bezier_batched
+    from utils.datasets.lane_as_bezier import build_bezier_store
+
+
+def fit_shard(shard, order, interpolate):
+    # Fit all lanes of a shard of images together
+    # shard: list of (filename, list of lanes), Return: list of json lines
+    lanes = [kp for _, kps in shard for kp in kps if kp.shape[0] != 0]
+    control_points = iter(fit_bezier_batched(lanes, order=order, interpolate=interpolate))
+    results = []
+    for filename, kps in shard:
+        temp = [[round(p, 3) for p in next(control_points).flatten().tolist()] for kp in kps if kp.shape[0] != 0]
+        formatted = {
+            "raw_file": filename,
+            "bezier_control_points": temp
+        }
+        results.append(json.dumps(formatted))
+
+    return results
 
 
 if __name__ == '__main__':
@@ -15,6 +34,10 @@ if __name__ == '__main__':
     parser.add_argument('--image-set', type=str, default='train', help='train.txt/test.txt/val.txt/valfast.txt')
     parser.add_argument('--order', type=int, default=3, help='the order of curve')
     parser.add_argument('--norm', action='store_true', default=False, help='normalize coordinates')
+    parser.add_argument('--packed', action='store_true', default=False,
+                        help='also save the packed (memory-mappable) .npz labels for training')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of fitting processes')
+    parser.add_argument('--shard-size', type=int, default=1000, help='number of images fitted together')
     args = parser.parse_args()
 
     root = root_map[args.dataset]
@@ -23,23 +46,17 @@ if __name__ == '__main__':
     lane_interpolate = True if args.dataset == 'curvelanes' else False
     lkp = SimpleKPLoader(root=root, image_set=args.image_set, data_set=args.dataset, image_size=image_size, norm=False)
     keypoints = lkp.load_annotations()
+    items = list(keypoints.items())
+    shards = [items[i:i + args.shard_size] for i in range(0, len(items), args.shard_size)]
     all_lanes_kps = []
-    for kps in tqdm(keypoints.keys()):
-        temp = []
-        for kp in keypoints[kps]:
-            if kp.shape[0] == 0:
-                continue
-            fcns = Bezier(order=order)
-            fcns.get_control_points(kp[:, 0], kp[:, 1], interpolate=lane_interpolate)
-            matrix = fcns.save_control_points()
-            flatten = [round(p, 3) for sub_m in matrix for p in sub_m]
-            temp.append(flatten)
-
-        formatted = {
-            "raw_file": kps,
-            "bezier_control_points": temp
-        }
-        all_lanes_kps.append(json.dumps(formatted))
+    if args.workers <= 1 or len(shards) <= 1:
+        for shard in tqdm(shards):
+            all_lanes_kps += fit_shard(shard, order, lane_interpolate)
+    else:
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            for results in tqdm(executor.map(fit_shard, shards, [order] * len(shards),
+                                             [lane_interpolate] * len(shards)), total=len(shards)):
+                all_lanes_kps += results
 
     dir_name = os.path.join(root, 'bezier_labels')
     if not os.path.exists(dir_name):
@@ -48,3 +65,5 @@ if __name__ == '__main__':
     with open(save_path, 'w') as f:
         for lane in all_lanes_kps:
             print(lane, end="\n", file=f)
+    if args.packed:
+        build_bezier_store(save_path)
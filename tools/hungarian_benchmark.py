@@ -0,0 +1,56 @@
+# Latency of Hungarian matching backends (scipy/torch), w.r.t. batch size & number of queries
+import argparse
+import time
+import torch
+
+from importmagician import import_from
+with import_from('./'):
+    from utils.losses._assignment import batched_linear_sum_assignment
+
+
+def random_inputs(batch_size, num_queries, max_targets, device):
+    sizes = torch.randint(0, max_targets + 1, (batch_size,)).tolist()
+    C = torch.rand(batch_size, num_queries, sum(sizes), device=device)
+
+    return C, sizes
+
+
+def total_costs(C, sizes, indices):
+    return torch.tensor([c[i][src.cpu(), tgt.cpu()].double().sum()
+                         for i, (c, (src, tgt)) in enumerate(zip(C.cpu().split(sizes, -1), indices))])
+
+
+def timeit(solver, C, sizes, device, times):
+    results = []
+    for _ in range(times):
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        t = time.perf_counter()
+        indices = batched_linear_sum_assignment(C, sizes, solver=solver)
+        if device.type == 'cuda':  # Matching results are used on the device
+            torch.cuda.synchronize()
+        results.append(time.perf_counter() - t)
+
+    return min(results) * 1000, indices
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='PytorchAutoDrive Hungarian matching benchmark')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 8, 32, 128])
+    parser.add_argument('--num-queries', type=int, nargs='+', default=[7, 50, 200])
+    parser.add_argument('--max-targets', type=int, default=6, help='Max number of lanes in an image')
+    parser.add_argument('--times', type=int, default=20)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+    device = torch.device(args.device)
+
+    print('{:>6} {:>8} {:>10} {:>10}'.format('batch', 'queries', 'scipy(ms)', 'torch(ms)'))
+    for num_queries in args.num_queries:
+        for batch_size in args.batch_sizes:
+            C, sizes = random_inputs(batch_size, num_queries, min(args.max_targets, num_queries), device)
+            t_scipy, indices_scipy = timeit('scipy', C, sizes, device, args.times)
+            t_torch, indices_torch = timeit('torch', C, sizes, device, args.times)
+            # Assignments can differ on ties, but the optimal costs should be the same
+            assert torch.allclose(total_costs(C, sizes, indices_scipy), total_costs(C, sizes, indices_torch),
+                                  rtol=0, atol=1e-9), 'Costs differ!'
+            print('{:>6} {:>8} {:>10.3f} {:>10.3f}'.format(batch_size, num_queries, t_scipy, t_torch))
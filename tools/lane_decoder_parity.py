@@ -0,0 +1,129 @@
+# Compare segmentation lane decoders (test.seg_decoder) against the naive one, on speed, memory & predictions
+import argparse
+import time
+import torch
+from tqdm import tqdm
+
+from importmagician import import_from
+with import_from('./'):
+    from utils.args import read_config, parse_arg_cfg, cmd_dict, add_shortcuts
+    from utils.models import MODELS
+    from utils.datasets import DATASETS
+    from utils.transforms import TRANSFORMS
+    from utils.common import load_checkpoint
+    from utils.lane_det_utils import lane_as_segmentation_inference
+
+
+def compare_lanes(ref, pred):
+    # Compare lanes of 1 image (same sample rows & existence), -2 or missing points are treated as invalid
+    # Lanes are paired by order, so images with different numbers of lanes are only counted, not compared
+    # Return: number of rows (valid in either), exactly same rows, sum of x error on rows valid in both,
+    #         number of rows valid in both, whether number of lanes differ
+    stats = [0, 0, 0., 0, int(len(ref) != len(pred))]
+    if stats[4] > 0:
+        return stats
+    for lane_ref, lane_pred in zip(ref, pred):
+        xs_ref = {y: x for x, y in lane_ref if x >= 0}
+        xs_pred = {y: x for x, y in lane_pred if x >= 0}
+        for y in set(xs_ref.keys()).union(xs_pred.keys()):
+            stats[0] += 1
+            if y in xs_ref and y in xs_pred:
+                stats[1] += int(xs_ref[y] == xs_pred[y])
+                stats[2] += abs(xs_ref[y] - xs_pred[y])
+                stats[3] += 1
+
+    return stats
+
+
+def timed_decode(net, outputs, cfg, decoder, device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        base_memory = torch.cuda.memory_allocated(device)
+    temp = time.perf_counter()
+    res = lane_as_segmentation_inference(net, {k: v.clone() for k, v in outputs.items()},
+                                         [cfg['input_size'], cfg['original_size']], cfg['gap'], cfg['ppl'],
+                                         cfg['thresh'], cfg['dataset_name'], cfg['max_lane'], forward=False,
+                                         decoder=decoder)
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+        peak_memory = torch.cuda.max_memory_allocated(device) - base_memory
+    else:
+        peak_memory = 0
+
+    return res, time.perf_counter() - temp, peak_memory
+
+
+if __name__ == '__main__':
+    # Settings
+    parser = argparse.ArgumentParser(description='PytorchAutoDrive Lane Decoder Parity', conflict_handler='resolve')
+    add_shortcuts(parser)
+
+    parser.add_argument('--config', type=str, help='Path to config file', required=True)
+
+    # Optional args/to overwrite configs
+    parser.add_argument('--decoders', type=str, default='tensor,sparse',
+                        help='Decoders to compare with naive, separated by comma (default: tensor,sparse)')
+    parser.add_argument('--image-set', type=str, default='val',
+                        help='Image set to compare on (default: val)')
+    parser.add_argument('--num-batches', type=int, default=0,
+                        help='Number of batches to compare, 0 for all (default: 0)')
+    parser.add_argument('--cfg-options', type=cmd_dict,
+                        help='Override config options with \"x1=y1 x2=y2 xn=yn\"')
+    parser.add_argument('--checkpoint', type=str,
+                        help='Load from a previous checkpoint')
+
+    args = parser.parse_args()
+
+    # Parse configs and build model
+    cfg = read_config(args.config)
+    args, cfg = parse_arg_cfg(args, cfg)
+    test_cfg = cfg['test']
+    assert test_cfg['seg'], 'Only segmentation based methods have these decoders!'
+    net = MODELS.from_dict(cfg['model'])
+    device = torch.device('cpu')
+    if torch.cuda.is_available():
+        device = torch.device('cuda:0')
+    print(device)
+    net.to(device)
+    if test_cfg['checkpoint'] is not None:
+        load_checkpoint(net=net, optimizer=None, lr_scheduler=None, filename=test_cfg['checkpoint'])
+    net.eval()
+
+    dataset = DATASETS.from_dict(cfg['test_dataset'] if 'test_dataset' in cfg.keys() else cfg['dataset'],
+                                 image_set=args.image_set,
+                                 transforms=TRANSFORMS.from_dict(cfg['test_augmentation']))
+    loader = torch.utils.data.DataLoader(dataset=dataset, batch_size=test_cfg['batch_size'],
+                                         num_workers=test_cfg['workers'], shuffle=False)
+
+    decoders = ['naive'] + args.decoders.split(',')
+    times = {k: 0. for k in decoders}
+    memory = {k: 0 for k in decoders}
+    stats = {k: [0, 0, 0., 0, 0] for k in decoders[1:]}
+    num_images = 0
+    num_batches = 0
+    with torch.no_grad():
+        for i, (images, _) in enumerate(tqdm(loader)):
+            if 0 < args.num_batches <= i:
+                break
+            outputs = net(images.to(device))
+            outputs = {'out': outputs['out'], 'lane': outputs['lane']}
+            results = {}
+            for decoder in decoders:
+                results[decoder], t, m = timed_decode(net, outputs, test_cfg, decoder, device)
+                times[decoder] += t
+                memory[decoder] = max(memory[decoder], m)
+            for decoder in decoders[1:]:
+                for ref, pred in zip(results['naive'], results[decoder]):
+                    stats[decoder] = [a + b for a, b in zip(stats[decoder], compare_lanes(ref, pred))]
+            num_images += images.shape[0]
+            num_batches += 1
+
+    for decoder in decoders:
+        print('{}: {: .2f} ms/batch, peak memory {: .2f} MB'.format(
+            decoder, times[decoder] / max(1, num_batches) * 1000, memory[decoder] / 2 ** 20))
+        if decoder in stats.keys():
+            s = stats[decoder]
+            print('    same points: {: .4f}, mean x error: {: .3f} px (on images with the same lane number), '
+                  'images with different lane numbers (skipped): {}/{}'.format(s[1] / max(1, s[0]), s[2] / max(1, s[3]),
+                                                                     s[4], num_images))
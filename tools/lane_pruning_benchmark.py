@@ -0,0 +1,70 @@
+# Latency of lane_pruning() vs the previous iterative version, w.r.t. batch size & number of queries (lanes)
+import argparse
+import time
+import torch
+
+from importmagician import import_from
+with import_from('./'):
+    from utils.models.lane_detection.utils import lane_pruning
+
+
+def lane_pruning_iterative(existence, existence_conf, max_lane):
+    # The previous implementation, 1 min-removal (w. a host sync) per iteration
+    while (existence.sum(dim=1) > max_lane).sum() > 0:
+        indices = (existence.sum(dim=1, keepdim=True) > max_lane).expand_as(existence) * \
+                  (existence_conf == existence_conf.min(dim=1, keepdim=True).values)
+        existence[indices] = 0
+        existence_conf[indices] = 1.1  # So we can keep using min
+
+    return existence, existence_conf
+
+
+def random_inputs(batch_size, num_queries, device, levels=0):
+    # levels > 0 quantizes confidences to create ties
+    existence_conf = torch.rand(batch_size, num_queries, device=device)
+    if levels > 0:
+        existence_conf = (existence_conf * levels).floor() / levels
+    existence = (existence_conf > 0.3) * (torch.rand(batch_size, num_queries, device=device) > 0.2)
+
+    return existence, existence_conf
+
+
+def timeit(func, existence, existence_conf, max_lane, device, times):
+    results = []
+    for _ in range(times):
+        x, y = existence.clone(), existence_conf.clone()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        t = time.perf_counter()
+        func(x, y, max_lane)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        results.append(time.perf_counter() - t)
+
+    return min(results) * 1000
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='PytorchAutoDrive lane_pruning benchmark')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 8, 32, 128])
+    parser.add_argument('--num-queries', type=int, nargs='+', default=[7, 50, 200])
+    parser.add_argument('--max-lane', type=int, default=4)
+    parser.add_argument('--times', type=int, default=50)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+    device = torch.device(args.device)
+
+    print('{:>6} {:>8} {:>14} {:>12}'.format('batch', 'queries', 'iterative(ms)', 'sorted(ms)'))
+    for num_queries in args.num_queries:
+        for batch_size in args.batch_sizes:
+            # Check identical results, w./w.o. ties
+            for levels in [0, 10]:
+                existence, existence_conf = random_inputs(batch_size, num_queries, device, levels)
+                ref = lane_pruning_iterative(existence.clone(), existence_conf.clone(), args.max_lane)
+                res = lane_pruning(existence.clone(), existence_conf.clone(), args.max_lane)
+                assert torch.equal(ref[0], res[0]) and torch.equal(ref[1], res[1]), 'Results differ!'
+            existence, existence_conf = random_inputs(batch_size, num_queries, device)
+            print('{:>6} {:>8} {:>14.3f} {:>12.3f}'.format(
+                batch_size, num_queries,
+                timeit(lane_pruning_iterative, existence, existence_conf, args.max_lane, device, args.times),
+                timeit(lane_pruning, existence, existence_conf, args.max_lane, device, args.times)))
@@ -22,15 +22,20 @@ import cv2
 import fcntl
 import ujson as json
 import numpy as np
-from p_tqdm import t_map, p_map
+from tqdm import tqdm
 from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 from scipy.interpolate import splprep, splev
 from scipy.optimize import linear_sum_assignment
 from shapely.geometry import LineString, Polygon
 from llamas_official_scripts import get_files_from_folder, get_horizontal_values_for_four_lanes, get_label_base
+from importmagician import import_from
+with import_from('../../'):
+    from tools.culane_evaluation_py.lane_store import split_packed_path, open_packed_lanes, save_packed_lanes
 
 
 LLAMAS_IMG_RES = [717, 1276]
+GT_CACHE_VERSION = 2
 IMAGE_HEIGHT, IMAGE_WIDTH = LLAMAS_IMG_RES[0], LLAMAS_IMG_RES[1]
 
 
@@ -55,10 +60,28 @@ def draw_lane(lane, img=None, img_shape=None, width=30):
     return img
 
 
-def discrete_cross_iou(xs, ys, width=30, img_shape=LLAMAS_IMG_RES):
+def crop_mask(mask):
+    """Crop a binary mask to its bounding box, returns (y0, x0, cropped mask)"""
+    rows = np.nonzero(mask.any(axis=1))[0]
+    cols = np.nonzero(mask.any(axis=0))[0]
+    if len(rows) == 0:
+        return 0, 0, mask[:0, :0]
+    return rows[0], cols[0], mask[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+
+
+def discrete_cross_iou(xs, ys, width=30, img_shape=LLAMAS_IMG_RES, ys_masks=None):
     """For each lane in xs, compute its Intersection Over Union (IoU) with each lane in ys by drawing the lanes on
-    an image"""
+    an image, ys_masks: optional pre-drawn masks of ys, cropped as in crop_mask()"""
     xs = [draw_lane(lane, img_shape=img_shape, width=width) > 0 for lane in xs]
+    if ys_masks is not None:
+        # Same results as the full res masks, with only the cropped region of ys
+        xs = np.stack(xs)
+        areas = xs.reshape(len(xs), -1).sum(axis=1)
+        ious = np.zeros((len(xs), len(ys_masks)))
+        for j, (y0, x0, y) in enumerate(ys_masks):
+            inter = (xs[:, y0:y0 + y.shape[0], x0:x0 + y.shape[1]] & y[None]).reshape(len(xs), -1).sum(axis=1)
+            ious[:, j] = inter / (areas + y.sum() - inter)
+        return ious
     ys = [draw_lane(lane, img_shape=img_shape, width=width) > 0 for lane in ys]
 
     ious = np.zeros((len(xs), len(ys)))
@@ -110,8 +133,9 @@ def interpolate_lane(points, n=50):
     return np.array(splev(u, tck)).T
 
 
-def culane_metric(pred, anno, width=30, iou_threshold=0.5, unofficial=False, img_shape=LLAMAS_IMG_RES):
-    """Computes CULane's metric for a single image"""
+def culane_metric(pred, anno, width=30, iou_threshold=0.5, unofficial=False, img_shape=LLAMAS_IMG_RES,
+                  anno_masks=None):
+    """Computes CULane's metric for a single image, anno_masks: optional pre-drawn annotation masks"""
     if len(pred) == 0:
         return 0, 0, len(anno)
     if len(anno) == 0:
@@ -122,7 +146,7 @@ def culane_metric(pred, anno, width=30, iou_threshold=0.5, unofficial=False, img
     if unofficial:
         ious = continuous_cross_iou(interp_pred, anno, width=width)
     else:
-        ious = discrete_cross_iou(interp_pred, anno, width=width, img_shape=img_shape)
+        ious = discrete_cross_iou(interp_pred, anno, width=width, img_shape=img_shape, ys_masks=anno_masks)
 
     row_ind, col_ind = linear_sum_assignment(1 - ious)
     tp = int((ious[row_ind, col_ind] > iou_threshold).sum())
@@ -132,9 +156,13 @@ def culane_metric(pred, anno, width=30, iou_threshold=0.5, unofficial=False, img
 
 
 def load_prediction(path):
-    """Loads an image's predictions
+    """Loads an image's predictions (from a .lines.txt file or a packed .lanes.npz store)
     Returns a list of lanes, where each lane is a list of points (x,y)
     """
+    packed = split_packed_path(path)
+    if packed is not None:
+        img_data = [[(x, y) for x, y in lane.tolist()] for lane in open_packed_lanes(packed[0])[packed[1]]]
+        return [lane for lane in img_data if len(lane) >= 2]
     with open(path, 'r') as data_file:
         img_data = data_file.readlines()
     img_data = [line.split() for line in img_data]
@@ -149,35 +177,160 @@ def load_prediction_list(label_paths, pred_dir):
     return [load_prediction(os.path.join(pred_dir, path.replace('.json', '.lines.txt'))) for path in label_paths]
 
 
-def load_labels(label_dir):
+def load_label(label_path):
+    """Loads an annotation as a list of lanes, each lane is a list of points (x, y)"""
+    return [add_ys(xs) for xs in get_horizontal_values_for_four_lanes(label_path) if
+            (np.array(xs) >= 0).sum() > 1]  # lanes annotated with a single point are ignored
+
+
+def rasterize_label(label_path, width=30, img_shape=LLAMAS_IMG_RES):
+    """Loads an annotation and draws its lanes, returns the lanes and cropped masks (see crop_mask())"""
+    anno = load_label(label_path)
+
+    return anno, [crop_mask(draw_lane(np.array(lane), img_shape=img_shape, width=width) > 0) for lane in anno]
+
+
+def map_in_pool(fn, *iterables, sequential=False, workers=None, chunksize=16):
+    total = len(iterables[0])
+    if sequential:
+        return list(tqdm(map(fn, *iterables), total=total))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(tqdm(executor.map(fn, *iterables, chunksize=chunksize), total=total))
+
+
+def load_labels(label_dir, sequential=False, workers=None):
     """Loads the annotations and its paths
     Each annotation is converted to a list of points (x, y)
     """
     label_paths = get_files_from_folder(label_dir, '.json')
-    annos = [[add_ys(xs) for xs in get_horizontal_values_for_four_lanes(label_path) if
-              (np.array(xs) >= 0).sum() > 1]  # lanes annotated with a single point are ignored
-             for label_path in label_paths]
+    annos = map_in_pool(load_label, label_paths, sequential=sequential, workers=workers)
     label_paths = [
         get_label_base(p) for p in label_paths
     ]
     return np.array(annos, dtype=object), np.array(label_paths, dtype=object)
 
 
-def eval_predictions(pred_dir, anno_dir, width=30, unofficial=True, sequential=False):
-    """Evaluates the predictions in pred_dir and returns CULane's metrics (precision, recall, F1 and its components)"""
-    print(f'Loading annotation data ({anno_dir})...')
-    annotations, label_paths = load_labels(anno_dir)
+def label_file_stats(label_paths):
+    """Returns [mtime_ns, size] of each label file, to check whether the cache is outdated"""
+    file_stats = np.zeros((len(label_paths), 2), dtype=np.int64)
+    for i, p in enumerate(label_paths):
+        stat = os.stat(p)
+        file_stats[i] = [stat.st_mtime_ns, stat.st_size]
+
+    return file_stats
+
+
+def build_gt_cache(label_dir, cache_file, masks=False, width=30, sequential=False, workers=None):
+    """Interpolates (and optionally draws) all annotations once, saves them to a packed store keyed by label path
+    Masks are cropped to their bounding boxes and bit-packed by rows
+    """
+    label_paths = get_files_from_folder(label_dir, '.json')
+    keys = [get_label_base(p) for p in label_paths]
+    file_stats = label_file_stats(label_paths)
+    if masks:
+        results = map_in_pool(partial(rasterize_label, width=width), label_paths, sequential=sequential,
+                              workers=workers)
+        annos = [anno for anno, _ in results]
+        lane_masks = [m for _, anno_masks in results for m in anno_masks]
+    else:
+        annos = map_in_pool(load_label, label_paths, sequential=sequential, workers=workers)
+        lane_masks = []
+    mask_bytes = [np.packbits(m, axis=1).reshape(-1) for _, _, m in lane_masks]
+    extra_arrays = {
+        'gt_version': np.array(GT_CACHE_VERSION),
+        'label_dir': np.array(os.path.abspath(label_dir)),
+        'file_stats': file_stats,
+        'mask_width': np.array(width if masks else -1),
+        'mask_boxes': np.array([[y0, x0, m.shape[0], m.shape[1]] for y0, x0, m in lane_masks],
+                               dtype=np.int64).reshape(-1, 4),
+        'mask_offsets': np.cumsum([0] + [len(m) for m in mask_bytes], dtype=np.int64),
+        'mask_bytes': np.concatenate(mask_bytes) if len(mask_bytes) > 0 else np.zeros(0, dtype=np.uint8)
+    }
+    dir_name = os.path.dirname(cache_file)
+    if dir_name != '':
+        os.makedirs(dir_name, exist_ok=True)
+    # Keep float64 points, so cached lanes are exactly the same as re-interpolated ones
+    save_packed_lanes(cache_file, keys, annos, dtype=np.float64, **extra_arrays)
+
+    return keys
+
+
+def load_gt_cache(label_dir, cache_file, masks=False, width=30, sequential=False, workers=None):
+    """Returns label paths (keys of the cache), (re-)builds the cache if it does not match label_dir or the settings
+    The cache is also rebuilt when any label file is added, removed or modified (by mtime & size)
+    """
+    label_paths = get_files_from_folder(label_dir, '.json')
+    keys = [get_label_base(p) for p in label_paths]
+    if os.path.exists(cache_file):
+        try:
+            store = open_packed_lanes(cache_file)
+            valid = int(store.arrays['gt_version']) == GT_CACHE_VERSION and \
+                (not masks or int(store.arrays['mask_width']) == width) and \
+                str(store.arrays['label_dir']) == os.path.abspath(label_dir) and \
+                len(store) == len(keys) and all([k in store for k in keys])
+            if valid:
+                # Stats are stored in the order of the cache keys
+                cached_stats = np.asarray(store.arrays['file_stats'])
+                file_stats = label_file_stats(label_paths)
+                order = [store.index[os.path.normpath(k)] for k in keys]
+                valid = cached_stats.shape == (len(keys), 2) and (cached_stats[order] == file_stats).all()
+        except (KeyError, ValueError, OSError):
+            valid = False
+        if valid:
+            print('Using annotation cache {}'.format(cache_file))
+            return keys
+    print('Building annotation cache {}...'.format(cache_file))
+
+    return build_gt_cache(label_dir, cache_file, masks=masks, width=width, sequential=sequential, workers=workers)
+
+
+def load_cached_label(cache_file, key, masks=False):
+    """Loads an annotation (and its cropped masks) from a cache built by build_gt_cache()"""
+    store = open_packed_lanes(cache_file)
+    anno = [np.array(lane) for lane in store[key]]
+    if not masks:
+        return anno, None
+    start, end = store.lane_range(key)
+    anno_masks = []
+    for i in range(start, end):
+        y0, x0, h, w = store.arrays['mask_boxes'][i].tolist()
+        if h == 0:
+            anno_masks.append((0, 0, np.zeros((0, 0), dtype=bool)))
+            continue
+        offsets = store.arrays['mask_offsets'][i:i + 2].tolist()
+        bits = np.asarray(store.arrays['mask_bytes'][offsets[0]:offsets[1]])
+        anno_masks.append((y0, x0, np.unpackbits(bits.reshape(h, -1), axis=1, count=w).astype(bool)))
+
+    return anno, anno_masks
+
+
+def culane_metric_cached(pred, key, cache_file, masks=False, **kwargs):
+    anno, anno_masks = load_cached_label(cache_file, key, masks=masks)
+
+    return culane_metric(pred, anno, anno_masks=anno_masks, **kwargs)
+
+
+def eval_predictions(pred_dir, anno_dir, width=30, unofficial=True, sequential=False, gt_cache=None, gt_masks=False,
+                     workers=None):
+    """Evaluates the predictions in pred_dir and returns CULane's metrics (precision, recall, F1 and its components)
+    gt_cache: path to the annotation cache (None to re-interpolate annotations), gt_masks: also cache rasterized masks
+    """
+    if gt_cache is None:
+        print(f'Loading annotation data ({anno_dir})...')
+        annotations, label_paths = load_labels(anno_dir, sequential=sequential, workers=workers)
+    else:
+        label_paths = load_gt_cache(anno_dir, gt_cache, masks=gt_masks and not unofficial, width=width,
+                                    sequential=sequential, workers=workers)
     print(f'Loading prediction data ({pred_dir})...')
     predictions = load_prediction_list(label_paths, pred_dir)
     print('Calculating metric {}...'.format('sequentially' if sequential else 'in parallel'))
-    if sequential:
-        results = t_map(partial(culane_metric, width=width, unofficial=unofficial, img_shape=LLAMAS_IMG_RES),
-                        predictions,
-                        annotations)
+    if gt_cache is None:
+        results = map_in_pool(partial(culane_metric, width=width, unofficial=unofficial, img_shape=LLAMAS_IMG_RES),
+                              predictions, annotations, sequential=sequential, workers=workers)
     else:
-        results = p_map(partial(culane_metric, width=width, unofficial=unofficial, img_shape=LLAMAS_IMG_RES),
-                        predictions,
-                        annotations)
+        results = map_in_pool(partial(culane_metric_cached, cache_file=gt_cache, masks=gt_masks and not unofficial,
+                                      width=width, unofficial=unofficial, img_shape=LLAMAS_IMG_RES),
+                              predictions, label_paths, sequential=sequential, workers=workers)
     total_tp = sum(tp for tp, _, _ in results)
     total_fp = sum(fp for _, fp, _ in results)
     total_fn = sum(fn for _, _, fn in results)
@@ -195,24 +348,38 @@ def eval_predictions(pred_dir, anno_dir, width=30, unofficial=True, sequential=F
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Measure CULane's metric on the LLAMAS dataset")
-    parser.add_argument("--pred_dir", help="Path to directory containing the predicted lanes", required=True)
+    parser.add_argument("--pred_dir", help="Path to directory containing the predicted lanes, "
+                                           "could be inside a packed store, e.g. ../../output/exp.lanes.npz/valid",
+                        required=True)
     parser.add_argument("--anno_dir", help="Path to directory containing the annotated lanes", required=True)
     parser.add_argument('--exp_name', type=str, default='', help='Name of experiment')
     parser.add_argument('--save-dir', type=str, help='Path prefix to save full res.')
     parser.add_argument("--width", type=int, default=30, help="Width of the lane")
     parser.add_argument("--sequential", action='store_true', help="Run sequentially instead of in parallel")
     parser.add_argument("--unofficial", action='store_true', help="Use a faster but unofficial algorithm")
+    parser.add_argument("--workers", type=int, default=None, help="Number of processes (default: number of CPUs)")
+    parser.add_argument("--gt_cache", type=str, default=None,
+                        help="Path to the annotation cache, built at the first run "
+                             "(default: ./output/<anno_dir name>_gt_cache.npz)")
+    parser.add_argument("--no_gt_cache", action='store_true', help="Re-interpolate annotations instead of caching")
+    parser.add_argument("--gt_masks", action='store_true', help="Also cache rasterized annotation masks")
 
     return parser.parse_args()
 
 
 def main():
     args = parse_args()
+    gt_cache = args.gt_cache
+    if gt_cache is None and not args.no_gt_cache:
+        gt_cache = os.path.join('./output', os.path.basename(os.path.normpath(args.anno_dir)) + '_gt_cache.npz')
     results = eval_predictions(args.pred_dir,
                                args.anno_dir,
                                width=args.width,
                                unofficial=args.unofficial,
-                               sequential=args.sequential)
+                               sequential=args.sequential,
+                               gt_cache=None if args.no_gt_cache else gt_cache,
+                               gt_masks=args.gt_masks,
+                               workers=args.workers)
 
     header = '=' * 20 + ' Results' + '=' * 20
     print(header)
@@ -1,6 +1,7 @@
+import os
 import fcntl
 import numpy as np
-from sklearn.linear_model import LinearRegression
+from concurrent.futures import ProcessPoolExecutor
 try:
     import ujson as json
 except ImportError:
@@ -8,26 +9,70 @@ except ImportError:
 
 
 class LaneEval(object):
-    lr = LinearRegression()
     pixel_thresh = 20
     pt_thresh = 0.85
+    _gt_cache = {}
+
+    @staticmethod
+    def get_angles(gt, y_samples):
+        # Closed-form least squares of x = k * y + b for all lanes at once (same as a LinearRegression per lane)
+        xs = np.asarray(gt, dtype=np.float64).reshape(len(gt), len(y_samples))
+        ys = np.broadcast_to(np.asarray(y_samples, dtype=np.float64)[None, :], xs.shape)
+        valid = xs >= 0
+        counts = valid.sum(axis=1)
+        mean_xs = np.where(valid, xs, 0.).sum(axis=1) / np.maximum(counts, 1)
+        mean_ys = np.where(valid, ys, 0.).sum(axis=1) / np.maximum(counts, 1)
+        dxs = np.where(valid, xs - mean_xs[:, None], 0.)
+        dys = np.where(valid, ys - mean_ys[:, None], 0.)
+        var = (dys ** 2).sum(axis=1)
+        k = np.where((counts > 1) & (var > 0), (dxs * dys).sum(axis=1) / np.where(var > 0, var, 1.), 0.)
+
+        return np.arctan(k)
 
     @staticmethod
     def get_angle(xs, y_samples):
-        xs, ys = xs[xs >= 0], y_samples[xs >= 0]
-        if len(xs) > 1:
-            LaneEval.lr.fit(ys[:, None], xs)
-            k = LaneEval.lr.coef_[0]
-            theta = np.arctan(k)
-        else:
-            theta = 0
-        return theta
+        return LaneEval.get_angles(np.asarray(xs)[None, :], y_samples)[0]
+
+    @staticmethod
+    def line_accuracies(pred, gt, threshs):
+        # pred x gt accuracy matrix, threshs for each gt lane
+        # pred: P x N, gt: G x N
+        pred = np.where(pred >= 0, pred, -100.)
+        gt = np.where(gt >= 0, gt, -100.)
+        hits = np.abs(pred[:, None, :] - gt[None, :, :]) < np.asarray(threshs)[None, :, None]
+
+        return hits.sum(axis=-1) / gt.shape[-1]
 
     @staticmethod
     def line_accuracy(pred, gt, thresh):
-        pred = np.array([p if p >= 0 else -100 for p in pred])
-        gt = np.array([g if g >= 0 else -100 for g in gt])
-        return np.sum(np.where(np.abs(pred - gt) < thresh, 1., 0.)) / len(gt)
+        return LaneEval.line_accuracies(np.asarray(pred, dtype=np.float64)[None, :],
+                                        np.asarray(gt, dtype=np.float64)[None, :], [thresh])[0, 0]
+
+    @staticmethod
+    def _match(pred, gt, y_samples):
+        # Return: pred x gt accuracy matrix, best accuracy of each gt lane
+        pred = np.asarray(pred, dtype=np.float64).reshape(len(pred), len(y_samples))
+        gt = np.asarray(gt, dtype=np.float64).reshape(len(gt), len(y_samples))
+        angles = LaneEval.get_angles(gt, y_samples)
+        threshs = LaneEval.pixel_thresh / np.cos(angles)
+        accs = LaneEval.line_accuracies(pred, gt, threshs)
+        line_accs = accs.max(axis=0) if len(pred) > 0 else np.zeros(len(gt))
+
+        return accs, line_accs
+
+    @staticmethod
+    def _summarize(line_accs, num_pred):
+        matched = float((line_accs >= LaneEval.pt_thresh).sum())
+        fn = len(line_accs) - matched
+        fp = num_pred - matched
+        if len(line_accs) > 4 and fn > 0:
+            fn -= 1
+        line_accs = line_accs.tolist()
+        s = sum(line_accs)
+        if len(line_accs) > 4:
+            s -= min(line_accs)
+        return s / max(min(4.0, len(line_accs)), 1.), fp / num_pred if num_pred > 0 else 0., \
+            fn / max(min(len(line_accs), 4.), 1.)
 
     @staticmethod
     def bench(pred, gt, y_samples, running_time):
@@ -35,53 +80,54 @@ class LaneEval(object):
             raise Exception('Format of lanes error.')
         if running_time > 200 or len(gt) + 2 < len(pred):
             return 0., 0., 1.
-        angles = [LaneEval.get_angle(np.array(x_gts), np.array(y_samples)) for x_gts in gt]
-        threshs = [LaneEval.pixel_thresh / np.cos(angle) for angle in angles]
-        line_accs = []
-        fp, fn = 0., 0.
-        matched = 0.
-        for x_gts, thresh in zip(gt, threshs):
-            accs = [LaneEval.line_accuracy(np.array(x_preds), np.array(x_gts), thresh) for x_preds in pred]
-            max_acc = np.max(accs) if len(accs) > 0 else 0.
-            if max_acc < LaneEval.pt_thresh:
-                fn += 1
-            else:
-                matched += 1
-            line_accs.append(max_acc)
-        fp = len(pred) - matched
-        if len(gt) > 4 and fn > 0:
-            fn -= 1
-        s = sum(line_accs)
-        if len(gt) > 4:
-            s -= min(line_accs)
-        return s / max(min(4.0, len(gt)), 1.), fp / len(pred) if len(pred) > 0 else 0., fn / max(min(len(gt), 4.) , 1.)
+        _, line_accs = LaneEval._match(pred, gt, y_samples)
+
+        return LaneEval._summarize(line_accs, len(pred))
+
+    @staticmethod
+    def _bench_shard(samples):
+        # samples: list of (pred lanes, gt lanes, y_samples, run_time)
+        try:
+            return [LaneEval.bench(*sample) for sample in samples]
+        except BaseException as e:
+            raise Exception('Format of lanes error.')
+
+    @staticmethod
+    def load_gt(gt_file):
+        # Cached per process by path and modification time, for evaluating many predictions on the same set
+        key = (os.path.abspath(gt_file), os.path.getmtime(gt_file))
+        if key not in LaneEval._gt_cache:
+            json_gt = [json.loads(line) for line in open(gt_file).readlines()]
+            LaneEval._gt_cache[key] = {l['raw_file']: l for l in json_gt}, len(json_gt)
+        return LaneEval._gt_cache[key]
 
     @staticmethod
-    def bench_one_submit(pred_file, gt_file):
+    def bench_one_submit(pred_file, gt_file, workers=0, shard_size=256):
+        # workers > 0: evaluate shards of images in that many processes, results are summed in the same order
         try:
             json_pred = [json.loads(line) for line in open(pred_file).readlines()]
         except BaseException as e:
             raise Exception('Fail to load json file of the prediction.')
-        json_gt = [json.loads(line) for line in open(gt_file).readlines()]
-        if len(json_gt) != len(json_pred):
+        gts, num_gt = LaneEval.load_gt(gt_file)
+        if num_gt != len(json_pred):
             raise Exception('We do not get the predictions of all the test tasks')
-        gts = {l['raw_file']: l for l in json_gt}
-        accuracy, fp, fn = 0., 0., 0.
+        samples = []
         for pred in json_pred:
             if 'raw_file' not in pred or 'lanes' not in pred or 'run_time' not in pred:
                 raise Exception('raw_file or lanes or run_time not in some predictions.')
             raw_file = pred['raw_file']
-            pred_lanes = pred['lanes']
-            run_time = pred['run_time']
             if raw_file not in gts:
                 raise Exception('Some raw_file from your predictions do not exist in the test tasks.')
             gt = gts[raw_file]
-            gt_lanes = gt['lanes']
-            y_samples = gt['h_samples']
-            try:
-                a, p, n = LaneEval.bench(pred_lanes, gt_lanes, y_samples, run_time)
-            except BaseException as e:
-                raise Exception('Format of lanes error.')
+            samples.append((pred['lanes'], gt['lanes'], gt['h_samples'], pred['run_time']))
+        shards = [samples[i:i + shard_size] for i in range(0, len(samples), shard_size)]
+        if workers > 0 and len(shards) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(LaneEval._bench_shard, shards))
+        else:
+            results = [LaneEval._bench_shard(shard) for shard in shards]
+        accuracy, fp, fn = 0., 0., 0.
+        for a, p, n in [x for shard in results for x in shard]:
             accuracy += a
             fp += p
             fn += n
@@ -98,42 +144,23 @@ class LaneEval(object):
         # Adapted from lucastabelini/LaneATT, for visualization use only
         if any(len(p) != len(y_samples) for p in pred):
             raise Exception('Format of lanes error.')
-        angles = [LaneEval.get_angle(np.array(x_gts), np.array(y_samples)) for x_gts in gt]
-        threshs = [LaneEval.pixel_thresh / np.cos(angle) for angle in angles]
-        line_accs = []
-        fp, fn = 0., 0.
-        matched = 0.
+        accs, line_accs = LaneEval._match(pred, gt, y_samples)
         my_matches = [False] * len(pred)
-        my_accs = [0] * len(pred)
-        for x_gts, thresh in zip(gt, threshs):
-            accs = [LaneEval.line_accuracy(np.array(x_preds), np.array(x_gts), thresh) for x_preds in pred]
-            my_accs = np.maximum(my_accs, accs)
-            max_acc = np.max(accs) if len(accs) > 0 else 0.
-
-            if max_acc < LaneEval.pt_thresh:
-                fn += 1
-            else:
-                my_matches[np.argmax(accs)] = True
-                matched += 1
-            line_accs.append(max_acc)
-        fp = len(pred) - matched
-        if len(gt) > 4 and fn > 0:
-            fn -= 1
-        s = sum(line_accs)
-        if len(gt) > 4:
-            s -= min(line_accs)
-        return s / max(min(4.0, len(gt)), 1.), fp / len(pred) if len(pred) > 0 else 0., fn / max(
-            min(len(gt), 4.), 1.), my_matches, my_accs
+        for j in range(len(gt)):
+            if line_accs[j] >= LaneEval.pt_thresh:
+                my_matches[int(np.argmax(accs[:, j]))] = True
+        my_accs = accs.max(axis=1) if len(gt) > 0 else np.zeros(len(pred))
+
+        return LaneEval._summarize(line_accs, len(pred)) + (my_matches, my_accs)
 
 
 if __name__ == '__main__':
     # args: pred filename, gt filename, experiment name, save dir
     import sys
-    import os
     try:
         if len(sys.argv) < 4:
             raise Exception('Invalid input arguments')
-        results = LaneEval.bench_one_submit(sys.argv[1], sys.argv[2])
+        results = LaneEval.bench_one_submit(sys.argv[1], sys.argv[2], workers=os.cpu_count())
         print(results)
         acc = json.loads(results)[0]['value']
         with open('../../log.txt', 'a') as f:
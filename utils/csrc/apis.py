@@ -1,17 +1,61 @@
 import os
+import torch
 from torch.utils.cpp_extension import load
 
 csrc_path = 'utils/csrc'
 
-line_nms_ = load(name='line_nms',
-                 sources=[os.path.join(csrc_path, 'line_nms', 'line_nms.cpp'),
-                          os.path.join(csrc_path, 'line_nms', 'line_nms_kernel.cu')],
-                 verbose=False)
+line_nms_cpu_error = None
+try:
+    line_nms_cpu_ = load(name='line_nms_cpu',
+                         sources=[os.path.join(csrc_path, 'line_nms', 'line_nms_cpu.cpp')],
+                         verbose=False)
+except Exception as e:  # No C++ compiler
+    line_nms_cpu_ = None
+    line_nms_cpu_error = e
+line_nms_error = None
+try:
+    line_nms_ = load(name='line_nms',
+                     sources=[os.path.join(csrc_path, 'line_nms', 'line_nms.cpp'),
+                              os.path.join(csrc_path, 'line_nms', 'line_nms_kernel.cu')],
+                     verbose=False)
+except Exception as e:  # CPU-only environments
+    line_nms_ = None
+    line_nms_error = e
 
 
-# Wrap it to be like a normal Python func
-# TODO: cpu version
+# Wrap it to be like a normal Python func, dispatched by device
 def line_nms(boxes, scores, overlap, top_k):
     # Notes: removed the extra 5 (start, end, len, valid (2)) in original LaneATT
+    if boxes.device.type == 'cpu':
+        if line_nms_cpu_ is None:
+            raise RuntimeError('CPU line nms is not compiled: {}'.format(line_nms_cpu_error))
+        return line_nms_cpu_.forward(boxes.contiguous(), scores.contiguous(), overlap, top_k)
+    if line_nms_ is None:
+        raise RuntimeError('CUDA line nms is not compiled: {}'.format(line_nms_error))
 
     return line_nms_.forward(boxes.contiguous(), scores.contiguous(), overlap, top_k)
+
+
+def line_nms_batched(boxes, scores, counts, overlap, top_k):
+    # Line nms of multiple images in 1 call
+    # boxes: N x 74, scores: N, boxes of all images concatenated in order, counts: number of boxes of each image
+    # Return: keep (kept boxes of image i are keep[offsets[i]:offsets[i] + num_to_keep[i]]), num_to_keep (B),
+    #         parent_object_index (N), offsets (B + 1, CPU)
+    offsets = torch.tensor([0] + list(counts), dtype=torch.int64).cumsum(0)
+    batch_inds = torch.repeat_interleave(torch.arange(len(counts), device=boxes.device),
+                                         torch.as_tensor(counts, device=boxes.device))
+    # Sort by scores in each image
+    idx = torch.sort(scores, dim=0, descending=True, stable=True)[1]
+    idx = idx[torch.sort(batch_inds[idx], stable=True)[1]]
+    if boxes.device.type == 'cpu':
+        if line_nms_cpu_ is None:
+            raise RuntimeError('CPU line nms is not compiled: {}'.format(line_nms_cpu_error))
+        keep, num_to_keep, parent_object_index = line_nms_cpu_.forward_batched(
+            boxes.contiguous(), idx.contiguous(), offsets, overlap, top_k)
+    else:
+        if line_nms_ is None:
+            raise RuntimeError('CUDA line nms is not compiled: {}'.format(line_nms_error))
+        keep, num_to_keep, parent_object_index = line_nms_.forward_batched(
+            boxes.contiguous(), idx.contiguous(), offsets, overlap, top_k)
+
+    return keep, num_to_keep, parent_object_index, offsets
@@ -8,6 +8,13 @@ std::vector<at::Tensor> nms_cuda_forward(
         float nms_overlap_thresh,
         unsigned long top_k);
 
+std::vector<at::Tensor> nms_cuda_forward_batched(
+        at::Tensor boxes,
+        at::Tensor idx,
+        at::Tensor offsets,
+        float nms_overlap_thresh,
+        unsigned long top_k);
+
 #define CHECK_CUDA(x) AT_ASSERTM(x.type().is_cuda(), #x " must be a CUDA tensor")
 #define CHECK_CONTIGUOUS(x) AT_ASSERTM(x.is_contiguous(), #x " must be contiguous")
 #define CHECK_INPUT(x) CHECK_CUDA(x); CHECK_CONTIGUOUS(x)
@@ -27,6 +34,21 @@ std::vector<at::Tensor> nms_forward(
     return nms_cuda_forward(boxes, idx, thresh, top_k);
 }
 
+// idx: sorted indices (by score) of each image, boxes of image b are [offsets[b], offsets[b + 1])
+std::vector<at::Tensor> nms_forward_batched(
+        at::Tensor boxes,
+        at::Tensor idx,
+        at::Tensor offsets,
+        float thresh,
+        unsigned long top_k) {
+
+    CHECK_INPUT(boxes);
+    CHECK_INPUT(idx);
+
+    return nms_cuda_forward_batched(boxes, idx, offsets, thresh, top_k);
+}
+
 PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
     m.def("forward", &nms_forward, "NMS forward");
+    m.def("forward_batched", &nms_forward_batched, "Batched NMS forward");
 }
@@ -0,0 +1,148 @@
+#include <torch/extension.h>
+#include <torch/types.h>
+#include <vector>
+
+// CPU version of line_nms_kernel.cu, same semantics (incl. outputs)
+#define N_OFFSETS 72 // if you use more than 72 offsets you will have to adjust this value
+#define N_STRIPS (N_OFFSETS - 1)
+#define PROP_SIZE (N_OFFSETS + 2)  // start, len, 72 offsets
+#define DATASET_OFFSET 0
+
+#define CHECK_CPU(x) AT_ASSERTM(!x.is_cuda(), #x " must be a CPU tensor")
+#define CHECK_CONTIGUOUS(x) AT_ASSERTM(x.is_contiguous(), #x " must be contiguous")
+#define CHECK_INPUT(x) CHECK_CPU(x); CHECK_CONTIGUOUS(x)
+
+// Same as devIoU() in line_nms_kernel.cu
+template <typename scalar_t>
+inline bool cpuIoU(scalar_t const * const a, scalar_t const * const b, const scalar_t threshold) {
+  const int start_a = (int) (a[0] * N_STRIPS - DATASET_OFFSET + 0.5); // 0.5 rounding trick
+  const int start_b = (int) (b[0] * N_STRIPS - DATASET_OFFSET + 0.5);
+  const int start = std::max(start_a, start_b);
+  const int end_a = start_a + a[1] - 1 + 0.5 - ((a[4] - 1) < 0); //  - (x<0) trick to adjust for negative numbers (in case length is 0)
+  const int end_b = start_b + b[1] - 1 + 0.5 - ((b[4] - 1) < 0);
+  const int end = std::min(std::min(end_a, end_b), N_OFFSETS - 1);
+  if (end < start) return false;
+  scalar_t dist = 0;
+  for(unsigned char i = 2 + start; i <= 2 + end; ++i) {
+    if (a[i] < b[i]) {
+      dist += b[i] - a[i];
+    } else {
+      dist += a[i] - b[i];
+    }
+  }
+  return dist < (threshold * (end - start + 1));
+}
+
+// Greedy: only kept boxes are compared to the boxes after them (same results as the full mask of the cuda version)
+// parent_object_index is indexed by idx, so it should be zeroed by the caller
+template <typename scalar_t>
+void nms_cpu_kernel(const int64_t boxes_num, const scalar_t nms_overlap_thresh, const int64_t top_k,
+                    const scalar_t *boxes, const int64_t *idx,
+                    int64_t *keep, int64_t *parent_object_index, int64_t *num_to_keep) {
+  std::vector<bool> removed(boxes_num, false);
+  int64_t num_to_keep_ = 0;
+
+  for (int64_t i = 0; i < boxes_num; i++) {
+    if (removed[i]) continue;
+    const int64_t idxi = idx[i];
+    keep[num_to_keep_] = idxi;
+    const scalar_t *cur_box = boxes + idxi * PROP_SIZE;
+    for (int64_t j = i + 1; j < boxes_num; j++) {
+      if (cpuIoU(cur_box, boxes + idx[j] * PROP_SIZE, nms_overlap_thresh)) {
+        removed[j] = true;
+        parent_object_index[idx[j]] = num_to_keep_ + 1;
+      }
+    }
+    parent_object_index[idxi] = num_to_keep_ + 1;
+
+    num_to_keep_++;
+
+    if (num_to_keep_ == top_k)
+      break;
+  }
+
+  // Initialize the rest of the keep array to avoid uninitialized values.
+  for (int64_t i = num_to_keep_; i < boxes_num; ++i)
+    keep[i] = 0;
+
+  *num_to_keep = std::min(top_k, num_to_keep_);
+}
+
+std::vector<at::Tensor> nms_cpu_forward(
+        at::Tensor boxes,
+        at::Tensor scores,
+        float thresh,
+        unsigned long top_k) {
+
+  auto idx = std::get<1>(scores.sort(0, true)).contiguous();
+
+  CHECK_INPUT(boxes);
+  CHECK_INPUT(idx);
+
+  const auto boxes_num = boxes.size(0);
+  TORCH_CHECK(boxes.size(1) == PROP_SIZE, "Wrong number of offsets. Please adjust `PROP_SIZE`");
+
+  auto longOptions = torch::TensorOptions().device(torch::kCPU).dtype(torch::kLong);
+  auto keep = at::empty({boxes_num}, longOptions);
+  auto parent_object_index = at::zeros({boxes_num}, longOptions);
+  auto num_to_keep = at::empty({}, longOptions);
+
+  AT_DISPATCH_FLOATING_TYPES(boxes.scalar_type(), "nms_cpu_forward", ([&] {
+    nms_cpu_kernel<scalar_t>(boxes_num,
+                             (scalar_t)thresh,
+                             (int64_t)top_k,
+                             boxes.data_ptr<scalar_t>(),
+                             idx.data_ptr<int64_t>(),
+                             keep.data_ptr<int64_t>(),
+                             parent_object_index.data_ptr<int64_t>(),
+                             num_to_keep.data_ptr<int64_t>());
+  }));
+
+  return {keep, num_to_keep, parent_object_index};
+}
+
+// Multiple images at once: boxes of image b are [offsets[b], offsets[b + 1]),
+// idx: sorted indices (by score) of each image, in the same segments
+std::vector<at::Tensor> nms_cpu_forward_batched(
+        at::Tensor boxes,
+        at::Tensor idx,
+        at::Tensor offsets,
+        float thresh,
+        unsigned long top_k) {
+
+  CHECK_INPUT(boxes);
+  CHECK_INPUT(idx);
+  CHECK_INPUT(offsets);
+
+  const auto boxes_num = boxes.size(0);
+  const auto batch_size = offsets.size(0) - 1;
+  TORCH_CHECK(boxes.size(1) == PROP_SIZE, "Wrong number of offsets. Please adjust `PROP_SIZE`");
+
+  auto longOptions = torch::TensorOptions().device(torch::kCPU).dtype(torch::kLong);
+  auto keep = at::empty({boxes_num}, longOptions);
+  auto parent_object_index = at::zeros({boxes_num}, longOptions);
+  auto num_to_keep = at::empty({batch_size}, longOptions);
+  const int64_t *offsets_ = offsets.data_ptr<int64_t>();
+
+  AT_DISPATCH_FLOATING_TYPES(boxes.scalar_type(), "nms_cpu_forward_batched", ([&] {
+    at::parallel_for(0, batch_size, 1, [&](int64_t begin, int64_t end) {
+      for (int64_t b = begin; b < end; ++b) {
+        nms_cpu_kernel<scalar_t>(offsets_[b + 1] - offsets_[b],
+                                 (scalar_t)thresh,
+                                 (int64_t)top_k,
+                                 boxes.data_ptr<scalar_t>(),
+                                 idx.data_ptr<int64_t>() + offsets_[b],
+                                 keep.data_ptr<int64_t>() + offsets_[b],
+                                 parent_object_index.data_ptr<int64_t>(),
+                                 num_to_keep.data_ptr<int64_t>() + b);
+      }
+    });
+  }));
+
+  return {keep, num_to_keep, parent_object_index};
+}
+
+PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
+  m.def("forward", &nms_cpu_forward, "NMS forward (CPU)");
+  m.def("forward_batched", &nms_cpu_forward_batched, "Batched NMS forward (CPU)");
+}
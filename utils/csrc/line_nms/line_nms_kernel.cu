@@ -4,6 +4,7 @@
 #include <cuda.h>
 #include <cuda_runtime.h>
 #include <vector>
+#include <algorithm>
 #include <iostream>
 
 // Hard-coded maximum. Increase if needed.
@@ -142,6 +143,109 @@ __global__ void nms_collect(const int64_t boxes_num, const int64_t col_blocks, i
   *num_to_keep = min(top_k,num_to_keep_);
 }
 
+// Batched versions, boxes of image b are idx[offsets[b]:offsets[b + 1]] (sorted by score),
+// masks of each image are stored from mask_offsets[b], grid z is the image
+template <typename scalar_t>
+__global__ void nms_batched_kernel(const scalar_t nms_overlap_thresh, const scalar_t *dev_boxes, const int64_t *idx,
+                                   const int64_t *offsets, const int64_t *mask_offsets, int64_t *dev_mask) {
+  const int64_t b = blockIdx.z;
+  const int64_t n_boxes = offsets[b + 1] - offsets[b];
+  const int64_t row_start = blockIdx.y;
+  const int64_t col_start = blockIdx.x;
+
+  // Grid is sized by the largest image
+  if (row_start > col_start || col_start * threadsPerBlock >= n_boxes) return;
+
+  const int64_t *img_idx = idx + offsets[b];
+  int64_t *img_mask = dev_mask + mask_offsets[b];
+  const int row_size =
+        min(n_boxes - row_start * threadsPerBlock, threadsPerBlock);
+  const int col_size =
+        min(n_boxes - col_start * threadsPerBlock, threadsPerBlock);
+
+  __shared__ scalar_t block_boxes[threadsPerBlock * PROP_SIZE];
+  if (threadIdx.x < col_size) {
+    for (int i = 0; i <  PROP_SIZE; ++i) {
+      block_boxes[threadIdx.x * PROP_SIZE + i] = dev_boxes[img_idx[(threadsPerBlock * col_start + threadIdx.x)] * PROP_SIZE + i];
+    }
+  }
+  __syncthreads();
+
+  if (threadIdx.x < row_size) {
+    const int cur_box_idx = threadsPerBlock * row_start + threadIdx.x;
+    const scalar_t *cur_box = dev_boxes + img_idx[cur_box_idx] * PROP_SIZE;
+    int i = 0;
+    unsigned long long t = 0;
+    int start = 0;
+    if (row_start == col_start) {
+      start = threadIdx.x + 1;
+    }
+    for (i = start; i < col_size; i++) {
+      if (devIoU(cur_box, block_boxes + i * PROP_SIZE, nms_overlap_thresh)) {
+        t |= 1ULL << i;
+      }
+    }
+    const int col_blocks = DIVUP(n_boxes, threadsPerBlock);
+    img_mask[cur_box_idx * col_blocks + col_start] = t;
+  }
+}
+
+
+// 1 thread for each image, same as nms_collect()
+__global__ void nms_batched_collect(const int64_t batch_size, int64_t top_k, const int64_t *idx, const int64_t *offsets, const int64_t *mask_offsets, const int64_t *mask, int64_t *keep, int64_t *parent_object_index, int64_t *num_to_keep) {
+  const int64_t b = blockIdx.x * blockDim.x + threadIdx.x;
+  if (b >= batch_size) return;
+
+  const int64_t boxes_num = offsets[b + 1] - offsets[b];
+  const int64_t col_blocks = DIVUP(boxes_num, threadsPerBlock);
+  const int64_t *img_idx = idx + offsets[b];
+  const int64_t *img_mask = mask + mask_offsets[b];
+  int64_t *img_keep = keep + offsets[b];
+  int64_t remv[MAX_COL_BLOCKS];
+  int64_t num_to_keep_ = 0;
+
+  for (int i = 0; i < col_blocks; i++) {
+      remv[i] = 0;
+  }
+
+  for (int i = 0; i < boxes_num; ++i) {
+      parent_object_index[img_idx[i]] = 0;
+  }
+
+  for (int i = 0; i < boxes_num; i++) {
+    int nblock = i / threadsPerBlock;
+    int inblock = i % threadsPerBlock;
+
+
+    if (!(remv[nblock] & (1ULL << inblock))) {
+      int64_t idxi = img_idx[i];
+      img_keep[num_to_keep_] = idxi;
+      const int64_t *p = &img_mask[0] + i * col_blocks;
+      for (int j = nblock; j < col_blocks; j++) {
+        remv[j] |= p[j];
+      }
+      for (int j = i; j < boxes_num; j++) {
+        int nblockj = j / threadsPerBlock;
+        int inblockj = j % threadsPerBlock;
+        if (p[nblockj] & (1ULL << inblockj))
+            parent_object_index[img_idx[j]] = num_to_keep_+1;
+      }
+      parent_object_index[idxi] = num_to_keep_+1;
+
+      num_to_keep_++;
+
+      if (num_to_keep_==top_k)
+          break;
+    }
+  }
+
+  // Initialize the rest of the keep array to avoid uninitialized values.
+  for (int i = num_to_keep_; i < boxes_num; ++i)
+      img_keep[i] = 0;
+
+  num_to_keep[b] = min(top_k,num_to_keep_);
+}
+
 #define CHECK_CONTIGUOUS(x) AT_ASSERTM(x.is_contiguous(), #x " must be contiguous")
 
 std::vector<at::Tensor> nms_cuda_forward(
@@ -190,3 +294,68 @@ std::vector<at::Tensor> nms_cuda_forward(
 
   return {keep,num_to_keep,parent_object_index};
 }
+
+
+std::vector<at::Tensor> nms_cuda_forward_batched(
+        at::Tensor boxes,
+        at::Tensor idx,
+        at::Tensor offsets,
+        float nms_overlap_thresh,
+        unsigned long top_k) {
+
+  // offsets is on CPU, to size the grid & masks
+  const auto boxes_num = boxes.size(0);
+  const auto batch_size = offsets.size(0) - 1;
+  TORCH_CHECK(boxes.size(1) == PROP_SIZE, "Wrong number of offsets. Please adjust `PROP_SIZE`");
+
+  auto offsets_cpu = offsets.to(torch::kCPU).contiguous();
+  const int64_t *offsets_ = offsets_cpu.data<int64_t>();
+  auto mask_offsets_cpu = at::empty({batch_size + 1}, offsets_cpu.options());
+  int64_t *mask_offsets_ = mask_offsets_cpu.data<int64_t>();
+  int64_t max_col_blocks = 0;
+  mask_offsets_[0] = 0;
+  for (int64_t b = 0; b < batch_size; ++b) {
+    const int64_t n = offsets_[b + 1] - offsets_[b];
+    const int64_t col_blocks = DIVUP(n, threadsPerBlock);
+    max_col_blocks = std::max(max_col_blocks, col_blocks);
+    mask_offsets_[b + 1] = mask_offsets_[b] + n * col_blocks;
+  }
+
+  AT_ASSERTM (max_col_blocks < MAX_COL_BLOCKS, "The number of column blocks must be less than MAX_COL_BLOCKS. Increase the MAX_COL_BLOCKS constant if needed.");
+
+  auto longOptions = torch::TensorOptions().device(boxes.device()).dtype(torch::kLong);
+  auto dev_offsets = offsets_cpu.to(boxes.device());
+  auto dev_mask_offsets = mask_offsets_cpu.to(boxes.device());
+  auto mask = at::empty({std::max(mask_offsets_[batch_size], (int64_t)1)}, longOptions);
+  auto keep = at::empty({boxes_num}, longOptions);
+  auto parent_object_index = at::empty({boxes_num}, longOptions);
+  auto num_to_keep = at::empty({batch_size}, longOptions);
+
+  CHECK_CONTIGUOUS(boxes);
+  CHECK_CONTIGUOUS(idx);
+
+  if (max_col_blocks > 0) {
+    dim3 blocks(max_col_blocks, max_col_blocks, batch_size);
+    dim3 threads(threadsPerBlock);
+    AT_DISPATCH_FLOATING_TYPES(boxes.type(), "nms_cuda_forward_batched", ([&] {
+      nms_batched_kernel<<<blocks, threads>>>((scalar_t)nms_overlap_thresh,
+                                              boxes.data<scalar_t>(),
+                                              idx.data<int64_t>(),
+                                              dev_offsets.data<int64_t>(),
+                                              dev_mask_offsets.data<int64_t>(),
+                                              mask.data<int64_t>());
+    }));
+  }
+
+  const int collect_threads = 32;
+  nms_batched_collect<<<DIVUP(batch_size, collect_threads), collect_threads>>>(batch_size, top_k,
+                                                                               idx.data<int64_t>(),
+                                                                               dev_offsets.data<int64_t>(),
+                                                                               dev_mask_offsets.data<int64_t>(),
+                                                                               mask.data<int64_t>(),
+                                                                               keep.data<int64_t>(),
+                                                                               parent_object_index.data<int64_t>(),
+                                                                               num_to_keep.data<int64_t>());
+
+  return {keep,num_to_keep,parent_object_index};
+}
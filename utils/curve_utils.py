@@ -46,22 +46,76 @@ class Polynomial(object):
         return coord_list
 
 
+def bernstein_basis(t, order):
+    # Bernstein basis of an order-n Bezier curve, vectorized over any shape of t
+    # t: ..., Return: ... x (n + 1), [C(n, k) * t^k * (1 - t)^(n - k) for k in 0..n]
+    t = np.asarray(t, dtype=np.float64)[..., None]
+    k = np.arange(order + 1)
+
+    return n_over_k(order, k) * t ** k * (1 - t) ** (order - k)
+
+
+_bernstein_matrices = {}
+
+
+def bernstein_matrix(order, num_points, proj_coefficient=0, dtype=torch.float32, device='cpu'):
+    # Bernstein basis (num_points x (order + 1)) at uniformly sampled t, optionally projected towards both ends,
+    # built once in float64 and memoized per process for each (order, num_points, proj_coefficient, dtype, device).
+    # The returned tensor is shared, never modify it in-place
+    device = torch.device(device)
+    key = (order, num_points, proj_coefficient, dtype, device)
+    if key not in _bernstein_matrices:
+        t = np.linspace(0, 1, num_points)
+        if proj_coefficient != 0:
+            upper = t > 0.5
+            t[upper] = t[upper] + (1 - t[upper]) * t[upper] ** proj_coefficient
+            lower = t < 0.5
+            t[lower] = 1 - (1 - t[lower] + t[lower] * (1 - t[lower]) ** proj_coefficient)
+        _bernstein_matrices[key] = torch.from_numpy(bernstein_basis(t, order)).to(dtype=dtype, device=device)
+
+    return _bernstein_matrices[key]
+
+
+def chord_length_parameters(points):
+    # Parameter t of each point by the normalized cumulative chord length (t = 0 at the first point, 1 at the last)
+    # points: ... x N x 2, Return: ... x N
+    dt = (np.diff(points, axis=-2) ** 2).sum(axis=-1) ** 0.5
+    t = dt / dt.sum(axis=-1, keepdims=True)
+    t = np.concatenate([np.zeros((*t.shape[:-1], 1)), t], axis=-1)
+
+    return t.cumsum(axis=-1)
+
+
+def fit_bezier_batched(lanes, order, interpolate=False):
+    # Least-squares fit of many lanes at once, same results as BezierCurve.get_control_points() up to rounding
+    # Lanes with the same number of points are stacked and solved by one batched pseudo-inverse
+    # lanes: list of N_i x 2 (x, y) arrays, Return: list of (order + 1) x 2 control points
+    if interpolate:  # Splines are fitted one by one
+        lanes = [BezierCurve.interpolate_lane(lane[:, 0], lane[:, 1]) for lane in lanes]
+    groups = {}
+    for i, lane in enumerate(lanes):
+        groups.setdefault(len(lane), []).append(i)
+    results = [None] * len(lanes)
+    for indices in groups.values():
+        points = np.stack([lanes[i] for i in indices]).astype(np.float64)  # G x N x 2
+        basis = bernstein_basis(chord_length_parameters(points), order)  # G x N x (order + 1)
+        control_points = np.linalg.pinv(basis) @ points  # G x (order + 1) x 2
+        for i, cp in zip(indices, control_points):
+            results[i] = cp
+
+    return results
+
+
 class BezierCurve(object):
     # Define Bezier curves for curve fitting
     def __init__(self, order, num_sample_points=50):
         self.num_point = order + 1
         self.control_points = []
-        self.bezier_coeff = self.get_bezier_coefficient()
         self.num_sample_points = num_sample_points
         self.c_matrix = self.get_bernstein_matrix()
 
-    def get_bezier_coefficient(self):
-        Mtk = lambda n, t, k: t ** k * (1 - t) ** (n - k) * n_over_k(n, k)
-        BezierCoeff = lambda ts: [[Mtk(self.num_point - 1, t, k) for k in range(self.num_point)] for t in ts]
-
-        return BezierCoeff
-
-    def interpolate_lane(self, x, y, n=50):
+    @staticmethod
+    def interpolate_lane(x, y, n=50):
         # Spline interpolation of a lane. Used on the predictions
         assert len(x) == len(y)
 
@@ -81,9 +135,7 @@ class BezierCurve(object):
             self.control_points.append([middle_points[idx], middle_points[idx + 1]])
 
     def get_bernstein_matrix(self):
-        tokens = np.linspace(0, 1, self.num_sample_points)
-        c_matrix = self.bezier_coeff(tokens)
-        return np.array(c_matrix)
+        return bernstein_matrix(self.num_point - 1, self.num_sample_points, dtype=torch.float64).numpy()
 
     def save_control_points(self):
         return self.control_points
@@ -104,8 +156,7 @@ class BezierCurve(object):
             :param n: the number of sampled points
             :return: a list of sampled points
         '''
-        t = np.linspace(0, 1, n)
-        coeff_matrix = np.array(self.bezier_coeff(t))
+        coeff_matrix = bernstein_matrix(self.num_point - 1, n, dtype=torch.float64).numpy()
         control_points_matrix = np.array(self.control_points)
         sample_points = coeff_matrix.dot(control_points_matrix)
         if image_size is not None:
@@ -115,14 +166,9 @@ class BezierCurve(object):
         return sample_points
 
     def get_middle_control_points(self, x, y):
-        dy = y[1:] - y[:-1]
-        dx = x[1:] - x[:-1]
-        dt = (dx ** 2 + dy ** 2) ** 0.5
-        t = dt / dt.sum()
-        t = np.hstack(([0], t))
-        t = t.cumsum()
         data = np.column_stack((x, y))
-        Pseudoinverse = np.linalg.pinv(self.bezier_coeff(t))  # (9,4) -> (4,9)
+        t = chord_length_parameters(data)
+        Pseudoinverse = np.linalg.pinv(bernstein_basis(t, self.num_point - 1))  # (9,4) -> (4,9)
         control_points = Pseudoinverse.dot(data)  # (4,9)*(9,2) -> (4,2)
         medi_ctp = control_points[:, :].flatten().tolist()
 
@@ -137,31 +183,67 @@ class BezierSampler(torch.nn.Module):
         self.num_control_points = order + 1
         self.num_sample_points = num_sample_points
         self.control_points = []
-        self.bezier_coeff = self.get_bezier_coefficient()
-        self.bernstein_matrix = self.get_bernstein_matrix()
 
-    def get_bezier_coefficient(self):
-        Mtk = lambda n, t, k: t ** k * (1 - t) ** (n - k) * n_over_k(n, k)
-        BezierCoeff = lambda ts: [[Mtk(self.num_control_points - 1, t, k) for k in range(self.num_control_points)] for t
-                                  in ts]
-        return BezierCoeff
-
-    def get_bernstein_matrix(self):
-        t = torch.linspace(0, 1, self.num_sample_points)
-        if self.proj_coefficient != 0:
-            # tokens = tokens + (1 - tokens) * tokens ** self.proj_coefficient
-            t[t > 0.5] = t[t > 0.5] + (1 - t[t > 0.5]) * t[t > 0.5] ** self.proj_coefficient
-            t[t < 0.5] = 1 - (1 - t[t < 0.5] + t[t < 0.5] * (1 - t[t < 0.5]) ** self.proj_coefficient)
-        c_matrix = torch.tensor(self.bezier_coeff(t))
-        return c_matrix
+    def get_bernstein_matrix(self, dtype=torch.float32, device='cpu'):
+        return bernstein_matrix(self.num_control_points - 1, self.num_sample_points, self.proj_coefficient,
+                                dtype=dtype, device=device)
 
     def get_sample_points(self, control_points_matrix):
         if control_points_matrix.numel() == 0:
             return control_points_matrix  # Looks better than a torch.Tensor
-        if self.bernstein_matrix.device != control_points_matrix.device:
-            self.bernstein_matrix = self.bernstein_matrix.to(control_points_matrix.device)
+        control_points_matrix = upcast(control_points_matrix)
+
+        return self.get_bernstein_matrix(control_points_matrix.dtype,
+                                         control_points_matrix.device).matmul(control_points_matrix)
 
-        return upcast(self.bernstein_matrix).matmul(upcast(control_points_matrix))
+
+@torch.no_grad()
+def cubic_bezier_solve_y(control_points, ys, iterations=40):
+    # Find x at each given y on a batch of cubic bezier curves, by bisection on the (at most 3)
+    # monotonic pieces of y(t) split by its critical points, the smallest t is used for multiple solutions
+    # control_points: L x 4 x 2
+    # ys: K
+    # Return: x (L x K), solved (L x K, whether y is reached by t in [0, 1])
+    p0, p1, p2, p3 = control_points.unbind(dim=-2)  # L x 2
+    coefficients = torch.stack([p3 - 3 * p2 + 3 * p1 - p0,
+                                3 * p2 - 6 * p1 + 3 * p0,
+                                3 * p1 - 3 * p0,
+                                p0], dim=-2)  # L x 4 x 2, power basis (t^3, t^2, t, 1)
+
+    def evaluate(t, dim):  # t: L x ...
+        c = coefficients[:, :, dim].reshape(-1, 4, *([1] * (t.dim() - 1)))
+        return ((c[:, 0] * t + c[:, 1]) * t + c[:, 2]) * t + c[:, 3]
+
+    # Critical points of y(t): roots of 3a t^2 + 2b t + c = 0, NaN if none (sorted as the last)
+    a, b, c = 3 * coefficients[:, 0, 1], 2 * coefficients[:, 1, 1], coefficients[:, 2, 1]
+    sqrt_delta = (b ** 2 - 4 * a * c).sqrt()
+    quadratic = a != 0
+    safe_a = torch.where(quadratic, a, torch.ones_like(a))
+    safe_b = torch.where(b != 0, b, torch.ones_like(b))
+    linear_root = torch.where(b != 0, -c / safe_b, torch.full_like(b, float('nan')))
+    roots = torch.stack([torch.where(quadratic, (-b - sqrt_delta) / (2 * safe_a), linear_root),
+                         torch.where(quadratic, (-b + sqrt_delta) / (2 * safe_a), linear_root)], dim=-1)
+    roots = roots.clamp(min=0, max=1).nan_to_num(nan=1.0)  # L x 2
+    bounds = torch.cat([torch.zeros_like(roots[:, :1]), roots.sort(dim=-1).values, torch.ones_like(roots[:, :1])],
+                       dim=-1)  # L x 4
+
+    # First piece that includes each y
+    f_bounds = evaluate(bounds, 1).unsqueeze(1) - ys.unsqueeze(-1)  # L x K x 4
+    has_root = f_bounds[:, :, :-1] * f_bounds[:, :, 1:] <= 0  # L x K x 3
+    piece = has_root.int().argmax(dim=-1, keepdim=True)  # L x K x 1
+    lo = bounds.unsqueeze(1).expand_as(f_bounds).gather(-1, piece).squeeze(-1)  # L x K
+    hi = bounds.unsqueeze(1).expand_as(f_bounds).gather(-1, piece + 1).squeeze(-1)
+    f_lo = f_bounds.gather(-1, piece).squeeze(-1)
+
+    # Bisection, fixed number of steps
+    for _ in range(iterations):
+        mid = (lo + hi) / 2
+        same_sign = (evaluate(mid, 1) - ys) * f_lo > 0
+        lo = torch.where(same_sign, mid, lo)
+        hi = torch.where(same_sign, hi, mid)
+    t = torch.where(f_lo == 0, lo, (lo + hi) / 2)
+
+    return evaluate(t, 0), has_root.any(dim=-1)
 
 
 @torch.no_grad()
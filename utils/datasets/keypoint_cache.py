@@ -0,0 +1,156 @@
+# Pre-processed keypoint targets of .lines.txt labels (CULane, LLAMAS), cached in 1 file
+# Single uncompressed .npz file, written to a temp file then renamed (a half-written cache is never read):
+#   version: int, bumped when the pre-processing changes
+#   params: float64, [ppl, gap, start]
+#   key_bytes: uint8, utf-8 encoded label paths (relative to the dataset root) concatenated
+#   key_offsets: int64, (num_images + 1)
+#   file_stats: int64, (num_images x 2), [mtime_ns, size] of each label file when it was processed
+#   lane_offsets: int64, (num_images + 1), index into keypoints
+#   keypoints: float32, (num_lanes x ppl x 2), invalid points are (-2, y)
+import os
+import numpy as np
+from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor
+
+from .packed import load_npz_arrays
+from ..common import warnings
+
+KEYPOINT_CACHE_VERSION = 1
+
+
+def lines_to_keypoints(lines, ppl, gap, start):
+    # Sample each lane (a line of "x y x y ...") to ppl points at y = start + i * gap,
+    # points on other rows are dropped, if there are multiple points on the same row, the last one is used
+    # Return: L x ppl x 2 float32 (shape (0,) if there is no lane, as expected by transforms)
+    if len(lines) == 0:
+        return np.zeros((0,), dtype=np.float32)
+    sample_ys = np.array([start + i * gap for i in range(ppl)], dtype=np.float32)
+    target = np.empty((len(lines), ppl, 2), dtype=np.float32)
+    target[:, :, 0] = -2
+    target[:, :, 1] = sample_ys
+    for i, line in enumerate(lines):
+        temp = np.array(line.split(), dtype=np.float64)
+        temp = temp[:len(temp) // 2 * 2].reshape(-1, 2).astype(np.float32)
+        # Row of each point, matched with float32 y as in the sampled rows
+        rows = np.clip(np.round((temp[:, 1].astype(np.float64) - start) / gap), 0, max(ppl - 1, 0)).astype(np.int64)
+        on_row = sample_ys[rows] == temp[:, 1] if ppl > 0 else np.zeros(len(temp), dtype=bool)
+        rows, temp = rows[on_row][::-1], temp[on_row][::-1]
+        rows, last = np.unique(rows, return_index=True)
+        target[i, rows] = temp[last]
+
+    return target
+
+
+def load_keypoint_file(filename, ppl, gap, start):
+    # Return: keypoints (L x ppl x 2), [mtime_ns, size] of the file
+    stat = os.stat(filename)
+    with open(filename, 'r') as f:
+        lines = f.readlines()
+
+    return lines_to_keypoints(lines, ppl, gap, start), [stat.st_mtime_ns, stat.st_size]
+
+
+def _load_keypoint_files(filenames, ppl, gap, start, workers):
+    if workers <= 1 or len(filenames) < 1000:
+        return [load_keypoint_file(x, ppl, gap, start) for x in tqdm(filenames)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(tqdm(executor.map(load_keypoint_file, filenames, [ppl] * len(filenames),
+                                      [gap] * len(filenames), [start] * len(filenames),
+                                      chunksize=256), total=len(filenames)))
+
+
+def _read_cache(cache_file, params):
+    # Return: a dict of arrays, or None if there is no valid cache
+    if not os.path.exists(cache_file):
+        return None
+    try:
+        cache = load_npz_arrays(cache_file, mmap=True)  # Only read what is needed
+        if int(cache['version']) != KEYPOINT_CACHE_VERSION:
+            warnings.warn('Keypoint cache {} is of an old version, re-processing.'.format(cache_file))
+            return None
+        if not np.array_equal(cache['params'], params):
+            warnings.warn('Keypoint cache {} has different (ppl, gap, start) {}, re-processing.'.format(
+                cache_file, cache['params'].tolist()))
+            return None
+        num_images = len(cache['lane_offsets']) - 1
+        if len(cache['key_offsets']) != num_images + 1 or cache['file_stats'].shape != (num_images, 2) or \
+                cache['lane_offsets'][-1] != len(cache['keypoints']) or \
+                cache['key_offsets'][-1] != len(cache['key_bytes']) or \
+                cache['keypoints'].shape[1:] != (int(params[0]), 2):
+            raise ValueError('inconsistent arrays')
+    except Exception as e:  # Corrupted
+        warnings.warn('Keypoint cache {} is invalid ({}), re-processing.'.format(cache_file, e))
+        return None
+
+    return cache
+
+
+def load_keypoint_targets(cache_file, root, label_files, ppl, gap, start, workers=None, mmap=False):
+    # Load keypoint targets of label files (paths relative to root), through a cache validated by
+    # the label files (paths, modification times & sizes) and (ppl, gap, start),
+    # only new or modified label files are processed (in parallel) and the cache is updated.
+    # Return: lane_offsets (num_images + 1), keypoints (num_lanes x ppl x 2),
+    #         lanes of the i-th label file are keypoints[lane_offsets[i]:lane_offsets[i + 1]],
+    #         memory-mapped (read-only) from the cache file if mmap=True
+    if workers is None:
+        workers = os.cpu_count()
+    params = np.array([ppl, gap, start], dtype=np.float64)
+    cache = _read_cache(cache_file, params)
+    cached_index = {}
+    if cache is not None:
+        key_bytes = cache['key_bytes'].tobytes()
+        key_offsets = cache['key_offsets'].tolist()
+        cached_index = {key_bytes[key_offsets[i]:key_offsets[i + 1]].decode('utf-8'): i
+                        for i in range(len(key_offsets) - 1)}
+        cached_lane_offsets = cache['lane_offsets'].tolist()
+
+    # Find new & modified label files
+    file_stats = np.zeros((len(label_files), 2), dtype=np.int64)
+    to_process = []
+    for i, x in enumerate(label_files):
+        j = cached_index.get(x)
+        if j is not None:
+            stat = os.stat(os.path.join(root, x))
+            file_stats[i] = [stat.st_mtime_ns, stat.st_size]
+            if (cache['file_stats'][j] == file_stats[i]).all():
+                continue
+        to_process.append(i)
+
+    if len(to_process) > 0:
+        print('Pre-processing {} label files, results will be cached in {}.'.format(len(to_process), cache_file))
+    processed = _load_keypoint_files([os.path.join(root, label_files[i]) for i in to_process],
+                                     ppl, gap, start, workers)
+    processed = {i: result for i, result in zip(to_process, processed)}
+
+    # Assemble in the order of label_files
+    pieces = []
+    lane_offsets = np.zeros(len(label_files) + 1, dtype=np.int64)
+    for i, x in enumerate(label_files):
+        if i in processed:
+            keypoints, file_stats[i] = processed[i]
+            pieces.append(keypoints)
+            if len(keypoints) == 0:
+                pieces[-1] = np.zeros((0, ppl, 2), dtype=np.float32)
+        else:
+            j = cached_index[x]
+            pieces.append(cache['keypoints'][cached_lane_offsets[j]:cached_lane_offsets[j + 1]])
+        lane_offsets[i + 1] = lane_offsets[i] + len(pieces[-1])
+    keypoints = np.concatenate(pieces) if len(pieces) > 0 else np.zeros((0, ppl, 2), dtype=np.float32)
+
+    # Update the cache if anything changed (including the list)
+    if len(to_process) > 0 or len(cached_index) != len(label_files) or \
+            any(cached_index[x] != i for i, x in enumerate(label_files)):
+        key_bytes = [x.encode('utf-8') for x in label_files]
+        temp = '{}.{}.tmp.npz'.format(cache_file, os.getpid())  # Other processes (e.g. DDP) could be writing
+        np.savez(temp, version=np.array(KEYPOINT_CACHE_VERSION), params=params,
+                 key_bytes=np.frombuffer(b''.join(key_bytes), dtype=np.uint8),
+                 key_offsets=np.cumsum([0] + [len(k) for k in key_bytes], dtype=np.int64),
+                 file_stats=file_stats, lane_offsets=lane_offsets, keypoints=keypoints)
+        os.replace(temp, cache_file)
+
+    if mmap:
+        cache = load_npz_arrays(cache_file, mmap=True)
+        return cache['lane_offsets'], cache['keypoints']
+
+    return lane_offsets, keypoints
+
@@ -6,8 +6,55 @@ import numpy as np
 from PIL import Image
 
 from .builder import DATASETS
+from .packed import PackedArrays, PackedStrings, save_packed_arrays, load_packed_arrays
+from ..common import warnings
 from ..curve_utils import BezierSampler, get_valid_points
 
+BEZIER_STORE_VERSION = 1
+
+
+def build_bezier_store(json_file, store_file=None):
+    # Pack control points in a bezier_labels json file to a memory-mappable .npz file (default: next to the json)
+    # Return: PackedArrays, lanes of image i (L x (order + 1) x 2) are packed[i]
+    if store_file is None:
+        store_file = os.path.splitext(json_file)[0] + '.npz'
+    beziers = []
+    with open(json_file, 'r') as f:
+        for x in f.readlines():
+            lanes = json.loads(x.strip())['bezier_control_points']
+            beziers.append(np.array(lanes, dtype=np.float32).reshape(len(lanes), -1, 2) if len(lanes) > 0
+                           else np.zeros((0,), dtype=np.float32))
+    packed = PackedArrays.from_list(beziers, item_shape=(0, 2))
+    stat = os.stat(json_file)
+    save_packed_arrays(store_file, packed, version=np.array(BEZIER_STORE_VERSION),
+                       json_stat=np.array([stat.st_mtime_ns, stat.st_size], dtype=np.int64))
+
+    return packed
+
+
+def load_bezier_store(json_file, store_file=None, mmap=True):
+    # Load the packed control points, (re-)build it if it is missing, invalid or older than the json file
+    if store_file is None:
+        store_file = os.path.splitext(json_file)[0] + '.npz'
+    if os.path.exists(store_file):
+        try:
+            packed, arrays = load_packed_arrays(store_file, mmap=mmap)
+            if int(arrays['version']) != BEZIER_STORE_VERSION:
+                raise ValueError('old version')
+            if os.path.exists(json_file):
+                stat = os.stat(json_file)
+                if arrays['json_stat'].tolist() != [stat.st_mtime_ns, stat.st_size]:
+                    raise ValueError('{} is modified'.format(json_file))
+
+            return packed
+        except Exception as e:
+            warnings.warn('Re-building {}: {}'.format(store_file, e))
+    print('Packing {} to {}, this will only be performed for 1 time.'.format(json_file, store_file))
+    build_bezier_store(json_file, store_file)
+    packed, _ = load_packed_arrays(store_file, mmap=mmap)
+
+    return packed
+
 
 class _BezierLaneDataset(torchvision.datasets.VisionDataset):
     # BezierLaneNet dataset, includes binary seg labels
@@ -38,6 +85,11 @@ class _BezierLaneDataset(torchvision.datasets.VisionDataset):
         self.splits_dir = os.path.join(root, 'lists')
         self._init_all()
 
+        # Flat storage, shared by DataLoader workers without copy-on-write
+        self.images = PackedStrings(self.images)
+        if hasattr(self, 'masks'):
+            self.masks = PackedStrings(self.masks)
+
     def init_dataset(self, root):
         raise NotImplementedError
 
@@ -68,19 +120,8 @@ class _BezierLaneDataset(torchvision.datasets.VisionDataset):
         return len(self.images)
 
     def loader_bezier(self):
-        results = []
-        with open(self.bezier_labels, 'r') as f:
-            results += [json.loads(x.strip()) for x in f.readlines()]
-        beziers = []
-        for lanes in results:
-            temp_lane = []
-            for lane in lanes['bezier_control_points']:
-                temp_cps = []
-                for i in range(0, len(lane), 2):
-                    temp_cps.append([lane[i], lane[i + 1]])
-                temp_lane.append(temp_cps)
-            beziers.append(np.array(temp_lane, dtype=np.float32))
-        return beziers
+        # Packed control points (memory-mapped), built from the json labels at the first time
+        return load_bezier_store(self.bezier_labels)
 
     def _init_all(self):
         # Got the lists from 4 datasets to be in the same format
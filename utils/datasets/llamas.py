@@ -1,9 +1,9 @@
 import os
-import pickle
 import numpy as np
-from tqdm import tqdm
 
 from .utils import LaneKeypointDataset
+from .keypoint_cache import lines_to_keypoints, load_keypoint_targets
+from .packed import PackedArrays, PackedStrings
 from .builder import DATASETS
 
 
@@ -17,8 +17,9 @@ class LLAMAS(LaneKeypointDataset):
     ]
 
     def __init__(self, root, image_set, transforms=None, transform=None, target_transform=None,
-                 ppl=417, gap=1, start=300, padding_mask=False):
-        super().__init__(root, transforms, transform, target_transform, ppl, gap, start, padding_mask, image_set)
+                 ppl=417, gap=1, start=300, padding_mask=False, is_process=True, mmap_targets=False):
+        super().__init__(root, transforms, transform, target_transform, ppl, gap, start, padding_mask, image_set,
+                         is_process)
 
         self._check()
 
@@ -33,35 +34,24 @@ class LLAMAS(LaneKeypointDataset):
             self.targets = [os.path.join('./output', x + '.lines.txt') for x in contents]
         else:  # Train
             self.images = [os.path.join(self.images_path, x[:x.find(' ')] + '.png') for x in contents]
-            self.targets = []
             print('Loading targets into memory...')
-            processed_file = os.path.join(root, 'train_processed_targets')
-            if os.path.exists(processed_file):
-                with open(processed_file, 'rb') as f:
-                    self.targets = pickle.load(f)
-            else:
-                print('Pre-processing will only be performed for 1 time, please wait ~10 minutes.')
-                for x in tqdm(contents):
-                    with open(os.path.join(self.images_path, x[:x.find(' ')] + '.lines.txt'), 'r') as f:
-                        self.targets.append(self._load_target(f.readlines()))
-                with open(processed_file, 'wb') as f:
-                    pickle.dump(self.targets, f)
+            # Cached, validated by the list & (ppl, gap, start), pre-processing is only done for new/modified labels
+            lane_offsets, keypoints = load_keypoint_targets(
+                cache_file=os.path.join(root, image_set + '_processed_targets.npz'), root=root,
+                label_files=[os.path.join('color_images', x[:x.find(' ')] + '.lines.txt') for x in contents],
+                ppl=self.ppl, gap=self.gap, start=self.start, mmap=mmap_targets)
+            self.targets = PackedArrays(lane_offsets, keypoints)
             print('Loading complete.')
 
         assert len(self.targets) == len(self.images)
+        # Flat storage, shared by DataLoader workers without copy-on-write
+        self.images = PackedStrings(self.images)
+        if image_set == 'test' or image_set == 'val':
+            self.targets = PackedStrings(self.targets)
 
     def _load_target(self, lines):
         # Read file content to lists (file content could be empty or variable number of lanes)
-        target = np.array([[[-2.0, self.start + i * self.gap] for i in range(self.ppl)]
-                           for _ in range(len(lines))], dtype=np.float32)
-        for i in range(len(lines)):  # lines=[] will end this immediately
-            temp = [float(k) for k in lines[i].strip().split(' ')]
-            for j in range(int(len(temp) / 2)):
-                x = temp[2 * j]
-                y = temp[2 * j + 1]
-                target[i][target[i][:, 1] == y] = [x, y]
-
-        return target
+        return lines_to_keypoints(lines, self.ppl, self.gap, self.start)
 
     @staticmethod
     def load_target_xy(lines):
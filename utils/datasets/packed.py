@@ -0,0 +1,103 @@
+# Compact, list-like storage of dataset items (e.g. lane targets, image paths)
+# A list of many small Python objects gets its pages copied (by reference counting) in each forked DataLoader worker,
+# these store everything in a few flat arrays instead, that can also be memory-mapped from a file
+# Also imported standalone by tools/culane_evaluation_py/lane_store.py, keep it free of other dependencies
+import os
+import struct
+import zipfile
+import numpy as np
+
+
+class PackedArrays(object):
+    # Arrays with the same trailing shape, item i is data[offsets[i]:offsets[i + 1]]
+    # Empty items are returned with shape (0,), same as np.array([])
+    def __init__(self, offsets, data):
+        self.offsets = offsets
+        self.data = data
+
+    @classmethod
+    def from_list(cls, arrays, item_shape=(), dtype=np.float32):
+        # item_shape: trailing shape of non-empty arrays, used when all arrays are empty
+        non_empty = [x for x in arrays if len(x) > 0]
+        if len(non_empty) > 0:
+            item_shape = non_empty[0].shape[1:]
+        data = np.concatenate(non_empty).astype(dtype, copy=False) if len(non_empty) > 0 \
+            else np.zeros((0, *item_shape), dtype=dtype)
+
+        return cls(np.cumsum([0] + [len(x) for x in arrays], dtype=np.int64), data)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        # A copy, so the storage is never modified (and can be read-only)
+        if index < 0:
+            index += len(self)
+        start, end = self.offsets[index], self.offsets[index + 1]
+        if start == end:
+            return np.zeros((0,), dtype=self.data.dtype)
+
+        return np.array(self.data[start:end])
+
+
+def save_packed_arrays(filename, packed, **extra_arrays):
+    # Single uncompressed .npz file (offsets, data, extra arrays), can be loaded with mmap
+    # Write to a temp file then rename, so a half-written file is never read
+    temp = '{}.{}.tmp.npz'.format(filename, os.getpid())
+    np.savez(temp, offsets=packed.offsets, data=packed.data, **extra_arrays)
+    os.replace(temp, filename)
+
+
+def load_packed_arrays(filename, mmap=True):
+    # Return: PackedArrays, all arrays in the file (for extra arrays)
+    arrays = load_npz_arrays(filename, mmap=mmap)
+    if arrays['offsets'][-1] != len(arrays['data']):
+        raise ValueError('Inconsistent offsets and data in {}'.format(filename))
+
+    return PackedArrays(arrays['offsets'], arrays['data']), arrays
+
+
+class PackedStrings(object):
+    # utf-8 strings concatenated in a byte array
+    def __init__(self, strings):
+        encoded = [x.encode('utf-8') for x in strings]
+        self.offsets = np.cumsum([0] + [len(x) for x in encoded], dtype=np.int64)
+        self.data = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        return self.data[self.offsets[index]:self.offsets[index + 1]].tobytes().decode('utf-8')
+
+
+def load_npz_arrays(filename, mmap=True):
+    # np.load(npz) reads the whole member, map stored (uncompressed) members directly instead
+    arrays = {}
+    with zipfile.ZipFile(filename) as zf, open(filename, 'rb') as f:
+        for info in zf.infolist():
+            name = info.filename[:-4] if info.filename.endswith('.npy') else info.filename
+            if not mmap or info.compress_type != zipfile.ZIP_STORED:
+                with zf.open(info) as member:
+                    arrays[name] = np.lib.format.read_array(member, allow_pickle=False)
+                continue
+            f.seek(info.header_offset)
+            local_header = f.read(30)
+            name_length, extra_length = struct.unpack('<HH', local_header[26:30])
+            f.seek(info.header_offset + 30 + name_length + extra_length)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            if dtype.hasobject:
+                raise ValueError('Object arrays are not supported')
+            if int(np.prod(shape)) == 0:
+                arrays[name] = np.zeros(shape, dtype=dtype)
+            else:
+                arrays[name] = np.memmap(filename, dtype=dtype, mode='r', shape=shape, offset=f.tell(),
+                                         order='F' if fortran_order else 'C')
+
+    return arrays
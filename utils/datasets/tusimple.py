@@ -7,6 +7,7 @@ import numpy as np
 from tqdm import tqdm
 
 from .utils import LaneKeypointDataset
+from .packed import PackedArrays, PackedStrings
 from .builder import DATASETS
 
 
@@ -52,8 +53,13 @@ class TuSimple(LaneKeypointDataset):
                     for k in range(len(lines)):
                         temp[k][temp[k][:, 1] == h_samples[j]] = [float(lines[k][j]), h_samples[j]]
                 self.targets.append(temp)
+            self.targets = PackedArrays.from_list(self.targets, item_shape=(self.ppl, 2))
 
         assert len(self.targets) == len(self.images)
+        # Flat storage, shared by DataLoader workers without copy-on-write
+        self.images = PackedStrings(self.images)
+        if image_set == 'test' or image_set == 'val':
+            self.targets = PackedStrings(self.targets)
 
     @staticmethod
     def concat_jsons(filenames):
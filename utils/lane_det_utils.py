@@ -90,20 +90,189 @@ def prob_to_lines(seg_pred, exist, resize_shape=None, smooth=True, gap=20, ppl=N
     return coordinates
 
 
+def get_sample_rows(h, H, gap, ppl, dataset='culane'):
+    # Row indices on a h x w prob map, the same ones get_lane() reads (-1 after its early break)
+    rows = []
+    for i in range(ppl):
+        if dataset == 'tusimple':
+            y = int(h - (ppl - i) * gap / H * h)
+        elif dataset in ['culane', 'llamas']:
+            y = int(h - i * gap / H * h - 1)
+        else:
+            raise ValueError
+        if y < 0:
+            rows += [-1] * (ppl - i)
+            break
+        rows.append(y)
+
+    return rows
+
+
+def box_blur_rows(prob_map, rows, kernel_size=9, vertical=True):
+    """
+    Arguments:
+    ----------
+    prob_map: prob maps as tensor, size (B, C, h, w)
+    rows:     row indices as long tensor, size (N)
+    vertical: False to only blur horizontally (1 x kernel_size)
+    Return:
+    ----------
+    blurred: cv2.blur(prob_map, (kernel_size, kernel_size), borderType=cv2.BORDER_REPLICATE) on those rows only,
+             size (B, C, N, w), accumulated in float64 and scaled by a reciprocal like OpenCV does
+    """
+
+    r = kernel_size // 2
+    if vertical:  # Vertical window around each row, clamped as border replicate
+        offsets = torch.arange(-r, r + 1, device=rows.device)
+        rows = (rows[:, None] + offsets[None, :]).clamp_(min=0, max=prob_map.shape[-2] - 1)
+        windows = prob_map[:, :, rows.flatten(), :]
+        B, C, _, w = windows.shape
+        col_sums = windows.double().view(B, C, -1, kernel_size, w).sum(dim=3)
+        scale = 1.0 / (kernel_size * kernel_size)
+    else:
+        col_sums = prob_map[:, :, rows, :].double()
+        w = col_sums.shape[-1]
+        scale = 1.0 / kernel_size
+    col_sums = torch.cat([col_sums[..., :1].expand(-1, -1, -1, r), col_sums,
+                          col_sums[..., -1:].expand(-1, -1, -1, r)], dim=-1)
+    sums = col_sums[..., :w].clone()
+    for i in range(1, kernel_size):
+        sums += col_sums[..., i:i + w]
+
+    return (sums * scale).to(prob_map.dtype)
+
+
+def interpolate_rows(x, rows, size):
+    # Same as interpolate(x, size=size, mode='bilinear', align_corners=True)[:, :, rows, :],
+    # without computing the other rows
+    # x: B x C x h x w
+    # rows: N (long tensor)
+    # Return: B x C x N x size[1]
+    h = x.shape[-2]
+    scale = (h - 1) / (size[0] - 1) if size[0] > 1 else 0.
+    src = rows.float() * scale
+    y0 = src.floor().long().clamp_(max=h - 1)
+    y1 = (y0 + 1).clamp_(max=h - 1)
+    ly = (src - y0).to(x.dtype)[:, None]
+    x = x[:, :, y0, :] * (1 - ly) + x[:, :, y1, :] * ly
+
+    return torch.nn.functional.interpolate(x, size=(rows.shape[0], size[1]), mode='bilinear', align_corners=True)
+
+
+@torch.no_grad()
+def rows_to_lines(row_probs, existence, w, resize_shape, gap, ppl, thresh, dataset='culane', valid_rows=None):
+    """
+    Arguments:
+    ----------
+    row_probs:   prob maps (smoothed) on the sampled rows, tensor size (B, num_classes - 1, ppl, w)
+    existence:   lane existence as bool tensor, size (B, num_classes - 1)
+    w:           prob map width
+    resize_shape: reshape size target, (H, W)
+    valid_rows:  bool tensor size (ppl), False for rows get_lane() never reaches
+    Return:
+    ----------
+    lane_coordinates: batched prob_to_lines() results, one list per image
+    """
+
+    H, W = resize_shape
+    values, indices = row_probs.max(dim=-1)  # B x L x ppl, first max index like np.argmax()
+    positive = values.double() > thresh
+    if valid_rows is not None:
+        positive &= valid_rows
+    coords = (indices.double() / w * W).trunc() * positive  # int(id / w * W)
+    coords *= ((coords > 0).sum(dim=-1, keepdim=True) >= 2)
+    coords = coords.cpu()  # The only device -> host transfer (besides tiny existence)
+
+    # Format like prob_to_lines()
+    lane_coordinates = []
+    for coords_image, exist in zip(coords.tolist(), existence.cpu().tolist()):
+        coordinates = []
+        for coords_lane, flag in zip(coords_image, exist):
+            if not flag or sum(coords_lane) == 0:
+                continue
+            if dataset == 'tusimple':
+                coordinates.append([[x, H - (ppl - j) * gap] if x > 0 else [-2, H - (ppl - j) * gap]
+                                    for j, x in enumerate(coords_lane)])
+            elif dataset in ['culane', 'llamas']:
+                coordinates.append([[x, H - j * gap - 1] for j, x in enumerate(coords_lane) if x > 0])
+            else:
+                raise ValueError
+        lane_coordinates.append(coordinates)
+
+    return lane_coordinates
+
+
+@torch.no_grad()
+def prob_to_lines_batched(prob_map, existence, resize_shape=None, smooth=True, gap=20, ppl=None, thresh=0.3,
+                          dataset='culane'):
+    # Tensorized prob_to_lines() for a batch, runs on prob_map's device with identical outputs
+    # prob_map: B x num_classes x h x w
+    # existence: B x (num_classes - 1)
+    h, w = prob_map.shape[-2:]
+    if resize_shape is None:
+        resize_shape = (h, w)
+    if ppl is None:
+        ppl = round(resize_shape[0] / 2 / gap)
+    rows = torch.tensor(get_sample_rows(h, resize_shape[0], gap, ppl, dataset), device=prob_map.device)
+    valid_rows = rows >= 0
+    rows = rows.clamp(min=0)
+    prob_map = prob_map[:, 1:]
+    if smooth:
+        row_probs = box_blur_rows(prob_map, rows)
+    else:
+        row_probs = prob_map[:, :, rows, :]
+
+    return rows_to_lines(row_probs, existence, w, resize_shape, gap, ppl, thresh, dataset, valid_rows)
+
+
+@torch.no_grad()
+def logits_to_lines_sparse(logits, existence, input_size, resize_shape, smooth=True, gap=20, ppl=None, thresh=0.3,
+                           dataset='culane'):
+    # Sparse row sampling: interpolate and softmax only the ppl rows read by get_lane(),
+    # instead of the full input_size prob map (e.g. 18 of 288 rows on CULane).
+    # The 9 x 9 blur is approximated by a 1 x 9 blur, bilinear upsampled logits are locally linear in y,
+    # check parity to the dense decoders with tools/lane_decoder_parity.py
+    # logits: B x num_classes x h' x w' (before upsampling)
+    # existence: B x (num_classes - 1)
+    h, w = input_size
+    if ppl is None:
+        ppl = round(resize_shape[0] / 2 / gap)
+    rows = torch.tensor(get_sample_rows(h, resize_shape[0], gap, ppl, dataset), device=logits.device)
+    valid_rows = rows >= 0
+    rows = rows.clamp(min=0)
+    row_probs = interpolate_rows(logits, rows, input_size).softmax(dim=1)[:, 1:]
+    if smooth:
+        row_probs = box_blur_rows(row_probs, torch.arange(ppl, device=logits.device), vertical=False)
+
+    return rows_to_lines(row_probs, existence, w, resize_shape, gap, ppl, thresh, dataset, valid_rows)
+
+
 # A unified inference function, for segmentation-based lane detection methods
 @torch.no_grad()
-def lane_as_segmentation_inference(net, inputs, input_sizes, gap, ppl, thresh, dataset, max_lane=0, forward=True):
+def lane_as_segmentation_inference(net, inputs, input_sizes, gap, ppl, thresh, dataset, max_lane=0, forward=True,
+                                   decoder='naive'):
     # Assume net and images are on the same device
     # images: B x C x H x W
+    # decoder: 'naive' (per-lane numpy & cv2 post-processing), 'tensor' (batched on device, same results)
+    #          or 'sparse' (batched on device, only upsample sampled rows)
     # Return: a list of lane predictions on each image
     outputs = net(inputs) if forward else inputs  # Support no forwarding inside this function
-    prob_map = torch.nn.functional.interpolate(outputs['out'], size=input_sizes[0], mode='bilinear',
-                                               align_corners=True).softmax(dim=1)
     existence_conf = outputs['lane'].sigmoid()
     existence = existence_conf > 0.5
     if max_lane != 0:  # Lane max number prior for testing
         existence, existence_conf = lane_pruning(existence, existence_conf, max_lane=max_lane)
 
+    if decoder == 'sparse':
+        return logits_to_lines_sparse(outputs['out'], existence, input_size=input_sizes[0],
+                                      resize_shape=input_sizes[1], gap=gap, ppl=ppl, thresh=thresh, dataset=dataset)
+    prob_map = torch.nn.functional.interpolate(outputs['out'], size=input_sizes[0], mode='bilinear',
+                                               align_corners=True).softmax(dim=1)
+    if decoder == 'tensor':
+        return prob_to_lines_batched(prob_map, existence, resize_shape=input_sizes[1],
+                                     gap=gap, ppl=ppl, thresh=thresh, dataset=dataset)
+    elif decoder != 'naive':
+        raise ValueError('Unknown segmentation lane decoder: {}'.format(decoder))
+
     prob_map = prob_map.cpu().numpy()
     existence = existence.cpu().numpy()
 
@@ -0,0 +1,86 @@
+# Linear sum assignment (Hungarian matching) backends for the matching losses
+import torch
+from scipy.optimize import linear_sum_assignment
+
+
+@torch.no_grad()
+def hungarian_batched(C):
+    # Shortest augmenting path Hungarian algorithm (the O(n^2 m) version with potentials),
+    # for a batch of problems at once on any device, loops are fixed-length to avoid host syncs
+    # C: B x n x m (n <= m), each row is assigned to a distinct column with the min total cost
+    # Return: B x n column index for each row
+    B, n, m = C.shape
+    device = C.device
+    if not torch.isfinite(C).all():
+        raise ValueError('Cost matrix contains inf or NaN entries')
+    inf = float('inf')
+    # 1-indexed as the classic implementation, row/column 0 are dummies
+    a = torch.nn.functional.pad(C.double(), (1, 0, 1, 0))
+    u = torch.zeros(B, n + 1, dtype=torch.float64, device=device)
+    v = torch.zeros(B, m + 1, dtype=torch.float64, device=device)
+    p = torch.zeros(B, m + 1, dtype=torch.int64, device=device)  # Row assigned to each column, 0 for none
+    way = torch.zeros(B, m + 1, dtype=torch.int64, device=device)
+    batch_inds = torch.arange(B, device=device)
+    for i in range(1, n + 1):
+        p[:, 0] = i
+        j0 = torch.zeros(B, 1, dtype=torch.int64, device=device)
+        minv = torch.full((B, m + 1), inf, dtype=torch.float64, device=device)
+        used = torch.zeros(B, m + 1, dtype=torch.bool, device=device)
+        active = torch.ones(B, 1, dtype=torch.bool, device=device)
+        # Find an augmenting path, at most i steps (i - 1 columns are assigned)
+        for _ in range(i):
+            used.scatter_(1, j0, True)
+            i0 = p.gather(1, j0)
+            cur = a[batch_inds, i0.squeeze(1)] - u.gather(1, i0) - v
+            update = ~used * (cur < minv)
+            minv = torch.where(update, cur, minv)
+            way = torch.where(update, j0, way)
+            delta, j1 = minv.masked_fill(used, inf)[:, 1:].min(dim=1, keepdim=True)
+            delta = torch.where(active, delta, torch.zeros_like(delta))  # Finished problems remain the same
+            u.scatter_add_(1, p, delta * used)
+            v -= delta * used
+            minv -= delta * ~used
+            j0 = torch.where(active, j1 + 1, j0)
+            active = active * (p.gather(1, j0) != 0)
+        # Augment along the path
+        for _ in range(i):
+            valid = j0 != 0
+            j1 = way.gather(1, j0)
+            p.scatter_(1, j0, torch.where(valid, p.gather(1, j1), p.gather(1, j0)))
+            j0 = torch.where(valid, j1, j0)
+
+    # Columns without rows are written to the dummy row 0
+    results = torch.zeros(B, n + 1, dtype=torch.int64, device=device)
+    results.scatter_(1, p[:, 1:], torch.arange(m, device=device).expand(B, -1))
+
+    return results[:, 1:]
+
+
+@torch.no_grad()
+def batched_linear_sum_assignment(C, sizes, solver='scipy'):
+    # Match predictions of each image to its own targets
+    # C: B x Q x G cost matrices, G is the total number of targets, sizes: number of targets for each image
+    # solver: 'scipy' (on CPU, image by image) or 'torch' (all images at once on C's device, finite costs only),
+    #         they give the same optimal costs, but the assignments can differ when there are ties
+    # Return: (pred_indices, target_indices) for each image, sorted by pred_indices as scipy does
+    B, Q = C.shape[:2]
+    max_size = max(sizes) if len(sizes) > 0 else 0
+    if solver == 'torch' and 0 < max_size <= Q:
+        # Pad to B x max_size x Q, a padded target has 0 cost to any prediction
+        offsets = torch.tensor([0] + list(sizes[:-1]), device=C.device).cumsum(0)
+        target_inds = offsets.unsqueeze(-1) + torch.arange(max_size, device=C.device)  # B x max_size
+        valid = torch.arange(max_size, device=C.device) < torch.tensor(sizes, device=C.device).unsqueeze(-1)
+        padded = C.transpose(1, 2).gather(1, (target_inds * valid).unsqueeze(-1).expand(-1, -1, Q))
+        pred_inds = hungarian_batched(padded.masked_fill(~valid.unsqueeze(-1), 0))
+        # Sort and put padded targets at last, so no boolean indexing (host sync) is needed
+        _, order = (pred_inds + ~valid * Q).sort(dim=1)
+        pred_inds = pred_inds.gather(1, order)
+
+        return [(pred_inds[i, :size], order[i, :size]) for i, size in enumerate(sizes)]
+    elif solver in ['scipy', 'torch']:
+        C = C.cpu()
+        indices = [linear_sum_assignment(c[i]) for i, c in enumerate(C.split(sizes, -1))]
+
+        return [(torch.as_tensor(i, dtype=torch.int64), torch.as_tensor(j, dtype=torch.int64)) for i, j in indices]
+    else:
+        raise ValueError('Unknown assignment solver: {}'.format(solver))
@@ -4,16 +4,15 @@
 
 import torch
 from torch.nn import functional as F
-from scipy.optimize import linear_sum_assignment
 
 from ..ddp_utils import is_dist_avail_and_initialized, get_world_size
 from ..curve_utils import BezierSampler, cubic_bezier_curve_segment, get_valid_points
 from ._utils import WeightedLoss
+from ._assignment import batched_linear_sum_assignment
 from .hungarian_loss import HungarianLoss
 from .builder import LOSSES
 
 
-# TODO: Speed-up Hungarian on GPU with tensors
 class _HungarianMatcher(torch.nn.Module):
     """This class computes an assignment between the targets and the predictions of the network
 
@@ -21,10 +20,12 @@ class _HungarianMatcher(torch.nn.Module):
     there are more predictions than targets. In this case, we do a 1-to-1 matching of the best predictions,
     while the others are un-matched (and thus treated as non-objects).
     POTO matching, which maximizes the cost matrix.
+    The assignment is solved by `solver`: 'scipy' (CPU) or 'torch' (batched on the cost matrix's device).
     """
 
-    def __init__(self, alpha=0.8, bezier_order=3, num_sample_points=100, k=7):
+    def __init__(self, alpha=0.8, bezier_order=3, num_sample_points=100, k=7, solver='scipy'):
         super().__init__()
+        self.solver = solver
         self.k = k
         self.alpha = alpha
         self.num_sample_points = num_sample_points
@@ -77,20 +78,18 @@ class _HungarianMatcher(torch.nn.Module):
 
         # Final cost matrix (scipy uses min instead of max)
         C = local_maxima * cost_label ** (1 - self.alpha) * cost_curve ** self.alpha
-        C = -C.view(B, Q, -1).cpu()
+        C = -C.view(B, Q, -1)
 
         # Hungarian (weighted) on each image
-        indices = [linear_sum_assignment(c[i]) for i, c in enumerate(C.split(sizes, -1))]
-
         # Return (pred_indices, target_indices) for each image
-        return [(torch.as_tensor(i, dtype=torch.int64), torch.as_tensor(j, dtype=torch.int64)) for i, j in indices]
+        return batched_linear_sum_assignment(C, sizes, solver=self.solver)
 
 
 @LOSSES.register()
 class HungarianBezierLoss(WeightedLoss):
     def __init__(self, curve_weight=1, label_weight=0.1, seg_weight=0.75, alpha=0.8,
                  num_sample_points=100, bezier_order=3, weight=None, size_average=None, reduce=None, reduction='mean',
-                 ignore_index=-100, weight_seg=None, k=9):
+                 ignore_index=-100, weight_seg=None, k=9, solver='scipy'):
         super().__init__(weight, size_average, reduce, reduction)
         self.curve_weight = curve_weight  # Weight for sampled points' L1 distance error between curves
         self.label_weight = label_weight  # Weight for classification error
@@ -99,7 +98,7 @@ class HungarianBezierLoss(WeightedLoss):
         self.ignore_index = ignore_index
         self.bezier_sampler = BezierSampler(num_sample_points=num_sample_points, order=bezier_order)
         self.matcher = _HungarianMatcher(alpha=alpha, num_sample_points=num_sample_points, bezier_order=bezier_order,
-                                         k=k)
+                                         k=k, solver=solver)
         if self.weight is not None and not isinstance(self.weight, torch.Tensor):
             self.weight = torch.tensor(self.weight).cuda()
         if self.weight_seg is not None and not isinstance(self.weight_seg, torch.Tensor):
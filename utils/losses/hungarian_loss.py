@@ -4,9 +4,9 @@
 import torch
 from torch import Tensor
 from torch.nn import functional as F
-from scipy.optimize import linear_sum_assignment
 
 from ._utils import WeightedLoss
+from ._assignment import batched_linear_sum_assignment
 from ..models.lane_detection import cubic_curve_with_projection
 from ..ddp_utils import is_dist_avail_and_initialized, get_world_size
 from .builder import LOSSES
@@ -26,7 +26,6 @@ def lane_normalize_in_batch(keypoints):
     return norm_weights, valid_points  # [...], [..., N]
 
 
-# TODO: Speed-up Hungarian on GPU with tensors
 # Nothing will happen with DDP (for at last we use image-wise results)
 class HungarianMatcher(torch.nn.Module):
     """This class computes an assignment between the targets and the predictions of the network
@@ -34,10 +33,12 @@ class HungarianMatcher(torch.nn.Module):
     For efficiency reasons, the targets don't include the no_object. Because of this, in general,
     there are more predictions than targets. In this case, we do a 1-to-1 matching of the best predictions,
     while the others are un-matched (and thus treated as non-objects).
+    The assignment is solved by `solver`: 'scipy' (CPU) or 'torch' (batched on the cost matrix's device).
     """
 
-    def __init__(self, upper_weight=2, lower_weight=2, curve_weight=5, label_weight=3):
+    def __init__(self, upper_weight=2, lower_weight=2, curve_weight=5, label_weight=3, solver='scipy'):
         super().__init__()
+        self.solver = solver
         self.lower_weight = lower_weight
         self.upper_weight = upper_weight
         self.curve_weight = curve_weight
@@ -82,13 +83,11 @@ class HungarianMatcher(torch.nn.Module):
         # Final cost matrix
         C = self.label_weight * cost_label + self.curve_weight * cost_curve + \
             self.lower_weight * cost_lower + self.upper_weight * cost_upper
-        C = C.view(bs, num_queries, -1).cpu()
+        C = C.view(bs, num_queries, -1)
 
         # Hungarian (weighted) on each image
-        indices = [linear_sum_assignment(c[i]) for i, c in enumerate(C.split(sizes, -1))]
-
         # Return (pred_indices, target_indices) for each image
-        return [(torch.as_tensor(i, dtype=torch.int64), torch.as_tensor(j, dtype=torch.int64)) for i, j in indices]
+        return batched_linear_sum_assignment(C, sizes, solver=self.solver)
 
 
 # The Hungarian loss for LSTR
@@ -97,13 +96,13 @@ class HungarianLoss(WeightedLoss):
     __constants__ = ['reduction']
 
     def __init__(self, upper_weight=2, lower_weight=2, curve_weight=5, label_weight=3,
-                 weight=None, size_average=None, reduce=None, reduction='mean'):
+                 weight=None, size_average=None, reduce=None, reduction='mean', solver='scipy'):
         super(HungarianLoss, self).__init__(weight, size_average, reduce, reduction)
         self.lower_weight = lower_weight
         self.upper_weight = upper_weight
         self.curve_weight = curve_weight
         self.label_weight = label_weight
-        self.matcher = HungarianMatcher(upper_weight, lower_weight, curve_weight, label_weight)
+        self.matcher = HungarianMatcher(upper_weight, lower_weight, curve_weight, label_weight, solver)
 
     @staticmethod
     def get_src_permutation_idx(indices):
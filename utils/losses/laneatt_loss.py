@@ -34,11 +34,11 @@ class LaneAttLoss(WeightedLoss):
         self.t_pos = t_pos
         self.t_neg = t_neg
         self.focal_loss = FocalLoss(alpha=alpha, gamma=gamma)
-        self.smooth_l1_loss = torch.nn.SmoothL1Loss()
+        self.smooth_l1_loss = torch.nn.SmoothL1Loss(reduction='none')
 
     def forward(self, inputs, targets, net):
         # inputs: batchsize x 3 x img_h x img_w
-        # B: batch size, M: max lane
+        # B: batch size, M: max lane, A: number of anchors
         labels = {
             'offsets': torch.stack([i['offsets'] for i in targets], dim=0),  # B x M x num_offsets
             'starts': torch.stack([i['starts'] for i in targets], dim=0),  # B x M x 1
@@ -48,68 +48,44 @@ class LaneAttLoss(WeightedLoss):
         batch_size = inputs.shape[0]
 
         outputs = net(inputs)
-        cls_loss = torch.tensor(0, dtype=torch.float32, device=inputs.device)
-        reg_loss = torch.tensor(0, dtype=torch.float32, device=inputs.device)
-        total_positives = 0
-
-        # TODO: Replace these ridiculous codes with batch computation
-        for i in range(batch_size):
-            # Filter lanes that do not exist (confidence == 0)
-            target = {k: v[i][labels['flags'][i]] for k, v in labels.items()}
-
-            # If there are no targets, all proposals have to be negatives (i.e., 0 confidence)
-            if len(target['offsets']) == 0:
-                cls_target = torch.zeros(outputs['logits'][i].shape[0],
-                                         dtype=torch.long, device=outputs['logits'].device)
-                cls_loss = cls_loss + self.focal_loss(outputs['logits'][i], cls_target).sum()
-                continue
-
-            # Match GT
-            positives_mask, invalid_offsets_mask, negatives_mask, target_positives_indices = \
-                self.match_proposals_with_targets(net.module.anchors.clone() if get_world_size() >= 2
-                                                  else net.anchors.clone(), target)
-            # Get positives & negatives
-            positives = {k: v[i][positives_mask] for k, v in outputs.items()}
-            num_positives = positives['logits'].shape[0]
-            total_positives += num_positives
-            negatives = {k: v[i][negatives_mask] for k, v in outputs.items()}
-            num_negatives = negatives['logits'].shape[0]
-
-            # Handle edge case of no positives found
-            if num_positives == 0:
-                cls_target = torch.zeros(outputs['logits'][i].shape[0],
-                                         dtype=torch.long, device=outputs['logits'].device)
-                cls_loss = cls_loss + self.focal_loss(outputs['logits'][i], cls_target).sum()
-                continue
-
-            # Get classification targets (normal cases)
-            cls_target = torch.zeros(num_positives + num_negatives,
-                                     dtype=torch.long, device=outputs['logits'].device)
-            cls_target[:num_positives] = 1
-            cls_pred = torch.cat([positives['logits'], negatives['logits']], dim=0)
-
-            # Regression loss (including length)
-            reg_pred = torch.cat([positives['lengths'][..., None], positives['offsets']], dim=1)
-            with torch.no_grad():
-                target = {k: v[target_positives_indices] for k, v in target.items()}
-                positive_starts = (positives['starts'] * self.num_strips).round().long()
-                targets_starts = (target['starts'] * self.num_strips).round().long()
-                target['lengths'] -= (positive_starts - targets_starts)
-                all_indices = torch.arange(num_positives, dtype=torch.long)
-                ends = (positive_starts + target['lengths'] - 1).round().long()
-                # length + num_offsets + pad (assignment trick ?)
-                invalid_offsets_mask = torch.zeros((num_positives, 1 + self.num_offsets + 1), dtype=torch.int)
-                invalid_offsets_mask[all_indices, 1 + positive_starts] = 1
-                invalid_offsets_mask[all_indices, 1 + ends + 1] -= 1
-                invalid_offsets_mask = invalid_offsets_mask.cumsum(dim=1) == 0
-                invalid_offsets_mask = invalid_offsets_mask[:, :-1]
-                invalid_offsets_mask[:, 0] = False
-                reg_target = torch.cat([target['lengths'][..., None], target['offsets']], dim=1)
-                reg_target[invalid_offsets_mask] = reg_pred[invalid_offsets_mask]  # apply invalids
-
-            # loss
-            reg_loss += self.smooth_l1_loss(reg_pred, reg_target)
-            cls_loss += self.focal_loss(cls_pred, cls_target).sum() / num_positives
+
+        # Match GT for all images at once
+        positives_mask, negatives_mask, target_positives_indices = \
+            self.match_proposals_with_targets(net.module.anchors.clone() if get_world_size() >= 2
+                                              else net.anchors.clone(), labels)
+        num_positives = positives_mask.sum(dim=1)  # B
+        total_positives = num_positives.sum()
+
+        # Classification loss: positives & negatives, or all proposals (as negatives) if no positive is found
+        # (including images without targets)
+        cls_target = positives_mask.long()
+        cls_valid = torch.where((num_positives > 0)[:, None], positives_mask | negatives_mask,
+                                torch.ones_like(positives_mask))
+        cls_loss = self.focal_loss(outputs['logits'].flatten(end_dim=-2), cls_target.flatten()).view_as(cls_target)
+        cls_loss = ((cls_loss * cls_valid).sum(dim=1) / num_positives.clamp(min=1)).sum()
+
+        # Regression loss (including length), on positives, the mean of each image
+        reg_pred = torch.cat([outputs['lengths'][..., None], outputs['offsets']], dim=-1)  # B x A x (1 + num_offsets)
+        with torch.no_grad():
+            target = {
+                'offsets': labels['offsets'].gather(1, target_positives_indices[..., None].expand(
+                    -1, -1, labels['offsets'].shape[-1])),  # B x A x num_offsets
+                'starts': labels['starts'].gather(1, target_positives_indices),  # B x A
+                'lengths': labels['lengths'].gather(1, target_positives_indices)  # B x A
+            }
+            positive_starts = (outputs['starts'] * self.num_strips).round().long()
+            targets_starts = (target['starts'] * self.num_strips).round().long()
+            target['lengths'] -= (positive_starts - targets_starts)
+            ends = (positive_starts + target['lengths'] - 1).round().long()
+            # length + num_offsets, same as the cumsum trick with a 1 at 1 + start and a -1 at 1 + end + 1
+            all_indices = torch.arange(1 + self.num_offsets, dtype=torch.long, device=ends.device)
+            invalid_offsets_mask = (all_indices >= 1 + positive_starts[..., None]) == \
+                                   (all_indices >= 1 + ends[..., None] + 1)
+            invalid_offsets_mask[..., 0] = False
+            reg_target = torch.cat([target['lengths'][..., None], target['offsets']], dim=-1)
+            reg_target = torch.where(invalid_offsets_mask, reg_pred, reg_target)  # apply invalids
+        reg_loss = self.smooth_l1_loss(reg_pred, reg_target) * positives_mask[..., None]
+        reg_loss = (reg_loss.sum(dim=(1, 2)) / (num_positives * reg_pred.shape[-1]).clamp(min=1)).sum()
 
         # Batch mean
         if self.reduction == 'mean':
@@ -120,72 +96,57 @@ class LaneAttLoss(WeightedLoss):
 
         total_loss = self.cls_weight * cls_loss + self.reg_weight * reg_loss
 
-        # print(torch.tensor(total_positives))
         return total_loss, {'total loss': total_loss,
                             'cls loss': cls_loss,
                             'reg loss': reg_loss,
-                            'all positives': torch.tensor(total_positives).to(reg_loss.device)}
+                            'all positives': total_positives}
 
     @torch.no_grad()
     def match_proposals_with_targets(self, proposals, labels):
         # Note: matching is between GT and anchors, not predictions
-        # repeat proposals and targets to generate all combinations
-        num_proposals = proposals.shape[0]
+        # proposals: A x (2 + num_offsets), labels: B x M x ... (with flags for valid lanes)
+        # Return: positives (B x A), negatives (B x A), the matched target (B x A, only valid for positives)
 
-        # Match targets with anchors data format (start len offsets)
-        targets = torch.cat([labels['starts'][..., None], labels['lengths'][..., None], labels['offsets']], dim=1)
-        num_targets = targets.shape[0]
+        # Match targets with anchors data format (start len offsets), non-existing targets are set to 0
+        targets = torch.cat([labels['starts'][..., None], labels['lengths'][..., None], labels['offsets']], dim=-1)
+        targets = targets.masked_fill(~labels['flags'][..., None], 0)
 
         # pad proposals and target for the valid_offset_mask's trick
-        proposals_pad = proposals.new_zeros(proposals.shape[0], proposals.shape[1] + 1)
-        proposals_pad[:, :-1] = proposals
-        proposals = proposals_pad
-        targets_pad = targets.new_zeros(targets.shape[0], targets.shape[1] + 1)
-        targets_pad[:, :-1] = targets
-        targets = targets_pad
-
-        # repeat interleave [a, b] 2 times gives [a, a, b, b]
-        proposals = torch.repeat_interleave(proposals, num_targets, dim=0)
-        # applying this 2 times on [c, d] gives [c, d, c, d]
-        targets = torch.cat(num_proposals * [targets])
+        proposals = torch.nn.functional.pad(proposals, (0, 1))
+        targets = torch.nn.functional.pad(targets, (0, 1))
+
+        # all combinations: B x A x M x ...
+        proposals = proposals[None, :, None, :]
+        targets = targets[:, None, :, :]
 
         # get start and the intersection of offsets
-        targets_starts = targets[:, 0] * self.num_strips
-        proposals_starts = proposals[:, 0] * self.num_strips
+        targets_starts = targets[..., 0] * self.num_strips
+        proposals_starts = proposals[..., 0] * self.num_strips
         starts = torch.max(targets_starts.float(), proposals_starts).round().long()
-        ends = (targets_starts + targets[:, 1].float() - 1.).round().long()
+        ends = (targets_starts + targets[..., 1].float() - 1.).round().long()
         lengths = ends - starts + 1
-        ends[lengths < 0] = starts[lengths < 0] - 1
-        lengths[lengths < 0] = 0  # a negative number here means no intersection, thus no length
+        ends = torch.where(lengths < 0, starts - 1, ends)
+        lengths = lengths.clamp(min=0)  # a negative number here means no intersection, thus no length
 
-        # generate valid offsets mask, which works like this:
+        # valid offsets mask, same as the cumsum trick:
         # start with mask [0, 0, 0, 0, 0]
         # suppose start = 1
         # length = 2
-        valid_offsets_mask = targets.new_zeros(targets.shape)
-        all_indices = torch.arange(valid_offsets_mask.shape[0], dtype=torch.long, device=targets.device)
-        #  put a one on index `start`, giving [0, 1, 0, 0, 0]
-        valid_offsets_mask[all_indices, 2 + starts] = 1
-        #  put a -1 on the `end` index, giving [0, 1, 0, -1, 0]
-        valid_offsets_mask[all_indices, 2 + ends + 1] -= 1
-        valid_offsets_mask = valid_offsets_mask.cumsum(dim=1) != 0
-        invalid_offsets_mask = ~valid_offsets_mask
+        # put a one on index `start`, giving [0, 1, 0, 0, 0]
+        # put a -1 on the `end` index, giving [0, 1, 0, -1, 0]
+        # cumsum != 0 gives [0, 1, 1, 0, 0]
+        all_indices = torch.arange(targets.shape[-1], dtype=torch.long, device=targets.device)
+        valid_offsets_mask = (all_indices >= 2 + starts[..., None]) ^ (all_indices >= 2 + ends[..., None] + 1)
 
         # compute distance
-        # this compares [ac, ad, bc, bd], i.e., all combinations
-        distances = torch.abs((targets - proposals) * valid_offsets_mask.float()).sum(dim=1) / \
+        # d[b, i, j] = distance from proposal i to target j in image b
+        distances = torch.where(valid_offsets_mask, (targets - proposals).abs_(), 0).sum(dim=-1) / \
                     (lengths.float() + 1e-9)  # avoid division by zero
-        distances[lengths == 0] = INFINITY
-        invalid_offsets_mask = invalid_offsets_mask.view(num_proposals, num_targets, invalid_offsets_mask.shape[1])
-        distances = distances.view(num_proposals, num_targets)  # d[i,j] = distance from proposal i to target j
-
-        positives = distances.min(dim=1)[0] < self.t_pos
-        negatives = distances.min(dim=1)[0] > self.t_neg
+        distances = distances.masked_fill(lengths == 0, INFINITY)
+        distances = distances.masked_fill(~labels['flags'][:, None, :], float('inf'))
 
-        if positives.sum() == 0:
-            target_positives_indices = torch.tensor([], device=positives.device, dtype=torch.long)
-        else:
-            target_positives_indices = distances[positives].argmin(dim=1)
+        min_distances, target_positives_indices = distances.min(dim=-1)
+        positives = min_distances < self.t_pos
+        negatives = min_distances > self.t_neg
 
-        invalid_offsets_mask = invalid_offsets_mask[positives, target_positives_indices]
-        return positives, invalid_offsets_mask[:, :-1], negatives, target_positives_indices
+        return positives, negatives, target_positives_indices
@@ -2,53 +2,59 @@ import torch
 import numpy as np
 
 from .utils import lane_pruning
-from ...curve_utils import BezierCurve
+from ...curve_utils import bernstein_matrix, cubic_bezier_solve_y
 
 
 class BezierBaseNet(torch.nn.Module):
-    def __init__(self, thresh=0.5, local_maximum_window_size=9):
+    def __init__(self, thresh=0.5, local_maximum_window_size=9, row_decoder='sample'):
+        # row_decoder: how x on fixed rows (TuSimple) are found,
+        #              'sample' (nearest of H sampled points within 5 pixels) or 'solve' (solve y(t) = row exactly)
         super().__init__()
+        if row_decoder not in ['sample', 'solve']:
+            raise ValueError('Unknown row decoder: {}'.format(row_decoder))
+        self.row_decoder = row_decoder
         self.thresh = thresh
         self.local_maximum_window_size = local_maximum_window_size
 
     def forward(self, *args, **kwargs):
         raise NotImplementedError
 
-    @staticmethod
-    def bezier_to_coordinates(control_points, existence, resize_shape, dataset, bezier_curve, ppl=56, gap=10):
-        # control_points: L x N x 2
+    def bezier_to_coordinates(self, control_points, existence, resize_shape, dataset, ppl=56, gap=10, n=50):
+        # All existing lanes of a batch are sampled on the device together (float64, as the former numpy version),
+        # only the final coordinates are transferred to the host
+        # control_points: B x Q x N x 2, existence: B x Q
+        # Return: a list of lane coordinates on each image
         H, W = resize_shape
-        cps_of_lanes = []
-        for flag, cp in zip(existence, control_points):
-            if flag:
-                cps_of_lanes.append(cp.tolist())
-        coordinates = []
-        for cps_of_lane in cps_of_lanes:
-            bezier_curve.assign_control_points(cps_of_lane)
-            if dataset == 'tusimple':
-                # Find x for TuSimple's fixed y eval positions (suboptimal)
+        num_lanes = existence.sum(dim=-1).tolist()
+        control_points = control_points[existence].double()  # L x N x 2
+        if dataset == 'tusimple':
+            # Find x for TuSimple's fixed y eval positions
+            h_samples = torch.tensor([1.0 - (ppl - i) * gap / H for i in range(ppl)],
+                                     dtype=torch.float32, device=control_points.device).double()
+            if self.row_decoder == 'solve':
+                xs, valid = cubic_bezier_solve_y(control_points, h_samples)  # L x ppl
+            else:  # Nearest sampled point (suboptimal)
                 bezier_threshold = 5.0 / H
-                h_samples = np.array([1.0 - (ppl - i) * gap / H for i in range(ppl)], dtype=np.float32)
-                sampled_points = bezier_curve.quick_sample_point(image_size=None)
-                temp = []
-                dis = np.abs(np.expand_dims(h_samples, -1) - sampled_points[:, 1])
-                idx = np.argmin(dis, axis=-1)
-                for i in range(ppl):
-                    h = H - (ppl - i) * gap
-                    if dis[i][idx[i]] > bezier_threshold or sampled_points[idx[i]][0] > 1 or sampled_points[idx[i]][0] < 0:
-                        temp.append([-2, h])
-                    else:
-                        temp.append([sampled_points[idx[i]][0] * W, h])
-                coordinates.append(temp)
-            elif dataset in ['culane', 'llamas']:
-                temp = bezier_curve.quick_sample_point(image_size=None)
-                temp[:, 0] = temp[:, 0] * W
-                temp[:, 1] = temp[:, 1] * H
-                coordinates.append(temp.tolist())
-            else:
-                raise ValueError
+                c_matrix = bernstein_matrix(order=3, num_points=H, dtype=torch.float64, device=control_points.device)
+                sampled_points = c_matrix.matmul(control_points)  # L x H x 2
+                dis = (h_samples.unsqueeze(-1) - sampled_points[:, :, 1].unsqueeze(1)).abs()  # L x ppl x H
+                idx = dis.argmin(dim=-1, keepdim=True)
+                xs = sampled_points[:, :, 0].gather(1, idx.squeeze(-1))
+                valid = dis.gather(-1, idx).squeeze(-1) <= bezier_threshold
+            valid *= (xs <= 1) * (xs >= 0)
+            coordinates = [[[x * W, H - (ppl - i) * gap] if flag else [-2, H - (ppl - i) * gap]
+                            for i, (x, flag) in enumerate(zip(xs_lane, valid_lane))]
+                           for xs_lane, valid_lane in zip(xs.cpu().tolist(), valid.cpu().tolist())]
+        elif dataset in ['culane', 'llamas']:
+            c_matrix = bernstein_matrix(order=3, num_points=n, dtype=torch.float64, device=control_points.device)
+            sampled_points = c_matrix.matmul(control_points)  # L x n x 2
+            sampled_points *= torch.tensor([W, H], dtype=sampled_points.dtype, device=sampled_points.device)
+            coordinates = sampled_points.cpu().tolist()
+        else:
+            raise ValueError
+        offsets = np.cumsum([0] + num_lanes)
 
-        return coordinates
+        return [coordinates[offsets[i]:offsets[i + 1]] for i in range(len(num_lanes))]
 
     @torch.no_grad()
     def inference(self, inputs, input_sizes, gap, ppl, dataset, max_lane=0, forward=True, return_cps=False, n=50):
@@ -79,16 +85,9 @@ class BezierBaseNet(torch.nn.Module):
             cps = control_points * image_size
             cps = [cps[i][existence[i]].cpu().numpy() for i in range(existence.shape[0])]
 
-        existence = existence.cpu().numpy()
-        control_points = control_points.cpu().numpy()
-        H, _ = input_sizes[1]
-        b = BezierCurve(order=3, num_sample_points=H if dataset == 'tusimple' else n)
-
-        lane_coordinates = []
-        for j in range(existence.shape[0]):
-            lane_coordinates.append(self.bezier_to_coordinates(control_points=control_points[j], existence=existence[j],
-                                                               resize_shape=input_sizes[1], dataset=dataset,
-                                                               bezier_curve=b, gap=gap, ppl=ppl))
+        lane_coordinates = self.bezier_to_coordinates(control_points=control_points, existence=existence,
+                                                      resize_shape=input_sizes[1], dataset=dataset,
+                                                      gap=gap, ppl=ppl, n=n)
         if return_cps:
             return cps, lane_coordinates
         else:
@@ -22,8 +22,9 @@ class BezierLaneNet(BezierBaseNet):
                  image_height=360,
                  num_regression_parameters=8,
                  thresh=0.5,
-                 local_maximum_window_size=9):
-        super(BezierLaneNet, self).__init__(thresh, local_maximum_window_size)
+                 local_maximum_window_size=9,
+                 row_decoder='sample'):
+        super(BezierLaneNet, self).__init__(thresh, local_maximum_window_size, row_decoder)
         global_stride = 16
         branch_channels = 256
 
@@ -12,14 +12,18 @@ import numpy as np
 import torch.nn as nn
 from torch.nn import functional as F
 from scipy.interpolate import splprep, splev
-from .._utils import is_tracing
 
+from ...common import warnings
 try:
-    from ...csrc.apis import line_nms
-    print('Successfully complied line nms for LaneATT.')
-except:
-    from ...common import warnings
-    warnings.warn('Can\'t complie line nms op for LaneATT. Set verbose=True for load in /utils/csrc/apis.py L9 for details.')
+    from ...csrc.apis import line_nms_batched, line_nms_, line_nms_error, line_nms_cpu_, line_nms_cpu_error
+    if line_nms_cpu_ is None:
+        warnings.warn('CPU line nms op for LaneATT is not compiled: {}'.format(line_nms_cpu_error))
+    if line_nms_ is None:
+        warnings.warn('CUDA line nms op for LaneATT is not compiled: {}'.format(line_nms_error))
+    elif line_nms_cpu_ is not None:
+        print('Successfully compiled line nms for LaneATT.')
+except Exception as e:
+    warnings.warn('Can\'t compile line nms op for LaneATT: {}'.format(e))
 from ..builder import MODELS
 
 
@@ -29,6 +33,8 @@ class LaneAtt(nn.Module):
     left_angles = [72., 60., 49., 39., 30., 22.]
     right_angles = [108., 120., 131., 141., 150., 158.]
     bottom_angles = [165., 150., 141., 131., 120., 108., 100., 90., 80., 72., 60., 49., 39., 30., 15.]
+    # TuSimple rows
+    tusimple_h_samples = [(160 + y * 10) for y in range(56)]
 
     def __init__(self,
                  backbone_cfg,
@@ -43,8 +49,13 @@ class LaneAtt(nn.Module):
                  conf_thres=None,
                  nms_thres=0,
                  nms_topk=3000,
-                 trace_arg=None):
+                 tusimple_decoder='spline'):
+        # tusimple_decoder: how x on TuSimple rows are found, 'spline' (nearest of 200 points on a spline fit)
+        #                   or 'linear' (linear interpolation of all lanes at once)
         super().__init__()
+        if tusimple_decoder not in ['spline', 'linear']:
+            raise ValueError('Unknown TuSimple decoder: {}'.format(tusimple_decoder))
+        self.tusimple_decoder = tusimple_decoder
         self.backbone = MODELS.from_dict(backbone_cfg)
         self.backbone_channels = backbone_channels
         self.stride = backbone_os
@@ -62,10 +73,6 @@ class LaneAtt(nn.Module):
         self.nms_thres = nms_thres
         self.nms_topk = nms_topk
 
-        if trace_arg is not None:  # Pre-compute
-            attention_matrix = torch.eye(topk_anchors).repeat(trace_arg['bs'], 1, 1)
-            self.pre_non_diag_inds = torch.nonzero(attention_matrix == 0., as_tuple=False)
-
         # generate anchors
         self.anchors, self.anchors_cut = self.generate_anchors(lateral_n=72, bottom_n=128)
         # Filter masks if `anchors_freq_path` is provided
@@ -77,7 +84,7 @@ class LaneAtt(nn.Module):
             self.anchors_cut = self.anchors_cut[idx]
 
         # pre compute indices for the anchor pooling
-        self.cut_zs, self.cut_ys, self.cut_xs, self.invalid_mask = self.compute_anchor_cut_indices(
+        self.cut_inds, self.invalid_mask = self.compute_anchor_cut_indices(
             self.anchor_feat_channels, self.featmap_w, self.featmap_h)
 
         # Setup ans initialize layers
@@ -100,77 +107,68 @@ class LaneAtt(nn.Module):
 
     def generate_side_anchors(self, angles, nb_origins, x=None, y=None):
         if x is None and y is not None:
-            starts = [(x, y) for x in np.linspace(1., 0., num=nb_origins)]
+            start_xs = np.linspace(1., 0., num=nb_origins)
+            start_ys = np.full_like(start_xs, y)
         elif x is not None and y is None:
-            starts = [(x, y) for y in np.linspace(1., 0., num=nb_origins)]
+            start_ys = np.linspace(1., 0., num=nb_origins)
+            start_xs = np.full_like(start_ys, x)
         else:
             raise Exception('Please define exactly one of `x` or `y` (not neither nor both)')
 
-        n_anchors = nb_origins * len(angles)
-
         # each row, first for x and second for y:
         # 2 scores, 1 start_y, start_x, 1 length, num_points coordinates
         # score[0] = negative prob, score[0] = positive prob
-        anchors = torch.zeros((n_anchors, 2 + self.num_offsets))
-        anchors_cut = torch.zeros((n_anchors, 2 + self.featmap_h))
-        for i, start in enumerate(starts):
-            for j, angle in enumerate(angles):
-                k = i * len(angles) + j
-                anchors[k] = self.generate_anchor(start, angle)
-                anchors_cut[k] = self.generate_anchor(start, angle, cut=True)
+        # All anchors at once, row k = i * len(angles) + j for the i-th start & j-th angle
+        anchors = self.generate_anchor(start_xs, start_ys, angles)
+        anchors_cut = self.generate_anchor(start_xs, start_ys, angles, cut=True)
 
         return anchors, anchors_cut
 
-    def generate_anchor(self, start, angle, cut=False):
-        if cut:
-            anchor_ys = self.anchor_cut_ys
-            anchor = torch.zeros(2 + self.featmap_h)
-        else:
-            anchor_ys = self.anchor_ys
-            anchor = torch.zeros(2 + self.num_offsets)
-        angle = angle * math.pi / 180.  # degrees to radians
-        start_x, start_y = start
-        anchor[0] = 1 - start_y  # using left bottom as the (0, 0) of the axis ?
-        anchor[1] = start_x
-        anchor[2:] = (start_x + (1 - anchor_ys - 1 + start_y) / math.tan(angle)) * self.img_w
+    def generate_anchor(self, start_xs, start_ys, angles, cut=False):
+        # Closed-form, same float32 arithmetic as computing anchors 1 by 1
+        anchor_ys = self.anchor_cut_ys if cut else self.anchor_ys
+        tans = torch.tensor([math.tan(angle * math.pi / 180.) for angle in angles])[None, :, None]  # degrees to radians
+        num_starts, num_angles = len(start_xs), len(angles)
+        anchors = torch.zeros(num_starts, num_angles, 2 + len(anchor_ys))
+        anchors[:, :, 0] = torch.from_numpy(1 - start_ys)[:, None].float()  # using left bottom as the (0, 0) of the axis ?
+        anchors[:, :, 1] = torch.from_numpy(start_xs)[:, None].float()
+        start_xs = torch.from_numpy(start_xs).float()[:, None, None]
+        start_ys = torch.from_numpy(start_ys).float()[:, None, None]
+        anchors[:, :, 2:] = (start_xs + (1 - anchor_ys - 1 + start_ys) / tans) * self.img_w
 
-        return anchor
+        return anchors.view(num_starts * num_angles, -1)
 
     def compute_anchor_cut_indices(self, num_channels, feat_w, feat_h):
-        # definitions
-        num_proposal = len(self.anchors_cut)
-
-        # indexing
+        # Indices into flattened (feat_h * feat_w) feature maps, same for all channels & images
         # num_anchors x feat_h
         unclamped_xs = torch.flip((self.anchors_cut[:, 2:] / self.stride).round().long(), dims=(1, ))
-        unclamped_xs = unclamped_xs[..., None]
-        # num_channels x num_anchors x feat_h --> num_channels * num_anchors * feat_h x 1
-        unclamped_xs = torch.repeat_interleave(unclamped_xs, num_channels, dim=0).reshape(-1, 1)
         cut_xs = torch.clamp(unclamped_xs, 0, feat_w - 1)
-        unclamped_xs = unclamped_xs.reshape(num_proposal, num_channels, feat_h, 1)
-        invalid_mask = (unclamped_xs < 0) | (unclamped_xs > feat_w)
-        cut_ys = torch.arange(0, feat_h)
-        cut_ys = cut_ys.repeat(num_channels * num_proposal)[:, None].reshape(num_proposal, num_channels, feat_h)
-        cut_ys = cut_ys.reshape(-1, 1)
-        cut_zs = torch.arange(num_channels).repeat_interleave(feat_h).repeat(num_proposal)[:, None]
+        cut_inds = (torch.arange(0, feat_h)[None, :] * feat_w + cut_xs).flatten()
+        # num_anchors x 1 x feat_h, broadcast to channels
+        invalid_mask = ((unclamped_xs < 0) | (unclamped_xs > feat_w))[:, None, :]
 
-        return cut_zs, cut_ys, cut_xs, invalid_mask
+        return cut_inds, invalid_mask
 
     def cut_anchor_features(self, features):
-        # definitions
-        batch_size = features.shape[0]
-        n_proposals = len(self.anchors)
-        n_fmaps = features.shape[1]
-        batch_anchor_features = torch.zeros((batch_size, n_proposals, n_fmaps, self.featmap_h, 1),
-                                            device=features.device)
+        # 1 gather for the whole batch (no per-image loop or zeroed buffer)
+        # B x C x H x W -> B x C x (num_anchors * H) -> B x num_anchors x C x H x 1
+        batch_size, n_fmaps = features.shape[:2]
+        rois = features.flatten(2).index_select(2, self.cut_inds)
+        rois = rois.view(batch_size, n_fmaps, -1, self.featmap_h).transpose(1, 2)
+        rois = rois.masked_fill(self.invalid_mask, 0)
 
-        # actual cutting
-        for batch_idx, img_features in enumerate(features):
-            rois = img_features[self.cut_zs, self.cut_ys, self.cut_xs].view(n_proposals, n_fmaps, self.featmap_h, 1)
-            rois[self.invalid_mask] = 0
-            batch_anchor_features[batch_idx] = rois
+        return rois[..., None]
 
-        return batch_anchor_features
+    @staticmethod
+    def fill_attention_matrix(attention):
+        # B x M x (M - 1) attention weights (to all other anchors) -> B x M x M, zeros on the diagonal
+        # Each diagonal 0 is followed by M off-diagonal elements in row-major order,
+        # so just insert zeros by padding, no eye matrix or nonzero() needed (also for tracing)
+        batch_size, num_anchors = attention.shape[:2]
+        attention_matrix = F.pad(attention.reshape(batch_size, num_anchors - 1, num_anchors), (1, 0))
+        attention_matrix = F.pad(attention_matrix.flatten(1), (0, 1))
+
+        return attention_matrix.view(batch_size, num_anchors, num_anchors)
 
     @staticmethod
     def initialize_layer(layer):
@@ -183,9 +181,7 @@ class LaneAtt(nn.Module):
         cuda_self = super().cuda(device)
         cuda_self.anchors = cuda_self.anchors.cuda(device)
         cuda_self.anchor_ys = cuda_self.anchor_ys.cuda(device)
-        cuda_self.cut_zs = cuda_self.cut_zs.cuda(device)
-        cuda_self.cut_ys = cuda_self.cut_ys.cuda(device)
-        cuda_self.cut_xs = cuda_self.cut_xs.cuda(device)
+        cuda_self.cut_inds = cuda_self.cut_inds.cuda(device)
         cuda_self.invalid_mask = cuda_self.invalid_mask.cuda(device)
         return cuda_self
 
@@ -193,9 +189,7 @@ class LaneAtt(nn.Module):
         device_self = super().to(*args, **kwargs)
         device_self.anchors = device_self.anchors.to(*args, **kwargs)
         device_self.anchor_ys = device_self.anchor_ys.to(*args, **kwargs)
-        device_self.cut_zs = device_self.cut_zs.to(*args, **kwargs)
-        device_self.cut_ys = device_self.cut_ys.to(*args, **kwargs)
-        device_self.cut_xs = device_self.cut_xs.to(*args, **kwargs)
+        device_self.cut_inds = device_self.cut_inds.to(*args, **kwargs)
         device_self.invalid_mask = device_self.invalid_mask.to(*args, **kwargs)
         return device_self
 
@@ -207,19 +201,12 @@ class LaneAtt(nn.Module):
         batch_anchor_features = self.cut_anchor_features(batch_features)
 
         # join proposals from all images into a single proposals features batch
-        batch_anchor_features = batch_anchor_features.view(-1, self.anchor_feat_channels * self.featmap_h)
+        batch_anchor_features = batch_anchor_features.reshape(-1, self.anchor_feat_channels * self.featmap_h)
         # add attention features
         softmax = nn.Softmax(dim=1)
         scores = self.attention_layer(batch_anchor_features)
         attention = softmax(scores).reshape(x.shape[0], len(self.anchors), -1)
-        attention_matrix = torch.eye(attention.shape[1], device=x.device).repeat(x.shape[0], 1, 1)
-        if is_tracing():
-            # Use pre-computed nonzero results
-            non_diag_inds = self.pre_non_diag_inds.to(attention_matrix.device)
-        else:
-            non_diag_inds = torch.nonzero(attention_matrix == 0., as_tuple=False)
-        attention_matrix[:] = 0
-        attention_matrix[non_diag_inds[:, 0], non_diag_inds[:, 1], non_diag_inds[:, 2]] = attention.flatten()
+        attention_matrix = self.fill_attention_matrix(attention)
         batch_anchor_features = batch_anchor_features.reshape(x.shape[0], len(self.anchors), -1)
         attention_features = torch.bmm(torch.transpose(batch_anchor_features, 1, 2),
                                        torch.transpose(attention_matrix, 1, 2)).transpose(1, 2)
@@ -252,76 +239,96 @@ class LaneAtt(nn.Module):
         outputs = self.forward(inputs) if forward else inputs  # Support no forwarding inside this function
         to_tusimple = True if args[1] == "tusimple" else False
         batch_regs = self.nms(outputs)
-        # the number of lanes is 1 ???
-        decoded = []
         for regs in batch_regs:
             regs[:, 1] = torch.round(regs[:, 1])  # length
-            if regs.shape[0] == 0:
-                decoded.append([])
-                continue
-            pred = self.proposals_to_pred(regs, input_sizes[1], to_tusimple)
-            decoded.append(pred)
-        return decoded
+
+        return self.decode_proposals(batch_regs, input_sizes[1], to_tusimple)
 
     @torch.no_grad()
     def nms(self, batch_proposals):
-        proposals_list = []
-        for i in range(len(batch_proposals['logits'])):
-            scores = F.softmax(batch_proposals['logits'][i], dim=1)[:, 1]
-            regs = torch.cat([batch_proposals['starts'][i][..., None],
-                              batch_proposals['lengths'][i][..., None],
-                              batch_proposals['offsets'][i]], dim=1)
-            if self.conf_thres is not None:
-                # apply confidence threshold
-                above_threshold = scores > self.conf_thres
-                regs = regs[above_threshold]
-                scores = scores[above_threshold]
-            if regs.shape[0] == 0:
-                proposals_list.append(regs[[]])
-                continue
-            keep, num_to_keep, _ = line_nms(regs, scores, self.nms_thres, self.nms_topk)
-            keep = keep[:num_to_keep]
-            regs = regs[keep]
-            proposals_list.append(regs)
+        # All images in 1 line nms call
+        scores = F.softmax(batch_proposals['logits'], dim=-1)[..., 1]
+        regs = torch.cat([batch_proposals['starts'][..., None],
+                          batch_proposals['lengths'][..., None],
+                          batch_proposals['offsets']], dim=-1)
+        if self.conf_thres is not None:
+            # apply confidence threshold
+            above_threshold = scores > self.conf_thres
+            counts = above_threshold.sum(dim=1).tolist()
+            regs = regs[above_threshold]
+            scores = scores[above_threshold]
+        else:
+            counts = [regs.shape[1]] * regs.shape[0]
+            regs = regs.flatten(0, 1)
+            scores = scores.flatten()
+        if regs.shape[0] == 0:
+            return [regs[[]] for _ in counts]
+        keep, num_to_keep, _, offsets = line_nms_batched(regs, scores, counts, self.nms_thres, self.nms_topk)
+        num_to_keep = num_to_keep.tolist()
+        offsets = offsets.tolist()
+        proposals_list = [regs[keep[offsets[i]:offsets[i] + num_to_keep[i]]] for i in range(len(counts))]
 
         return proposals_list
 
     def proposals_to_pred(self, proposals, image_size, to_tusimple=False):
-        self.anchor_ys = self.anchor_ys.to(proposals.device)
-        lanes = []
-        for lane in proposals:
-            lane_xs = lane[2:] / self.img_w
-
-            # start end length in 0-72
-            start = int(round(lane[0].item() * self.num_strips))
-            length = int(round(lane[1].item()))
-            end = start + length - 1
-            end = min(end, len(self.anchor_ys) - 1)
-
-            # end = label_end
-            # if the proposal does not start at the bottom of the image,
-            # extend its proposal until the x is outside the image
-            mask = ~((((lane_xs[:start] >= 0.) &
-                       (lane_xs[:start] <= 1.)).cpu().numpy()[::-1].cumprod()[::-1]).astype(np.bool))
-            lane_xs[end + 1:] = -2
-            lane_xs[:start][mask] = -2
-            lane_ys = self.anchor_ys[lane_xs >= 0]
-            lane_xs = lane_xs[lane_xs >= 0]
-            lane_xs = lane_xs.flip(0)
-            lane_ys = lane_ys.flip(0)
-            if len(lane_xs) <= 1:
-                continue
-            points = torch.stack((lane_xs.reshape(-1, 1), lane_ys.reshape(-1, 1)), dim=1).squeeze(2)
-            points = points.cpu().numpy()
-            lane_coords = []
-            for i in range(points.shape[0]):
-                lane_coords.append([points[i, 0] * float(image_size[1]), points[i, 1] * float(image_size[0])])
-            if to_tusimple:
-                lanes.append(self.convert_to_tusimple(lane_coords))
-            else:
-                lanes.append(lane_coords)
+        return self.decode_proposals([proposals], image_size, to_tusimple)[0]
 
-        return lanes
+    @staticmethod
+    def _slice_bound(i, n):
+        # Same as python slicing bounds for i in x[:i] or x[i:]
+        return torch.where(i >= 0, i, i + n).clamp(0, n)
+
+    def decode_proposals(self, batch_proposals, image_size, to_tusimple=False):
+        # Decode kept proposals of all images at once (same rules as the per-lane python decoding),
+        # Return: lanes of each image, lists of [x, y]
+        num_lanes = [len(p) for p in batch_proposals]
+        if sum(num_lanes) == 0:
+            return [[] for _ in num_lanes]
+        proposals = torch.cat(list(batch_proposals))
+        self.anchor_ys = self.anchor_ys.to(proposals.device)
+        lane_xs = proposals[:, 2:] / self.img_w  # L x 72
+
+        # start end length in 0-72
+        starts = torch.round(proposals[:, 0].double() * self.num_strips).long()
+        lengths = torch.round(proposals[:, 1].double()).long()
+        ends = (starts + lengths - 1).clamp(max=len(self.anchor_ys) - 1)
+        inds = torch.arange(lane_xs.shape[1], device=proposals.device)[None, :]
+        start_bounds = self._slice_bound(starts, lane_xs.shape[1])[:, None]
+        end_bounds = self._slice_bound(ends + 1, lane_xs.shape[1])[:, None]
+
+        # if the proposal does not start at the bottom of the image,
+        # extend its proposal until the x is outside the image
+        inside = ((lane_xs >= 0.) & (lane_xs <= 1.)) | (inds >= start_bounds)
+        extended = inside.flip(1).int().cumprod(dim=1).flip(1).bool()
+        invalid = (inds >= end_bounds) | ((inds < start_bounds) & ~extended)
+        valid = ~invalid & (lane_xs >= 0)
+        counts = valid.sum(dim=1)
+
+        # Top to bottom, scale to image size
+        xs = (lane_xs * float(image_size[1])).flip(1).cpu().numpy()
+        ys = (self.anchor_ys * float(image_size[0])).flip(0).cpu().numpy()
+        valid = valid.flip(1).cpu().numpy()
+        counts = counts.tolist()
+        if to_tusimple and self.tusimple_decoder == 'linear':
+            tusimple_xs = self.resample_tusimple(xs, ys, valid).tolist()
+
+        results = []
+        lane_id = 0
+        for n in num_lanes:
+            lanes = []
+            for i in range(lane_id, lane_id + n):
+                if counts[i] <= 1:
+                    continue
+                if to_tusimple and self.tusimple_decoder == 'linear':
+                    lanes.append([[x if x >= 0 else -2, h] for x, h in zip(tusimple_xs[i], self.tusimple_h_samples)])
+                elif to_tusimple:
+                    lanes.append(self.convert_to_tusimple(list(zip(xs[i][valid[i]], ys[valid[i]]))))
+                else:
+                    lanes.append([[x, y] for x, y in zip(xs[i][valid[i]], ys[valid[i]])])
+            results.append(lanes)
+            lane_id += n
+
+        return results
 
     def convert_to_tusimple(self, points, n=200, bezier_threshold=5):
         """Spline interpolation of a lane. Used on the predictions"""
@@ -330,9 +337,8 @@ class LaneAtt(nn.Module):
         tck, _ = splprep([x, y], s=0, t=n, k=min(3, len(points) - 1))
         u = np.linspace(0., 1., n)
         rep_points = np.array(splev(u, tck)).T
-        h_samples = [(160 + y * 10) for y in range(56)]
         temp = []
-        for h_sample in h_samples:
+        for h_sample in self.tusimple_h_samples:
             dis = np.abs(h_sample - rep_points[:, 1])
             idx = np.argmin(dis)
             if dis[idx] > bezier_threshold:
@@ -340,3 +346,32 @@ class LaneAtt(nn.Module):
             else:
                 temp.append([round(rep_points[:, 0][idx], 3), h_sample])
         return temp
+
+    def resample_tusimple(self, xs, ys, valid, threshold=5):
+        """Linear interpolation of lanes at TuSimple rows, -2 for rows > threshold pixels away from a lane (numpy)"""
+        # xs: L x N, valid: L x N, ys: N (increasing)
+        h_samples = np.array(self.tusimple_h_samples, dtype=np.float64)
+        num_points = len(ys)
+        inds = np.arange(num_points)
+        # Nearest valid points above / below each row
+        last_valid = np.maximum.accumulate(np.where(valid, inds[None, :], -1), axis=1)
+        next_valid = np.minimum.accumulate(np.where(valid, inds[None, :], num_points)[:, ::-1], axis=1)[:, ::-1]
+        k = np.searchsorted(ys, h_samples, side='left')  # first point with y >= h
+        lo = np.where(k > 0, last_valid[:, np.maximum(k - 1, 0)], -1)  # L x 56
+        hi = np.where(k < num_points, next_valid[:, np.minimum(k, num_points - 1)], num_points)
+        lo_c = np.clip(lo, 0, num_points - 1)
+        hi_c = np.clip(hi, 0, num_points - 1)
+        x_lo = np.take_along_axis(xs, lo_c, axis=1).astype(np.float64)
+        x_hi = np.take_along_axis(xs, hi_c, axis=1).astype(np.float64)
+        y_lo = ys[lo_c].astype(np.float64)
+        y_hi = ys[hi_c].astype(np.float64)
+        has_lo = lo >= 0
+        has_hi = hi < num_points
+        both = has_lo & has_hi
+        w = np.where(both, (h_samples[None, :] - y_lo) / np.where(both, y_hi - y_lo, 1.), 0.)
+        res = np.where(both, x_lo + w * (x_hi - x_lo), np.where(has_lo, x_lo, x_hi))
+        # Rows beyond the lane ends
+        dis = np.where(both, 0., np.where(has_lo, h_samples[None, :] - y_lo, y_hi - h_samples[None, :]))
+        res = np.where((has_lo | has_hi) & (dis <= threshold), np.round(res, 3), -2.)
+
+        return res
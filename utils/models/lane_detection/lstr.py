@@ -119,24 +119,21 @@ class LSTR(nn.Module):
         if max_lane != 0:  # Lane max number prior for testing
             existence, _ = lane_pruning(existence, existence_conf, max_lane=max_lane)
 
-        existence = existence.cpu().numpy()
         # Get coordinates for lanes
-        lane_coordinates = []
-        for j in range(existence.shape[0]):
-            lane_coordinates.append(self.coefficients_to_coordinates(outputs['curves'][j, :, 2:], existence[j],
-                                    resize_shape=input_sizes[1], dataset=dataset, ppl=ppl,
-                                    gap=gap, curve_function=cubic_curve_with_projection,
-                                    upper_bound=outputs['curves'][j, :, 0],
-                                    lower_bound=outputs['curves'][j, :, 1]))
-
-        return lane_coordinates
+        return self.coefficients_to_coordinates(outputs['curves'][..., 2:], existence,
+                                                resize_shape=input_sizes[1], dataset=dataset, ppl=ppl,
+                                                gap=gap, curve_function=cubic_curve_with_projection,
+                                                upper_bound=outputs['curves'][..., 0],
+                                                lower_bound=outputs['curves'][..., 1])
 
     @staticmethod
     def coefficients_to_coordinates(coefficients, existence, resize_shape, dataset, ppl, gap, curve_function,
                                     upper_bound, lower_bound):
         # For methods that predict coefficients of polynomials,
         # works with normalized coordinates (in range 0.0 ~ 1.0).
-        # Restricted to single image to align with other methods' codes
+        # All images are processed together on the device, only the final coordinates are transferred to the host
+        # coefficients: B x Q x C, existence & upper_bound & lower_bound: B x Q
+        # Return: a list of lane coordinates on each image
         H, W = resize_shape
         if dataset == 'tusimple':  # Annotation start at 10 pixel away from bottom
             y = torch.tensor([1.0 - (ppl - i) * gap / H for i in range(ppl)],
@@ -146,26 +143,32 @@ class LSTR(nn.Module):
                              dtype=coefficients.dtype, device=coefficients.device)
         else:
             raise ValueError
-        coords = curve_function(coefficients=coefficients, y=y.unsqueeze(0).expand(coefficients.shape[0], -1))
+        coords = curve_function(coefficients=coefficients, y=y.expand(*coefficients.shape[:-1], -1))  # B x Q x ppl
 
         # Delete outside points according to predicted upper & lower boundaries
-        coordinates = []
-        for i in range(existence.shape[0]):
-            if existence[i]:
-                # Note that in image coordinate system, (0, 0) is the top-left corner
-                valid_points = (coords[i] >= 0) * (coords[i] <= 1) * (y < lower_bound[i]) * (y > upper_bound[i])
-                if valid_points.sum() < 2:  # Same post-processing technique as segmentation methods
+        # Note that in image coordinate system, (0, 0) is the top-left corner
+        valid_points = (coords >= 0) * (coords <= 1) * \
+                       (y < lower_bound.unsqueeze(-1)) * (y > upper_bound.unsqueeze(-1))  # B x Q x ppl
+        # Same post-processing technique as segmentation methods (at least 2 points)
+        existence = existence * (valid_points.sum(dim=-1) >= 2)
+        xs = (coords * W).cpu().tolist()
+        valid_points = valid_points.cpu().tolist()
+
+        lane_coordinates = []
+        for xs_image, valid_image, exist in zip(xs, valid_points, existence.cpu().tolist()):
+            coordinates = []
+            for xs_lane, valid_lane, flag in zip(xs_image, valid_image, exist):
+                if not flag:
                     continue
                 if dataset == 'tusimple':  # Invalid sample points need to be included as negative value, e.g. -2
-                    coordinates.append([[(coords[i][j] * W).item(), H - (ppl - j) * gap]
-                                        if valid_points[j] else [-2, H - (ppl - j) * gap] for j in range(ppl)])
-                elif dataset in ['culane', 'llamas']:
-                    coordinates.append([[(coords[i][j] * W).item(), H - j * gap]
-                                        for j in range(ppl) if valid_points[j]])
+                    coordinates.append([[x, H - (ppl - j) * gap] if valid else [-2, H - (ppl - j) * gap]
+                                        for j, (x, valid) in enumerate(zip(xs_lane, valid_lane))])
                 else:
-                    raise ValueError
+                    coordinates.append([[x, H - j * gap] for j, (x, valid) in enumerate(zip(xs_lane, valid_lane))
+                                        if valid])
+            lane_coordinates.append(coordinates)
 
-        return coordinates
+        return lane_coordinates
 
     @torch.jit.unused
     def _set_aux_loss(self, output_class, output_curve):
@@ -3,12 +3,15 @@
 
 def lane_pruning(existence, existence_conf, max_lane):
     # Prune lanes based on confidence (a max number constrain for lanes in an image)
-    # Maybe too slow (but should be faster than topk/sort),
-    # consider batch size >> max number of lanes
-    while (existence.sum(dim=1) > max_lane).sum() > 0:
-        indices = (existence.sum(dim=1, keepdim=True) > max_lane).expand_as(existence) * \
-                  (existence_conf == existence_conf.min(dim=1, keepdim=True).values)
-        existence[indices] = 0
-        existence_conf[indices] = 1.1  # So we can keep using min
+    # Same results as iteratively removing the least confident lanes (all ties at once) in images with > max_lane lanes,
+    # but with 1 sort, no loop & no host sync:
+    # the lanes removed are the ones with confidence <= the smallest sorted confidence that leaves <= max_lane lanes
+    sorted_conf, sorted_indices = existence_conf.sort(dim=1)
+    num_lanes = existence.sum(dim=1, keepdim=True)
+    remaining = num_lanes - existence.gather(dim=1, index=sorted_indices).cumsum(dim=1)
+    first_fit = (remaining <= max_lane).int().argmax(dim=1, keepdim=True)
+    indices = (num_lanes > max_lane) * (existence_conf <= sorted_conf.gather(dim=1, index=first_fit))
+    existence.masked_fill_(indices, 0)
+    existence_conf.masked_fill_(indices, 1.1)  # Same as the removed ones in the iterative version
 
     return existence, existence_conf
@@ -18,8 +18,7 @@ MINIMAL_OPSET_VERSIONS = {
 TRACE_REQUIRE_PREPROCESSING = [
     'LSTR',
     'RESA',
-    'RESA_Net',
-    'LaneAtt'
+    'RESA_Net'
 ]
 
 
@@ -1,10 +1,16 @@
 import os
+import time
+import queue
+import threading
 import torch
 try:
     import ujson as json
 except ImportError:
     import json
 from tqdm import tqdm
+from importmagician import import_from
+with import_from('./'):
+    from tools.culane_evaluation_py.lane_store import save_packed_lanes, PACKED_SUFFIX
 if torch.__version__ >= '1.6.0':
     from torch.cuda.amp import autocast
 else:
@@ -15,6 +21,109 @@ from ..seg_utils import ConfusionMatrix
 from ..lane_det_utils import lane_as_segmentation_inference
 
 
+class LanePredictionWriter(object):
+    # Format & write predictions in a background thread fed by a bounded queue,
+    # so that disk I/O overlaps with inference of the next batches
+    # output_format: 'lines' (1 .lines.txt per image) or 'packed' (1 .lanes.npz file, CULane & LLAMAS)
+    def __init__(self, dataset, ppl, exp_name=None, max_queue_size=16, output_format='lines', output_dir='./output'):
+        if output_format not in ['lines', 'packed']:
+            raise ValueError('Unknown output format: {}'.format(output_format))
+        self.dataset = dataset
+        self.ppl = ppl
+        self.exp_name = exp_name
+        self.packed = output_format == 'packed' and dataset in ['culane', 'llamas']
+        self.output_dir = output_dir
+        self.packed_keys = []
+        self.packed_lanes = []
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.created_dirs = set()
+        self.all_lanes = []
+        self.error = None
+        self.wait_time = 0  # Time that inference was blocked by a full queue (i.e. disk is the bottleneck)
+        self.thread = threading.Thread(target=self._work, daemon=True)
+        self.thread.start()
+
+    def put(self, batch_coordinates, filenames):
+        if self.error is not None:
+            raise self.error
+        temp = time.perf_counter()
+        self.queue.put((batch_coordinates, filenames))
+        self.wait_time += time.perf_counter() - temp
+
+    def close(self):
+        # Flush & join, return time spent waiting for the queue (during inference, at the end)
+        temp = time.perf_counter()
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        if self.dataset == 'tusimple':
+            with open(os.path.join(self.output_dir, self.exp_name + '.json'), 'w') as f:
+                for lane in self.all_lanes:
+                    print(lane, end="\n", file=f)
+        elif self.packed:
+            filename = os.path.join(self.output_dir, self.exp_name + PACKED_SUFFIX)
+            save_packed_lanes(filename, self.packed_keys, self.packed_lanes)
+            print('Predictions saved to {}.'.format(filename))
+        elif self.exp_name is not None and os.path.exists(os.path.join(self.output_dir, self.exp_name + PACKED_SUFFIX)):
+            # Stale packed predictions would be preferred by the autotest scripts
+            os.remove(os.path.join(self.output_dir, self.exp_name + PACKED_SUFFIX))
+
+        return self.wait_time, time.perf_counter() - temp
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is None:  # Keep consuming after errors, so put() never blocks forever
+                try:
+                    self.write(*item)
+                except Exception as e:
+                    self.error = e
+
+    def _make_dir(self, filename):
+        dir_name = filename[:filename.rfind('/')]
+        if dir_name not in self.created_dirs:
+            os.makedirs(dir_name, exist_ok=True)
+            self.created_dirs.add(dir_name)
+
+    @staticmethod
+    def format_lines(lane_coordinates):
+        # The CULane format, 1 lane per line: x1 y1 x2 y2 ...
+        return ''.join([''.join(['{} {} '.format(x, y) for (x, y) in lane]) + '\n'
+                        for lane in lane_coordinates if lane])  # No printing for []
+
+    def write(self, batch_coordinates, filenames):
+        for j in range(len(batch_coordinates)):
+            lane_coordinates = batch_coordinates[j]
+            if self.packed:
+                # Keys are relative paths of the .lines.txt files
+                self.packed_keys.append(os.path.relpath(filenames[j].replace("_color_rect", ""), self.output_dir))
+                self.packed_lanes.append([lane for lane in lane_coordinates if lane])
+            elif self.dataset == 'culane':
+                # Save each lane to disk
+                self._make_dir(filenames[j])
+                with open(filenames[j], "w") as f:
+                    f.write(self.format_lines(lane_coordinates))
+            elif self.dataset == 'tusimple':
+                # Save lanes to a single file
+                formatted = {
+                    "h_samples": [160 + y * 10 for y in range(self.ppl)],
+                    "lanes": [[c[0] for c in lane] for lane in lane_coordinates],
+                    "run_time": 0,
+                    "raw_file": filenames[j]
+                }
+                self.all_lanes.append(json.dumps(formatted))
+            elif self.dataset == 'llamas':
+                # save each lane in images in xxx.lines.txt
+                self._make_dir(filenames[j])
+                with open(filenames[j].replace("_color_rect", ""), "w") as f:
+                    f.write(self.format_lines(lane_coordinates))
+            else:
+                raise ValueError
+
+
 class LaneDetTester(BaseTester):
     image_sets = ['valfast', 'test', 'val']
 
@@ -31,70 +140,40 @@ class LaneDetTester(BaseTester):
             self.test_one_set(self.model, self.device, self.dataloader, self._cfg['mixed_precision'],
                               [self._cfg['input_size'], self._cfg['original_size']],
                               self._cfg['gap'], self._cfg['ppl'], self._cfg['thresh'],
-                              self._cfg['dataset_name'], self._cfg['seg'], self._cfg['max_lane'], self._cfg['exp_name'])
+                              self._cfg['dataset_name'], self._cfg['seg'], self._cfg['max_lane'], self._cfg['exp_name'],
+                              self._cfg.get('seg_decoder', 'naive'), self._cfg.get('output_format', 'lines'))
 
     @staticmethod
     @torch.no_grad()
     def test_one_set(net, device, loader, mixed_precision, input_sizes, gap, ppl, thresh, dataset,
-                     seg, max_lane=0, exp_name=None):
+                     seg, max_lane=0, exp_name=None, seg_decoder='naive', output_format='lines'):
         # Adapted from harryhan618/SCNN_Pytorch
         # Predict on 1 data_loader and save predictions for the official script
         # sizes: [input size, test original size, ...]
         # max_lane = 0 -> unlimited number of lanes
+        # seg_decoder: post-processing for segmentation methods, 'naive', 'tensor' or 'sparse'
+        # output_format: 'lines' or 'packed' (CULane & LLAMAS predictions in ./output/<exp_name>.lanes.npz)
 
-        all_lanes = []
+        if dataset not in ['culane', 'tusimple', 'llamas']:
+            raise ValueError
+        writer = LanePredictionWriter(dataset, ppl, exp_name, output_format=output_format)
         net.eval()
         for images, filenames in tqdm(loader):
             images = images.to(device)
             with autocast(mixed_precision):
                 if seg:
                     batch_coordinates = lane_as_segmentation_inference(net, images,
-                                                                       input_sizes, gap, ppl, thresh, dataset, max_lane)
+                                                                       input_sizes, gap, ppl, thresh, dataset, max_lane,
+                                                                       decoder=seg_decoder)
                 else:
                     batch_coordinates = net.inference(images, input_sizes, gap, ppl, dataset, max_lane)
 
-            # Parse coordinates
-            for j in range(len(batch_coordinates)):
-                lane_coordinates = batch_coordinates[j]
-                if dataset == 'culane':
-                    # Save each lane to disk
-                    dir_name = filenames[j][:filenames[j].rfind('/')]
-                    if not os.path.exists(dir_name):
-                        os.makedirs(dir_name)
-                    with open(filenames[j], "w") as f:
-                        for lane in lane_coordinates:
-                            if lane:  # No printing for []
-                                for (x, y) in lane:
-                                    print("{} {}".format(x, y), end=" ", file=f)
-                                print(file=f)
-                elif dataset == 'tusimple':
-                    # Save lanes to a single file
-                    formatted = {
-                        "h_samples": [160 + y * 10 for y in range(ppl)],
-                        "lanes": [[c[0] for c in lane] for lane in lane_coordinates],
-                        "run_time": 0,
-                        "raw_file": filenames[j]
-                    }
-                    all_lanes.append(json.dumps(formatted))
-                elif dataset == 'llamas':
-                    # save each lane in images in xxx.lines.txt
-                    dir_name = filenames[j][:filenames[j].rfind('/')]
-                    file_path = filenames[j].replace("_color_rect", "")
-                    if not os.path.exists(dir_name):
-                        os.makedirs(dir_name)
-                    with open(file_path, "w") as f:
-                        for lane in lane_coordinates:
-                            if lane:  # No printing for []
-                                for (x, y) in lane:
-                                    print("{} {}".format(x, y), end=" ", file=f)
-                                print(file=f)
-                else:
-                    raise ValueError
+            # Parse coordinates & save in background
+            writer.put(batch_coordinates, filenames)
 
-        if dataset == 'tusimple':
-            with open('./output/' + exp_name + '.json', 'w') as f:
-                for lane in all_lanes:
-                    print(lane, end="\n", file=f)
+        wait_time, flush_time = writer.close()
+        print('Prediction writer: inference blocked {:.2f}s by a full queue, {:.2f}s to flush at the end.'.format(
+            wait_time, flush_time))
 
     @staticmethod
     @torch.no_grad()
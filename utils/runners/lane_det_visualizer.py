@@ -3,6 +3,9 @@ import torch
 import numpy as np
 from tqdm import tqdm
 from abc import abstractmethod
+from importmagician import import_from
+with import_from('./'):
+    from tools.culane_evaluation_py.lane_store import split_packed_path, load_lines
 if torch.__version__ >= '1.6.0':
     from torch.cuda.amp import autocast
 else:
@@ -17,8 +20,10 @@ from ..vis_utils import lane_detection_visualize_batched, save_images
 
 def lane_label_process_fn(label):
     # The CULane format
-    # input: label txt file path or content as list
+    # input: label txt file path (could be inside a packed .lanes.npz store) or content as list
     if isinstance(label, str):
+        if split_packed_path(label) is not None:
+            return [np.array(lane) for lane in load_lines(label)]
         with open(label, 'r') as f:
             label = f.readlines()
     target = []
@@ -51,7 +56,8 @@ class LaneDetVisualizer(BaseVisualizer):
                                                            self._cfg['ppl'],
                                                            self._cfg['thresh'],
                                                            self._cfg['dataset_name'],
-                                                           self._cfg['max_lane'])
+                                                           self._cfg['max_lane'],
+                                                           decoder=self._cfg.get('seg_decoder', 'naive'))
             else:
                 return_cps = self._cfg['style'] == 'bezier'
                 res = self.model.inference(images,
@@ -920,6 +920,28 @@ def affine(
     return F_t.affine(img, matrix=matrix, resample=resample, fillcolor=fillcolor)
 
 
+@torch.jit.unused
+def warp_affine(img, matrix, size, resample=0, fillcolor=None):
+    """Apply an affine transformation given by its inverse matrix on a PIL Image, to an output image of any size.
+
+    Args:
+        img (PIL Image): image to transform.
+        matrix (list of floats): 6 values of the inverse affine matrix (output -> input coordinates),
+            in continuous coordinates (origin is the top-left corner of the top-left pixel).
+        size (sequence): (h, w) of the output image.
+        resample (``PIL.Image.NEAREST`` or ``PIL.Image.BILINEAR`` or ``PIL.Image.BICUBIC``, optional):
+            An optional resampling filter.
+        fillcolor (int): Optional fill color for the area outside the transform in the output image.
+
+    Returns:
+        PIL Image: Transformed image.
+    """
+    if isinstance(img, torch.Tensor):
+        raise TypeError('warp_affine() only supports PIL Images')
+
+    return F_pil.affine(img, matrix=matrix, resample=resample, fillcolor=fillcolor, output_size=(size[1], size[0]))
+
+
 @torch.jit.unused
 def to_grayscale(img, num_output_channels=1):
     """Convert PIL image of any mode (RGB, HSV, LAB, etc) to grayscale version of image.
@@ -10,13 +10,23 @@ def affine(points, angle, translate, scale, shear, height, width, ignore_x=-2):
     # image center
     center = (width / 2, height / 2)
 
+    if sum(points.shape) == 0:
+        return points
+    matrix = get_affine_matrix(center, angle, translate, scale, shear)
+
+    return transform(points, matrix, height, width, ignore_x)
+
+
+def transform(points, matrix, height, width, ignore_x=-2):
+    # Transform a np.array (L x N x 2) of points (x, y) by a 3 x 3 affine matrix,
+    # original axis start from top-left corner
+    # Set ignore_x to None if you don't want to ignore out-of-image (height x width) points
     if sum(points.shape) == 0:
         return points
     if ignore_x is not None:
         ignore_filter = (points[:, :, 0] == ignore_x)
-    matrix = get_affine_matrix(center, angle, translate, scale, shear)
     homo_coords = np.concatenate([points, np.ones((*points.shape[:-1], 1), dtype=points.dtype)], axis=-1)
-    res = np.matmul(homo_coords, np.transpose(matrix))[:, :, :2]
+    res = np.matmul(homo_coords, np.transpose(matrix))[:, :, :2].astype(points.dtype, copy=False)
 
     if ignore_x is not None:
         ignore_by_border = (res[:, :, 0] < 0) + (res[:, :, 0] > width) \
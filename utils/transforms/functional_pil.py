@@ -474,7 +474,7 @@ def _parse_fill(fill, img, min_pil_version, name="fillcolor"):
 
 
 @torch.jit.unused
-def affine(img, matrix, resample=0, fillcolor=None):
+def affine(img, matrix, resample=0, fillcolor=None, output_size=None):
     """PRIVATE METHOD. Apply affine transformation on the PIL Image keeping image center invariant.
 
     .. warning::
@@ -490,6 +490,7 @@ def affine(img, matrix, resample=0, fillcolor=None):
             See `filters`_ for more information.
             If omitted, or if the image has mode "1" or "P", it is set to ``PIL.Image.NEAREST``.
         fillcolor (int): Optional fill color for the area outside the transform in the output image. (Pillow>=5.0.0)
+        output_size (2-tuple, optional): (w, h) of the output image, defaults to the input image size.
 
     Returns:
         PIL Image: Transformed image.
@@ -497,7 +498,8 @@ def affine(img, matrix, resample=0, fillcolor=None):
     if not _is_pil_image(img):
         raise TypeError('img should be PIL Image. Got {}'.format(type(img)))
 
-    output_size = img.size
+    if output_size is None:
+        output_size = img.size
     opts = _parse_fill(fillcolor, img, '5.0.0')
     return img.transform(output_size, Image.AFFINE, matrix, resample, **opts)
 
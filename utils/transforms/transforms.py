@@ -22,6 +22,7 @@ __all__ = [
     'ColorJitter',
     'Compose',
     'Crop',
+    'FusedAffine',
     'LabelMap',
     'MatchSize',
     'Normalize',
@@ -61,10 +62,57 @@ def _setup_angle(x, name, req_sizes=(2,)):
     return [float(d) for d in x]
 
 
+def _translation_matrix(t_x, t_y):
+    return np.array([[1, 0, t_x], [0, 1, t_y], [0, 0, 1]], dtype=np.float64)
+
+
+def _inverse_to_matrix(inverse):
+    # 6 values of an inverse affine matrix (as for PIL) -> 3 x 3 forward matrix
+    return np.linalg.inv(np.array([inverse[:3], inverse[3:], [0, 0, 1]], dtype=np.float64))
+
+
+def _is_fusable(t):
+    # Geometric transforms that can be fused by FusedAffine (image, mask and keypoints stay aligned)
+    if isinstance(t, RandomApply):
+        return len(t.transforms) > 0 and all(_is_fusable(x) for x in t.transforms)
+    if isinstance(t, RandomRotation):
+        return not t.expand and t.center is None
+    if isinstance(t, Resize):
+        return isinstance(t.size_image, Sequence) and len(t.size_image) == 2 and \
+            list(t.size_image) == list(t.size_label)
+
+    return isinstance(t, (RandomAffine, RandomTranslation, RandomResize, RandomCrop, RandomHorizontalFlip))
+
+
+def _fuse_geometric(transforms):
+    # Replace consecutive fusable transforms (at least 2, including those in RandomApply) by FusedAffine
+    def count(t):
+        return sum(count(x) for x in t.transforms) if isinstance(t, RandomApply) else 1
+
+    results = []
+    run = []
+    for t in transforms + [None]:
+        if t is not None and _is_fusable(t):
+            run.append(t)
+            continue
+        if sum(count(x) for x in run) >= 2:
+            results.append(FusedAffine(run))
+        else:
+            results += run
+        run = []
+        if t is not None:
+            results.append(t)
+
+    return results
+
+
 @TRANSFORMS.register()
 class Compose(object):
-    def __init__(self, transforms):
+    def __init__(self, transforms, fuse_geometric=False):
+        # fuse_geometric: apply consecutive geometric transforms by 1 warp (see FusedAffine)
         self.transforms = [t if callable(t) else TRANSFORMS.from_dict(t) for t in transforms]
+        if fuse_geometric:
+            self.transforms = _fuse_geometric(self.transforms)
 
     def __call__(self, image, target=None):
         for t in self.transforms:
@@ -89,6 +137,20 @@ class RandomApply(object):
 
         return image, target
 
+    def get_affine(self, size):
+        # Draw random parameters as __call__(), for FusedAffine
+        # size: (w, h) of the input image
+        # Return: a list of (3 x 3 forward matrix, output size (w, h), keypoint transform function)
+        steps = []
+        t = random.random()
+        if t < self.apply_prob:
+            for t in self.transforms:
+                steps += t.get_affine(size)
+                if len(steps) > 0:
+                    size = steps[-1][1]
+
+        return steps
+
 
 @TRANSFORMS.register()
 class Resize(object):
@@ -120,6 +182,17 @@ class Resize(object):
 
         return self.parse_resize(image, target, self.size_image, self.size_label, (h_ori, w_ori), self.ignore_x)
 
+    @staticmethod
+    def get_resize_affine(size, size_label, ignore_x):
+        w, h = size
+        out_h, out_w = size_label
+        matrix = np.diag([out_w / w, out_h / h, 1.0])
+
+        return [(matrix, (out_w, out_h), lambda points: F_kp.resize(points, (h, w), size_label, ignore_x))]
+
+    def get_affine(self, size):
+        return self.get_resize_affine(size, self.size_label, self.ignore_x)
+
 
 # Crop from up-left corner
 @TRANSFORMS.register()
@@ -189,6 +262,15 @@ class RandomTranslation(object):
         self.trans_w = trans_w
         self.ignore_x = ignore_x
 
+    def get_affine(self, size):
+        # Keypoints are translated along with the image, by the padding minus the crop offset
+        tw, th = size
+        i, j, h, w = RandomCrop.get_params_by_size((tw + 2 * self.trans_w, th + 2 * self.trans_h), (th, tw))
+        t_x, t_y = self.trans_w - j, self.trans_h - i
+
+        return [(_translation_matrix(t_x, t_y), (w, h),
+                 lambda points: F_kp.translate(points, t_x, t_y, h, w, self.ignore_x))]
+
     def __call__(self, image, target):
         tw, th = F._get_image_size(image)
         image = F.pad(image, [self.trans_w, self.trans_h, self.trans_w, self.trans_h], fill=0)
@@ -254,6 +336,14 @@ class RandomResize(object):
 
         return Resize.parse_resize(image, target, [h, w], [h, w], (h_ori, w_ori), self.ignore_x)
 
+    def get_affine(self, size):
+        min_h, min_w = self.min_size
+        max_h, max_w = self.max_size
+        h = random.randint(min_h, max_h)
+        w = random.randint(min_w, max_w)
+
+        return Resize.get_resize_affine(size, [h, w], self.ignore_x)
+
 
 @TRANSFORMS.register()
 class RandomScale(object):
@@ -282,7 +372,11 @@ class RandomCrop(object):
 
     @staticmethod
     def get_params(img, output_size):
-        w, h = F._get_image_size(img)
+        return RandomCrop.get_params_by_size(F._get_image_size(img), output_size)
+
+    @staticmethod
+    def get_params_by_size(size, output_size):
+        w, h = size
         th, tw = output_size
         if w <= tw and h <= th:
             return 0, 0, h, w
@@ -304,6 +398,13 @@ class RandomCrop(object):
 
         return Crop.parse_crop(image, target, i, j, h, w, self.ignore_x)
 
+    def get_affine(self, size):
+        # Zero padding on right & bottom (if needed) does not move anything
+        iw, ih = size
+        i, j, h, w = self.get_params_by_size((max(self.size[1], iw), max(self.size[0], ih)), self.size)
+
+        return [(_translation_matrix(-j, -i), (w, h), lambda points: F_kp.crop(points, i, j, h, w, self.ignore_x))]
+
 
 @TRANSFORMS.register()
 class RandomHorizontalFlip(object):
@@ -332,6 +433,15 @@ class RandomHorizontalFlip(object):
 
         return image, target
 
+    def get_affine(self, size):
+        t = random.random()
+        if t >= self.flip_prob:
+            return []
+        w, h = size
+        matrix = np.array([[-1, 0, w], [0, 1, 0], [0, 0, 1]], dtype=np.float64)
+
+        return [(matrix, (w, h), lambda points: F_kp.hflip(points, w / 2, self.ignore_x))]
+
 
 @TRANSFORMS.register()
 class ToTensor(object):
@@ -496,6 +606,15 @@ class RandomRotation(object):
 
         return image, target
 
+    def get_affine(self, size):
+        # Rotation around the image center without expanding, as PIL
+        angle = self.get_params(self.degrees)
+        w, h = size
+        matrix = _inverse_to_matrix(F._get_inverse_affine_matrix([w * 0.5, h * 0.5], -angle, [0.0, 0.0], 1.0,
+                                                                  [0.0, 0.0]))
+
+        return [(matrix, (w, h), lambda points: F_kp.rotate(points, angle, h, w, self.ignore_x))]
+
 
 # TODO: Change to random
 @TRANSFORMS.register()
@@ -720,6 +839,97 @@ class RandomAffine(torch.nn.Module):
 
         return image, target
 
+    def get_affine(self, size):
+        ret = self.get_params(self.degrees, self.translate, self.scale, self.shear)
+        w, h = size
+        matrix = _inverse_to_matrix(F._get_inverse_affine_matrix([w * 0.5, h * 0.5], ret[0], list(ret[1]), ret[2],
+                                                                  list(ret[3])))
+
+        return [(matrix, (w, h), lambda points: F_kp.affine(points, *ret, height=h, width=w, ignore_x=self.ignore_x))]
+
+
+@TRANSFORMS.register()
+class FusedAffine(object):
+    # Consecutive geometric transforms (RandomAffine, RandomRotation, RandomTranslation, Resize, RandomResize,
+    # RandomCrop, RandomHorizontalFlip, or RandomApply of them) composed into 1 affine matrix per sample.
+    # Random parameters are drawn by each transform in the same order and distributions as applying them 1 by 1,
+    # but the image is warped only once (bilinear), the mask once (nearest) and keypoints once
+    # (or transform by transform if any ignore_x is set, to keep the out-of-image filtering of each transform).
+    # Since the image is resampled once, pixels are slightly different (sharper) than the chained transforms.
+    # Falls back to applying the transforms 1 by 1 for tensors, numpy masks or padding masks.
+    def __init__(self, transforms):
+        self.transforms = [t if callable(t) else TRANSFORMS.from_dict(t) for t in transforms]
+        for t in self.transforms:
+            if not _is_fusable(t):
+                raise ValueError('{} can not be fused'.format(type(t).__name__))
+
+        def leaves(t):
+            return [y for x in t.transforms for y in leaves(x)] if isinstance(t, RandomApply) else [t]
+
+        self.transform_keypoints_once = all(t.ignore_x is None for x in self.transforms for t in leaves(x))
+
+    @staticmethod
+    def can_fuse(image, target):
+        if not isinstance(image, Image.Image):
+            return False
+        if isinstance(target, dict):
+            return 'padding_mask' not in target.keys() and \
+                   isinstance(target.get('segmentation_mask', image), Image.Image)
+
+        return target is None or isinstance(target, (str, Image.Image))
+
+    @staticmethod
+    def warp(image, matrix, size, resample, fill, reduce=False):
+        # matrix: 3 x 3 forward matrix, size: (w, h) of the output
+        inverse = np.linalg.inv(matrix)
+        if reduce:
+            # Scaling down by 2x or more, first shrink by an integer factor with a box filter (as reducing_gap in PIL),
+            # or bilinear sampling skips pixels (Resize() does antialiasing)
+            factors = np.floor(np.hypot(inverse[:2, 0], inverse[:2, 1])).astype(np.int64).clip(min=1).tolist()
+            if max(factors) > 1:
+                image = image.reduce(tuple(factors))
+                inverse = np.diag([1 / factors[0], 1 / factors[1], 1.0]) @ inverse
+
+        return F.warp_affine(image, inverse[:2].flatten().tolist(), [size[1], size[0]], resample=resample,
+                             fillcolor=fill)
+
+    def __call__(self, image, target=None):
+        if not self.can_fuse(image, target):
+            for t in self.transforms:
+                image, target = t(image, target)
+
+            return image, target
+
+        steps = []
+        size = F._get_image_size(image)
+        for t in self.transforms:
+            steps += t.get_affine(size)
+            if len(steps) > 0:
+                size = steps[-1][1]
+        if len(steps) == 0:
+            return image, target
+        matrix = np.eye(3)
+        for step_matrix, _, _ in steps:
+            matrix = step_matrix @ matrix
+        w, h = size
+
+        image = self.warp(image, matrix, size, Image.BILINEAR, 0, reduce=True)
+        if target is None or isinstance(target, str):
+            return image, target
+        elif isinstance(target, dict):
+            if 'keypoints' in target.keys():
+                if self.transform_keypoints_once:
+                    target['keypoints'] = F_kp.transform(target['keypoints'], matrix, h, w, ignore_x=None)
+                else:
+                    for _, _, keypoint_transform in steps:
+                        target['keypoints'] = keypoint_transform(target['keypoints'])
+            if 'segmentation_mask' in target.keys():
+                target['segmentation_mask'] = self.warp(target['segmentation_mask'], matrix, size, Image.NEAREST, 255)
+        else:
+            target = self.warp(target, matrix, size, Image.NEAREST, 255)
+
+        return image, target
+
 
 
 @TRANSFORMS.register()